@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Time the pbs_celery runner on this machine, with emulated PBS nodes.
+
+    python bench_celery_env.py --nodes 3 --cores-per-node 4 --tasks 2000 /tmp/bench
+
+Needs redis-server on the PATH. (see digitalearthau.runners.emulate)
+"""
+import logging
+import tempfile
+from pathlib import Path
+
+import click
+
+from digitalearthau.runners import celery_environment, emulate
+
+
+@click.command(help=__doc__)
+@click.option('--nodes', type=click.IntRange(1), default=2, help='Number of emulated nodes')
+@click.option('--cores-per-node', type=click.IntRange(1), default=4)
+@click.option('--workers-per-node', type=click.IntRange(1), default=None)
+@click.option('--tasks', type=click.IntRange(1), default=1000, help='Number of tasks to run')
+@click.option('--task-seconds', type=float, default=0.0, help='How long each task sleeps')
+@click.option('--worker-module', default=celery_environment.WORKER_MODULE,
+              help='Module run to start the workers on each node (eg. datacube.execution.worker)')
+@click.option('--warm/--cold', default=True, help='Start workers from a pre-imported parent, or each from scratch')
+@click.option('--import-profile', is_flag=True, help="Write each node's import times to the logs folder")
+@click.argument('work_path', type=click.Path(file_okay=False), required=False)
+def main(nodes, cores_per_node, workers_per_node, tasks, task_seconds, worker_module, warm, import_profile,
+         work_path):
+    logging.basicConfig(level=logging.INFO)
+    work_path = Path(work_path or tempfile.mkdtemp(prefix='dea-bench-'))
+    work_path.mkdir(parents=True, exist_ok=True)
+
+    timings = emulate.benchmark_runner(
+        work_path,
+        node_count=nodes,
+        cores_per_node=cores_per_node,
+        task_count=tasks,
+        task_seconds=task_seconds,
+        workers_per_node=workers_per_node,
+        worker_module=worker_module,
+        warm_start=warm,
+        import_profile=import_profile,
+    )
+    for name, value in timings._asdict().items():
+        click.echo('{:>22}: {}'.format(name, round(value, 3) if isinstance(value, float) else value))
+    click.echo('Events written to {}'.format(work_path.joinpath('events')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Time the serialisation of task events, as done for every event by the celery event logger.
+
+    python bench_serialise.py --count 100000
+"""
+import datetime
+import io
+import timeit
+import uuid
+
+import click
+from dateutil import tz
+
+from digitalearthau import serialise
+from digitalearthau.events import NodeMessage, Status, TaskEvent
+from digitalearthau.runners.model import DefaultJobParameters
+
+
+def example_event() -> TaskEvent:
+    return TaskEvent(
+        timestamp=datetime.datetime(2017, 10, 5, 22, 11, 45, tzinfo=tz.tzutc()),
+        event='task.complete',
+        name='fc',
+        user='dra547',
+        status=Status.COMPLETE,
+        id=uuid.UUID('9b1ad3d5-8ab4-4b91-a5b3-5d7e3f0bfa4c'),
+        parent_id=uuid.UUID('47d97d2d-9aeb-5e07-8072-ebcf9424fc97'),
+        job_parameters=DefaultJobParameters(
+            query={'time': [2015, 2016]},
+            source_products=['ls8_nbar_albers'],
+            output_products=['ls8_fc_albers'],
+        ),
+        message=None,
+        input_datasets=[uuid.UUID('d514c26a-d98f-47f1-b0de-15f7fe78c209')],
+        output_datasets=None,
+        node=NodeMessage(hostname='r2043.gadi.nci.org.au', pid=4521),
+    )
+
+
+@click.command(help=__doc__)
+@click.option('--count', type=click.IntRange(1), default=100000, help='Events per measurement')
+@click.option('--repeat', type=click.IntRange(1), default=3, help='Measurements to take (the best is shown)')
+def main(count, repeat):
+    event = example_event()
+    event_dict = serialise.type_to_dict(event)
+    writer = serialise.JsonLinesWriter(io.StringIO(), buffer_size=64 * 1024, fast_json=True)
+
+    def measure(name, func):
+        seconds = min(timeit.repeat(func, number=count, repeat=repeat))
+        click.echo('{:>16}: {:>9,.0f} events/s'.format(name, count / seconds))
+
+    measure('type_to_dict', lambda: serialise.type_to_dict(event))
+    measure('dict_to_type', lambda: serialise.dict_to_type(event_dict, TaskEvent))
+    measure('write_item', lambda: writer.write_item(event))
+
+
+if __name__ == '__main__':
+    main()
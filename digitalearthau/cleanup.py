@@ -24,6 +24,7 @@ from dateutil import tz
 
 @click.group(help=__doc__)
 @ui.global_cli_options
+@uiutil.profile_option
 def cli():
     pass
 
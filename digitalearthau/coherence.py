@@ -1,14 +1,58 @@
+import uuid
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
 import click
 import structlog
-import collections
+from dateutil.relativedelta import relativedelta
 
 from datacube import Datacube
-from datacube.model import Dataset
+from datacube.model import Range
 from datacube.ui import click as ui
-from digitalearthau import uiutil
+from digitalearthau import lineage, uiutil
+from digitalearthau.index import ArchiveBatcher, DEFAULT_ARCHIVE_CHUNK_SIZE
+from digitalearthau.qsub import TaskRunner, with_qsub_runner
+from digitalearthau.runners.util import init_run_directory
 
 _LOG = structlog.getLogger('archive-locationless')
-_siblings_count = 0
+
+_TIME_WINDOW_PERIODS = {
+    'year': relativedelta(years=1),
+    'month': relativedelta(months=1),
+}
+
+
+class CoherenceChecks(NamedTuple):
+    check_locationless: bool = False
+    archive_locationless: bool = False
+    check_ancestors: bool = False
+    check_siblings: bool = False
+    archive_siblings: bool = False
+
+
+class CoherenceCounts(NamedTuple):
+    datasets_count: int = 0
+    locationless_count: int = 0
+    siblings_count: int = 0
+    archived_count: int = 0
+
+    @classmethod
+    def merge(cls, counts: Iterable['CoherenceCounts']) -> 'CoherenceCounts':
+        """
+        >>> CoherenceCounts.merge([CoherenceCounts(10, 1, 0, 1), CoherenceCounts(5, 0, 2, 2)])
+        CoherenceCounts(datasets_count=15, locationless_count=1, siblings_count=2, archived_count=3)
+        """
+        return cls(*(sum(values) for values in zip(cls(), *counts)))
+
+
+class Window(NamedTuple):
+    """
+    A slice of the search that can be checked independently.
+    """
+    expressions: dict
+    # Inclusive range of dataset ids
+    id_range: Optional[Tuple[uuid.UUID, uuid.UUID]] = None
 
 
 @click.command()
@@ -32,12 +76,29 @@ _siblings_count = 0
               is_flag=True,
               default=False,
               help="Archive sibling datasets (forces --check-ancestors)")
+@click.option('--archive-chunk-size',
+              type=int,
+              default=DEFAULT_ARCHIVE_CHUNK_SIZE,
+              help="Number of datasets to archive in each index transaction")
+@click.option('--dry-run',
+              is_flag=True,
+              default=False,
+              help="Report what would be archived without changing the index")
+@click.option('--time-window',
+              type=click.Choice(sorted(_TIME_WINDOW_PERIODS)),
+              default=None,
+              help="Split the search into windows of this length of time, to check in parallel")
+@click.option('--id-windows',
+              type=int,
+              default=None,
+              help="Split the search into this many dataset id ranges, to check in parallel")
 @click.option('--test-dc-config', '-C',
               default=None,
               help='Custom datacube config file (testing purpose only)')
 @ui.parsed_search_expressions
+@with_qsub_runner()
 def main(expressions, check_locationless, archive_locationless, check_ancestors, check_siblings, archive_siblings,
-         test_dc_config):
+         archive_chunk_size, dry_run, time_window, id_windows, test_dc_config, runner: TaskRunner, qsub):
     """
     Find problem datasets using the index.
 
@@ -52,43 +113,185 @@ def main(expressions, check_locationless, archive_locationless, check_ancestors,
     until the entire folder has been synced, and ideally the ancestors synced too.)
     TODO: This could be merged into it as a post-processing step, although it's less safe than sync if
     TODO: the index is being updated concurrently by another
+
+    Large searches can be split with --time-window or --id-windows, and the windows checked in
+    parallel with --parallel, --celery or --qsub.
     """
-    global _siblings_count
+    if qsub is not None:
+        exit_code, output = qsub(auto=True)
+        click.echo(output)
+        raise click.exceptions.Exit(exit_code)
+
+    if time_window and id_windows:
+        raise click.UsageError("Only one of --time-window and --id-windows can be used")
+
     uiutil.init_logging()
-    with Datacube(config=test_dc_config) as dc:
-        _LOG.info('query', query=expressions)
-        count = 0
-        archive_count = 0
-        locationless_count = 0
-        for dataset in dc.index.datasets.search(**expressions):
-            count += 1
-            # Archive if it has no locations.
-            # (the sync tool removes locations that don't exist anymore on disk,
-            # but can't archive datasets as another path may be added later during the sync)
-            if check_locationless or archive_locationless:
-                if dataset.uris is not None and len(dataset.uris) == 0:
-                    locationless_count += 1
-
-                    if archive_locationless:
-                        dc.index.datasets.archive([dataset.id])
-                        archive_count += 1
-                        _LOG.info("locationless_dataset_id.archived", dataset_id=str(dataset.id))
-                    else:
-                        _LOG.info("locationless_dataset_id", dataset_id=str(dataset.id))
-
-            # If an ancestor is archived, it may have been replaced. This one may need
-            # to be reprocessed too.
-            if check_ancestors or archive_siblings or check_siblings:
-                archive_count += _check_ancestors(check_siblings, archive_siblings, dc, dataset)
-
-        _LOG.info("coherence.finish",
-                  datasets_count=count,
-                  locationless_count=locationless_count,
-                  siblings_count=_siblings_count,
-                  archived_count=archive_count)
-
-
-def _archive_duplicate_siblings(dc, ids):
+    _LOG.info('query', query=expressions)
+
+    checks = CoherenceChecks(
+        check_locationless=check_locationless,
+        archive_locationless=archive_locationless,
+        check_ancestors=check_ancestors,
+        check_siblings=check_siblings,
+        archive_siblings=archive_siblings,
+    )
+    check = partial(check_window,
+                    config=test_dc_config,
+                    checks=checks,
+                    archive_chunk_size=archive_chunk_size,
+                    dry_run=dry_run)
+
+    if not (time_window or id_windows):
+        counts = check(Window(expressions))
+    else:
+        if time_window:
+            with Datacube(config=test_dc_config) as dc:
+                windows = list(time_windows(expressions, _TIME_WINDOW_PERIODS[time_window], index=dc.index))
+        else:
+            windows = list(id_range_windows(expressions, id_windows))
+        _LOG.info('windows', window_count=len(windows), runner=repr(runner))
+
+        window_counts = []
+        try:
+            task_desc = init_run_directory('coherence', expressions) if runner.needs_work_directory() else None
+            _, failed_count = runner(task_desc, iter(windows), check, window_counts.append)
+        finally:
+            runner.stop()
+        counts = CoherenceCounts.merge(window_counts)
+
+        if failed_count:
+            _LOG.error("coherence.failed", dry_run=dry_run, failed_window_count=failed_count, **counts._asdict())
+            raise click.exceptions.Exit(1)
+
+    _LOG.info("coherence.finish", dry_run=dry_run, **counts._asdict())
+
+
+def check_window(task: Window,
+                 config: Optional[str],
+                 checks: CoherenceChecks,
+                 archive_chunk_size=DEFAULT_ARCHIVE_CHUNK_SIZE,
+                 dry_run=False) -> CoherenceCounts:
+    """
+    Run the checks over one window of the search.
+
+    Each window has its own index connection, so it can be run in a worker process. (It's the `task`
+    argument, as the TaskRunner gives it.)
+    """
+    window = task
+    with Datacube(config=config, app='dea-coherence') as dc, \
+            ArchiveBatcher(dc.index, chunk_size=archive_chunk_size, dry_run=dry_run, log=_LOG) as archiver:
+        graph = lineage.load_lineage(dc.index, window.expressions, id_range=window.id_range)
+        counts = _check_graph(graph, checks, archiver)
+
+    _LOG.info("window.finish", expressions=window.expressions, id_range=window.id_range, **counts._asdict())
+    return counts
+
+
+def _check_graph(graph: lineage.LineageGraph, checks: CoherenceChecks, archiver: ArchiveBatcher) -> CoherenceCounts:
+    locationless_count = 0
+    siblings_count = 0
+    # Archive if it has no locations.
+    # (the sync tool removes locations that don't exist anymore on disk,
+    # but can't archive datasets as another path may be added later during the sync)
+    if checks.check_locationless or checks.archive_locationless:
+        for i in graph.locationless():
+            locationless_count += 1
+            dataset_id = graph.ids[i]
+
+            if checks.archive_locationless:
+                archiver.archive([dataset_id])
+                graph.mark_archived([i])
+                _LOG.info("locationless_dataset_id.archived", dataset_id=str(dataset_id))
+            else:
+                _LOG.info("locationless_dataset_id", dataset_id=str(dataset_id))
+
+    # If an ancestor is archived, it may have been replaced. This one may need
+    # to be reprocessed too.
+    if checks.check_ancestors or checks.archive_siblings or checks.check_siblings:
+        for i, classifier, source in graph.archived_sources():
+            _LOG.info(
+                "ancestor.dataset_id",
+                dataset_id=str(graph.ids[i]),
+                source_type=classifier,
+                source_dataset_id=str(graph.ids[source])
+            )
+
+    if checks.check_siblings or checks.archive_siblings:
+        for i, source, siblings in graph.sibling_groups():
+            # Earlier archiving may have resolved this group already.
+            siblings = [s for s in siblings if not graph.archived[s]]
+            if graph.archived[i] or not siblings:
+                continue
+
+            siblings_count += 1
+            _LOG.info("dataset.siblings_exist",
+                      dataset_id=str(graph.ids[i]),
+                      siblings=[str(graph.ids[s]) for s in siblings])
+
+            # Choose the most recent sibling and archive others
+            if checks.archive_siblings:
+                _archive_duplicate_siblings(archiver, graph, siblings + [i])
+
+    return CoherenceCounts(
+        datasets_count=int(graph.in_scope.sum()),
+        locationless_count=locationless_count,
+        siblings_count=siblings_count,
+        archived_count=archiver.summary().dataset_count,
+    )
+
+
+def time_windows(expressions: dict, period: relativedelta, index=None) -> Iterator[Window]:
+    """
+    Split the search into consecutive time windows.
+
+    The search's own time range is used if it has one, otherwise the time bounds of the matching products.
+
+    (a dataset whose time range crosses a window boundary will be checked in both windows)
+
+    >>> query = {'product': 'ls8_nbar_scene', 'time': Range(datetime(2016, 11, 20), datetime(2017, 2, 1))}
+    >>> for w in time_windows(query, relativedelta(years=1)):
+    ...     print(w.expressions['time'].begin, '-', w.expressions['time'].end)
+    2016-11-20 00:00:00 - 2016-12-31 23:59:59.999999
+    2017-01-01 00:00:00 - 2017-02-01 00:00:00
+    """
+    if 'time' in expressions:
+        start, end = expressions['time']
+    else:
+        bounds = [index.datasets.get_product_time_bounds(product.name)
+                  for product, _ in index.products.search_robust(**expressions)]
+        if not bounds:
+            raise click.UsageError('No products match search terms: %r' % expressions)
+        start, end = min(b[0] for b in bounds), max(b[1] for b in bounds)
+
+    # Align windows to the period (whole years or months).
+    window_start = datetime(start.year, 1 if period.years else start.month, 1, tzinfo=start.tzinfo)
+    while window_start <= end:
+        window_end = window_start + period
+        yield Window(dict(expressions, time=Range(
+            max(start, window_start),
+            min(end, window_end - timedelta(microseconds=1))
+        )))
+        window_start = window_end
+
+
+def id_range_windows(expressions: dict, count: int) -> Iterator[Window]:
+    """
+    Split the search into even ranges of dataset id.
+
+    >>> [str(w.id_range[0]) for w in id_range_windows({}, 4)]  # doctest: +NORMALIZE_WHITESPACE
+    ['00000000-0000-0000-0000-000000000000', '40000000-0000-0000-0000-000000000000',
+     '80000000-0000-0000-0000-000000000000', 'c0000000-0000-0000-0000-000000000000']
+    >>> str(list(id_range_windows({}, 4))[-1].id_range[1])
+    'ffffffff-ffff-ffff-ffff-ffffffffffff'
+    """
+    space = 2 ** 128
+    for i in range(count):
+        low = i * space // count
+        high = (i + 1) * space // count - 1
+        yield Window(expressions, id_range=(uuid.UUID(int=low), uuid.UUID(int=high)))
+
+
+def _archive_duplicate_siblings(archiver: ArchiveBatcher, graph: lineage.LineageGraph, indices: List[int]) -> int:
     """Archive old versions of duplicate datasets.
 
     When given a list of duplicate sibling datasets, keep the most recently
@@ -96,58 +299,18 @@ def _archive_duplicate_siblings(dc, ids):
 
     Return the number of archived duplicates.
     """
-    # Look up the indexed time for each datset and store in a dict
-    id_to_index_time = {ds_id: dc.index.datasets.get(ds_id).indexed_time
-                        for ds_id in ids}
-
     # Sort by indexed time, and split into [newest : older_duplicates]
-    newest_ds, *older_duplicates = collections.OrderedDict(sorted(id_to_index_time.items(), key=lambda t: t[1], reverse=True))
+    newest, *older_duplicates = sorted(indices, key=lambda i: graph.indexed_time[i], reverse=True)
+    older_ids = [str(graph.ids[i]) for i in older_duplicates]
 
-    dc.index.datasets.archive(older_duplicates)
+    archiver.archive(older_ids)
+    graph.mark_archived(older_duplicates)
 
-    _LOG.info("dataset_id.archived", ids=older_duplicates)
-    _LOG.info("dataset_id.kept", id=newest_ds)
+    _LOG.info("dataset_id.archived", ids=older_ids)
+    _LOG.info("dataset_id.kept", id=str(graph.ids[newest]))
 
     return len(older_duplicates)
 
 
-def _check_ancestors(check_siblings: bool, archive_siblings: bool, dc: Datacube, dataset: Dataset):
-    global _siblings_count
-    ancestors_archive_count = 0
-    dataset = dc.index.datasets.get(dataset.id, include_sources=True)
-    if dataset.sources:
-        for classifier, source_dataset in dataset.sources.items():
-            if source_dataset.is_archived:
-                _LOG.info(
-                    "ancestor.dataset_id",
-                    dataset_id=str(dataset.id),
-                    source_type=classifier,
-                    source_dataset_id=str(source_dataset.id)
-                )
-            elif check_siblings or archive_siblings:
-                # If a source dataset has other siblings they may be duplicates.
-                # (this only applies to source products that are 1:1 with
-                # descendants, not pass-to-scene or scene-to-tile conversions)
-                siblings = dc.index.datasets.get_derived(source_dataset.id)
-
-                # Only active siblings of the same type.
-                siblings = [
-                    s for s in siblings
-                    if s != dataset and not s.is_archived and s.type == dataset.type
-                ]
-                if siblings:
-                    _siblings_count += 1
-                    sibling_ids = [str(d.id) for d in siblings]
-                    _LOG.info("dataset.siblings_exist",
-                              dataset_id=str(dataset.id),
-                              siblings=sibling_ids)
-
-                    # Choose the most recent sibling and archive others
-                    if archive_siblings:
-                        ancestors_archive_count += _archive_duplicate_siblings(dc, sibling_ids + [str(dataset.id)])
-
-    return ancestors_archive_count
-
-
 if __name__ == '__main__':
     main()
@@ -1,22 +1,54 @@
 # coding=utf-8
-
+"""
+Find datasets that share the unique fields of their collection.
+
+Rather than asking the database to group each product separately, every product sharing a metadata type
+is read through one server-side cursor as (product, unique field values, id, archived) rows. These are
+grouped by an external sort in this process, so memory stays bounded however many datasets there are, and
+the duplicate groups are written out incrementally as CSV or Parquet.
+"""
 import csv
-import sys
-from datetime import datetime
+import heapq
+import itertools
+import pickle
+import tempfile
+from collections import defaultdict
+from contextlib import ExitStack
+from datetime import date, datetime, timedelta
 from functools import singledispatch
-from typing import Iterable
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
 from uuid import UUID
 
 import click
+import structlog
 from dateutil import tz
 from psycopg2._range import Range
+from sqlalchemy import and_, select
 
+from datacube.drivers.postgres import _api as pgapi
 from datacube.index import Index
-from datacube.index.fields import Field
 from datacube.model import DatasetType, MetadataType
 from datacube.ui.click import global_cli_options, pass_index
 from digitalearthau import collections
 
+_LOG = structlog.get_logger()
+
+# Number of duplicate groups per Parquet row group.
+PARQUET_BATCH_SIZE = 10000
+
+# Rows to sort in memory before spilling a sorted run to disk.
+SORT_BUFFER_ROWS = 500000
+# Rows per pickle in a spilled run.
+_SPILL_CHUNK_ROWS = 1000
+
+
+class DuplicateGroup(NamedTuple):
+    product: str
+    # The unique field values shared by the group, in collection.unique order.
+    values: tuple
+    dataset_ids: List[UUID]
+
 
 def parse_field_expression(md: MetadataType, expression: str):
     parts = expression.split('.')
@@ -36,38 +68,330 @@ def parse_field_expression(md: MetadataType, expression: str):
     return field
 
 
+def write_duplicates(
+        index: Index,
+        collections_: Iterable[collections.Collection],
+        writer: 'DuplicateWriter',
+        solar_day=False,
+        include_archived=False):
+    """
+    Find the duplicates of each collection and hand them to the writer as they are found.
+    """
+    with writer:
+        for collection in collections_:
+            matching_products = list(index.products.search(**collection.query))
+            if not matching_products:
+                continue
+            # Named by their fields, as expressions such as 'lat.begin' name the field they reach.
+            writer.write_header(tuple(parse_field_expression(matching_products[0].metadata_type, f).name
+                                      for f in collection.unique))
+            for group in find_duplicates(index, matching_products, collection.unique,
+                                         solar_day=solar_day, include_archived=include_archived):
+                writer.write(group)
+
+
 def write_duplicates_csv(
         index: Index,
         collections_: Iterable[collections.Collection],
-        out_stream):
-    has_started = False
-    for collection in collections_:
-        matching_products = index.products.search(**collection.query)
-        for product in matching_products:
-            unique_fields = tuple(parse_field_expression(product.metadata_type, f)
-                                  for f in collection.unique)
+        out_stream,
+        solar_day=False,
+        include_archived=False):
+    write_duplicates(index, collections_, CsvDuplicateWriter(out_stream),
+                     solar_day=solar_day, include_archived=include_archived)
+
+
+def find_duplicates(index: Index,
+                    products: Iterable[DatasetType],
+                    unique: Sequence[str],
+                    solar_day=False,
+                    include_archived=False) -> Iterator[DuplicateGroup]:
+    """
+    Find groups of datasets that share all the given unique fields within their product.
 
-            _write_csv(
-                unique_fields,
-                get_dupes(index, unique_fields, product),
-                out_stream,
-                append=has_started
-            )
-            has_started = True
+    Products are read one cursor per metadata type, as the unique field expressions are defined by it.
 
+    :param solar_day: Group the 'time' field by approximate solar day rather than its exact value.
+    :param include_archived: Archived datasets can also be duplicates of an active one (but groups with
+                             no active datasets are not reported).
+    """
+    by_metadata_type: Dict[str, List[DatasetType]] = defaultdict(list)
+    for product in products:
+        by_metadata_type[product.metadata_type.name].append(product)
 
-def get_dupes(index, unique_fields, product):
-    # type: (Index, Iterable[Field], DatasetType) -> Iterable[dict]
-    headers = _get_headers(unique_fields)
+    for products_of_type in by_metadata_type.values():
+        metadata_type = products_of_type[0].metadata_type
+        rows = _stream_rows(index, metadata_type, products_of_type, unique,
+                            solar_day=solar_day, include_archived=include_archived)
+        yield from group_duplicates(rows)
 
-    for group, dataset_refs in index.datasets.search_product_duplicates(product, *unique_fields):
-        values = (product.name,) + group + (len(dataset_refs), list(dataset_refs))
-        yield dict(zip(headers, values))
 
+def group_duplicates(rows: Iterable[Tuple[str, tuple, UUID, Optional[datetime]]],
+                     buffer_rows: int = SORT_BUFFER_ROWS) -> Iterator[DuplicateGroup]:
+    """
+    Group (product, values, dataset_id, archived) rows, yielding those that share their product and values.
+
+    The rows are sorted by key with an external merge sort: up to `buffer_rows` are sorted in memory at a
+    time, and spilled to a temporary file when there are more. Groups are then yielded as the sorted runs
+    are merged, in key order.
+
+    >>> a, b, c = UUID(int=1), UUID(int=2), UUID(int=3)
+    >>> archived = datetime(2017, 1, 1)
+    >>> rows = [
+    ...     ('ls8_level1_scene', (114, 80), b, None),
+    ...     ('ls8_level1_scene', (114, 81), c, None),
+    ...     ('ls8_level1_scene', (114, None), b, None),
+    ...     ('ls8_level1_scene', (114, 80), a, archived),
+    ...     ('ls7_level1_scene', (114, 80), c, None),
+    ...     ('ls8_level1_scene', (114, None), c, None),
+    ... ]
+    >>> [(g.product, g.values, g.dataset_ids == [b, c]) for g in group_duplicates(rows)]
+    [('ls8_level1_scene', (114, None), True), ('ls8_level1_scene', (114, 80), False)]
+    >>> # The same, when spilled to disk in runs of two rows.
+    >>> [(g.product, g.values) for g in group_duplicates(rows, buffer_rows=2)]
+    [('ls8_level1_scene', (114, None)), ('ls8_level1_scene', (114, 80))]
+    >>> # A group that has already been fully archived is not a problem.
+    >>> list(group_duplicates([
+    ...     ('ls8_level1_scene', (114, 80), a, archived),
+    ...     ('ls8_level1_scene', (114, 80), b, archived),
+    ... ]))
+    []
+    """
+    with ExitStack() as spill_files:
+        runs = []
+        buffer = []
+        for product, values, dataset_id, archived in rows:
+            buffer.append(((product, _sortable(values)), values, dataset_id, archived))
+            if len(buffer) >= buffer_rows:
+                runs.append(_spill_run(spill_files.enter_context(tempfile.TemporaryFile()), buffer))
+                buffer = []
+        buffer.sort(key=_row_key)
+        sorted_rows = heapq.merge(buffer, *runs, key=_row_key) if runs else iter(buffer)
+
+        for (product, _), members in itertools.groupby(sorted_rows, key=_row_key):
+            members = list(members)
+            dataset_ids = {dataset_id for _, _, dataset_id, _ in members}
+            if len(dataset_ids) < 2 or all(archived is not None for _, _, _, archived in members):
+                continue
+            yield DuplicateGroup(product, members[0][1], sorted(dataset_ids, key=str))
+
+
+def _row_key(row):
+    return row[0]
+
+
+def _sortable(values: tuple) -> tuple:
+    """
+    A key for the values that always compares: None sorts first, and ranges by their bounds.
+    """
+    return tuple(_sortable_value(v) for v in values)
 
-def _get_headers(unique_fields):
-    # type: (Iterable[Field]) -> Iterable[str]
-    return ('product',) + tuple(f.name for f in unique_fields) + ('count', 'dataset_refs',)
+
+def _sortable_value(val):
+    if val is None:
+        return (0,)
+    if isinstance(val, Range):
+        return (1, _sortable_value(val.lower), _sortable_value(val.upper), val._bounds or '')
+    return (2, type(val).__name__, val)
+
+
+def _spill_run(spill_file, buffer: list) -> Iterator[tuple]:
+    """
+    Write the buffer to the file as a sorted run, returning an iterator to read it back.
+    """
+    buffer.sort(key=_row_key)
+    for i in range(0, len(buffer), _SPILL_CHUNK_ROWS):
+        pickle.dump(buffer[i:i + _SPILL_CHUNK_ROWS], spill_file, protocol=pickle.HIGHEST_PROTOCOL)
+    spill_file.seek(0)
+    return _read_run(spill_file, len(buffer))
+
+
+def _read_run(spill_file, row_count: int) -> Iterator[tuple]:
+    while row_count > 0:
+        chunk = pickle.load(spill_file)
+        row_count -= len(chunk)
+        yield from chunk
+
+
+def solar_date(time: datetime, longitude: Optional[float]) -> date:
+    """
+    The approximate solar day of a time at the given longitude (15 degrees per hour from UTC).
+
+    >>> solar_date(datetime(2016, 9, 26, 23, 30, tzinfo=tz.tzutc()), 150.2)
+    datetime.date(2016, 9, 27)
+    >>> solar_date(datetime(2016, 9, 26, 23, 30), None)
+    datetime.date(2016, 9, 26)
+    """
+    time = _assume_utc(time)
+    if longitude is not None:
+        time += timedelta(hours=longitude / 15)
+    return time.date()
+
+
+def _range_centre(val) -> Optional[float]:
+    """
+    >>> from psycopg2.extras import NumericRange
+    >>> _range_centre(NumericRange(148.0, 150.0))
+    149.0
+    >>> _range_centre(None)
+    """
+    if val is None or val.lower is None or val.upper is None:
+        return None
+    return (float(val.lower) + float(val.upper)) / 2
+
+
+# TODO: expand api to support this?
+# pylint: disable=protected-access
+def _stream_rows(index: Index,
+                 metadata_type: MetadataType,
+                 products: Sequence[DatasetType],
+                 unique: Sequence[str],
+                 solar_day=False,
+                 include_archived=False) -> Iterator[Tuple[str, tuple, UUID, Optional[datetime]]]:
+    """
+    Read (product name, unique values, id, archived) for every dataset of the products.
+    """
+    unique_fields = tuple(parse_field_expression(metadata_type, f) for f in unique)
+    product_names = {p.id: p.name for p in products}
+
+    time_position = None
+    lon_field = None
+    if solar_day and 'time' in unique:
+        time_position = unique.index('time')
+        lon_field = metadata_type.dataset_fields.get('lon')
+        if lon_field is None:
+            _LOG.warning('solar_day.no_longitude', metadata_type=metadata_type.name)
+
+    select_fields = unique_fields + ((lon_field,) if lon_field is not None else ())
+    conditions = [pgapi.DATASET.c.dataset_type_ref.in_(list(product_names))]
+    if not include_archived:
+        conditions.append(pgapi.DATASET.c.archived == None)  # noqa: E711
+
+    columns = [pgapi.DATASET.c.dataset_type_ref, pgapi.DATASET.c.id, pgapi.DATASET.c.archived]
+    columns.extend(f.alchemy_expression for f in select_fields)
+    query = select(
+        columns
+    ).select_from(
+        pgapi.PostgresDbAPI._from_expression(pgapi.DATASET, fields=select_fields)
+    ).where(
+        and_(*conditions)
+    ).execution_options(
+        stream_results=True
+    )
+
+    count = 0
+    # Server-side (named) cursors need a transaction.
+    with index.datasets._db.begin() as db:
+        for type_ref, dataset_id, archived, *values in db._connection.execute(query):
+            count += 1
+            if time_position is not None:
+                longitude = _range_centre(values.pop()) if lon_field is not None else None
+                values[time_position] = solar_date(_range_start(values[time_position]), longitude)
+            yield product_names[type_ref], tuple(values), dataset_id, archived
+
+    _LOG.info('duplicates.scanned',
+              metadata_type=metadata_type.name,
+              products=sorted(product_names.values()),
+              dataset_count=count)
+
+
+def _range_start(val):
+    if isinstance(val, Range):
+        return val.upper if val.lower_inf else val.lower
+    return val
+
+
+class DuplicateWriter:
+    def write_header(self, unique: Sequence[str]):
+        """The names of the unique fields of the groups that follow."""
+
+    def write(self, group: DuplicateGroup):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class CsvDuplicateWriter(DuplicateWriter):
+    """
+    One row per duplicate group: the product, its unique field values, the count and space-separated ids.
+
+    The header is taken from the first collection written.
+    """
+
+    def __init__(self, out_stream) -> None:
+        self._stream = out_stream
+        self._writer = csv.writer(out_stream)
+        self._has_header = False
+
+    def write_header(self, unique: Sequence[str]):
+        if not self._has_header:
+            self._writer.writerow(('product',) + tuple(unique) + ('count', 'dataset_refs'))
+            self._has_header = True
+
+    def write(self, group: DuplicateGroup):
+        self._writer.writerow(
+            (group.product, *(printable(v) for v in group.values), len(group.dataset_ids), printable(group.dataset_ids))
+        )
+
+    def close(self):
+        self._stream.flush()
+
+
+class ParquetDuplicateWriter(DuplicateWriter):
+    """
+    Write duplicate groups to a Parquet file, one row group per batch.
+
+    Collections have differing unique fields, so the values are stored as a field-name map.
+    """
+
+    def __init__(self, path: Path, batch_size: int = PARQUET_BATCH_SIZE) -> None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise click.UsageError('Writing Parquet requires the pyarrow package')
+
+        self._pa = pyarrow
+        self._schema = pyarrow.schema([
+            ('product', pyarrow.string()),
+            ('values', pyarrow.map_(pyarrow.string(), pyarrow.string())),
+            ('count', pyarrow.int64()),
+            ('dataset_refs', pyarrow.list_(pyarrow.string())),
+        ])
+        self._writer = pyarrow.parquet.ParquetWriter(str(path), self._schema)
+        self._batch_size = batch_size
+        self._unique: Sequence[str] = ()
+        self._batch: List[DuplicateGroup] = []
+
+    def write_header(self, unique: Sequence[str]):
+        self._flush()
+        self._unique = tuple(unique)
+
+    def write(self, group: DuplicateGroup):
+        self._batch.append(group)
+        if len(self._batch) >= self._batch_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._batch:
+            return
+        self._writer.write_table(self._pa.Table.from_pydict({
+            'product': [g.product for g in self._batch],
+            'values': [[(k, str(printable(v))) for k, v in zip(self._unique, g.values)] for g in self._batch],
+            'count': [len(g.dataset_ids) for g in self._batch],
+            'dataset_refs': [[str(id_) for id_ in g.dataset_ids] for g in self._batch],
+        }, schema=self._schema))
+        self._batch = []
+
+    def close(self):
+        self._flush()
+        self._writer.close()
 
 
 @singledispatch
@@ -100,12 +424,7 @@ def printable_r(val):
     """
     :type val: psycopg2._range.Range
     """
-    if val.lower_inf:
-        return printable(val.upper)
-    if val.upper_inf:
-        return printable(val.lower)
-
-    return printable(val.lower)
+    return printable(_range_start(val))
 
 
 @printable.register(list)
@@ -125,27 +444,21 @@ def printable_uuid(val):
     return str(val)
 
 
-def _write_csv(unique_fields, dicts, stream, append=False):
-    writer = csv.DictWriter(stream, _get_headers(unique_fields))
-    if not append:
-        writer.writeheader()
-    writer.writerows(
-        (
-            {k: printable(v) for k, v in d.items()}
-            for d in dicts
-        )
-    )
-
-
 collections.init_nci_collections(None)
 
 
 @click.command('duplicates')
 @global_cli_options
 @click.option('-a', '--all_', is_flag=True)
+@click.option('--solar-day', is_flag=True, default=False,
+              help="Group the 'time' field by approximate solar day (from the dataset's longitude)")
+@click.option('--include-archived', is_flag=True, default=False,
+              help="Also report archived datasets that duplicate an active one")
+@click.option('-o', '--output', type=click.Path(dir_okay=False, writable=True),
+              help="Write to this file rather than stdout. A .parquet suffix writes Parquet (requires pyarrow)")
 @click.argument('collections_', type=click.Choice(collections.registered_collection_names()), nargs=-1)
 @pass_index(app_name="find-duplicates")
-def cli(index, all_, collections_):
+def cli(index, all_, solar_day, include_archived, output, collections_):
     """
     Find duplicate datasets for a collection.
 
@@ -155,7 +468,7 @@ def cli(index, all_, collections_):
 
     Note that this is really a prototype: it won't report all duplicates as the unique fields aren't good enough.
 
-      - Scenes group by "day" not "solar day"
+      - Scenes group by exact time unless --solar-day is given
 
       - Tiled products should be grouped by tile_index, but it's not in the metadata.
 
@@ -167,11 +480,15 @@ def cli(index, all_, collections_):
     else:
         collection_names = collections_
 
-    write_duplicates_csv(
-        index,
-        [collections.get_collection(name) for name in collection_names],
-        sys.stdout
-    )
+    collections_ = [collections.get_collection(name) for name in collection_names]
+
+    if output and output.endswith('.parquet'):
+        write_duplicates(index, collections_, ParquetDuplicateWriter(Path(output)),
+                         solar_day=solar_day, include_archived=include_archived)
+    else:
+        with click.open_file(output or '-', 'w') as out_stream:
+            write_duplicates_csv(index, collections_, out_stream,
+                                 solar_day=solar_day, include_archived=include_archived)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,187 @@
+"""
+Estimate the PBS resources for a job from how long its kind of task took in earlier runs.
+
+Earlier runs are found in the product work directories (see `paths.get_product_work_directory()`):
+each has an events folder of the task events (JSON-Lines) recorded while it ran.
+"""
+import json
+import logging
+from collections import defaultdict
+from math import ceil
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+import dateutil.parser
+import numpy
+
+from digitalearthau import paths
+from digitalearthau.qsub import NUM_CPUS_PER_NODE
+
+_LOG = logging.getLogger(__name__)
+
+# Used when there's no history for a task type.
+DEFAULT_TASK_SECONDS = 10 * 60
+
+# Headroom over the estimate, as runtimes vary between runs and nodes.
+WALLTIME_PADDING = 1.25
+MIN_WALLTIME_SECONDS = 10 * 60
+# The longest walltime allowed on Gadi's normal queue.
+MAX_WALLTIME_SECONDS = 48 * 60 * 60
+
+# How many earlier runs to learn from.
+DEFAULT_HISTORY_RUNS = 10
+
+
+class TaskCostModel(NamedTuple):
+    """
+    How long one task of a type takes.
+    """
+    task_type: str
+    # How many finished tasks this was measured from. (0 for the default)
+    sample_count: int
+    median_seconds: float
+    # The slow end: a job's last tasks to finish decide its walltime.
+    p95_seconds: float
+
+    @classmethod
+    def default(cls, task_type: str) -> 'TaskCostModel':
+        return TaskCostModel(task_type, 0, DEFAULT_TASK_SECONDS, DEFAULT_TASK_SECONDS)
+
+
+class JobEstimate(NamedTuple):
+    nodes: int
+    # As understood by `qsub.norm_qsub_params()`, eg. '95m'
+    walltime: str
+    # Predicted runtime, before padding.
+    expected_seconds: float
+
+
+def task_durations(events_paths: Iterable[Path]) -> Dict[str, List[float]]:
+    """
+    The seconds from active to complete for every completed task in the events folders, by task name.
+
+    Failed tasks aren't counted.
+    """
+    started = {}
+    durations = defaultdict(list)  # type: Dict[str, List[float]]
+    for events_path in events_paths:
+        for jsonl_path in sorted(events_path.glob('*.jsonl')):
+            with jsonl_path.open('r') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    event = json.loads(line)
+                    status = event.get('status')
+                    if status == 'active':
+                        started[event['id']] = dateutil.parser.parse(event['timestamp'])
+                    elif status == 'complete' and event['id'] in started:
+                        finished = dateutil.parser.parse(event['timestamp'])
+                        durations[event['name']].append((finished - started.pop(event['id'])).total_seconds())
+    return durations
+
+
+def history_events_paths(output_product: str, task_type: str, limit: int = DEFAULT_HISTORY_RUNS) -> List[Path]:
+    """
+    The events folders of the most recent runs of a task type for a product.
+    """
+    # Work directories are named by time, so they sort chronologically. (see paths._JOB_WORK_OFFSET)
+    type_path = paths.NCI_WORK_ROOT.joinpath(output_product, task_type)
+    if not type_path.exists():
+        return []
+    events_paths = sorted(p for p in type_path.glob('*/*/events') if p.is_dir())
+    return events_paths[-limit:]
+
+
+def fit_cost_model(task_type: str, durations: List[float]) -> TaskCostModel:
+    """
+    >>> fit_cost_model('stack', [60.0] * 10 + [120.0] * 10)
+    TaskCostModel(task_type='stack', sample_count=20, median_seconds=90.0, p95_seconds=120.0)
+    >>> fit_cost_model('stack', [])
+    TaskCostModel(task_type='stack', sample_count=0, median_seconds=600, p95_seconds=600)
+    """
+    if not durations:
+        return TaskCostModel.default(task_type)
+
+    median, p95 = numpy.percentile(durations, [50, 95])
+    return TaskCostModel(task_type, len(durations), float(median), float(p95))
+
+
+def load_cost_model(output_product: str, task_type: str, limit: int = DEFAULT_HISTORY_RUNS) -> TaskCostModel:
+    """
+    Fit a cost model for a task type from its recent runs on a product.
+    """
+    events_paths = history_events_paths(output_product, task_type, limit=limit)
+    durations = task_durations(events_paths).get(task_type, [])
+    model = fit_cost_model(task_type, durations)
+    _LOG.info('Task cost for %s %s from %d runs: %s', output_product, task_type, len(events_paths), model)
+    return model
+
+
+def estimate_job(model: TaskCostModel,
+                 task_count: int,
+                 max_nodes: int = 5,
+                 cores_per_node: int = NUM_CPUS_PER_NODE,
+                 target_seconds: float = 4 * 60 * 60) -> JobEstimate:
+    """
+    The fewest nodes (up to max_nodes) that finish the tasks within the target time, and the walltime they need.
+
+    Tasks run one per core, in "waves".
+
+    >>> model = TaskCostModel('stack', 100, median_seconds=300, p95_seconds=480)
+    >>> estimate_job(model, 100)
+    JobEstimate(nodes=1, walltime='23m', expected_seconds=1080.0)
+    >>> estimate_job(model, 5000)
+    JobEstimate(nodes=3, walltime='223m', expected_seconds=10680.0)
+    >>> # Never more nodes than there are tasks to fill them.
+    >>> estimate_job(model, 5000, target_seconds=60).nodes
+    5
+    """
+    max_nodes = max(1, min(max_nodes, ceil(task_count / cores_per_node)))
+
+    def runtime(nodes):
+        waves = ceil(task_count / (nodes * cores_per_node))
+        # The last wave is as slow as the slowest tasks.
+        return (waves - 1) * model.median_seconds + model.p95_seconds
+
+    nodes = next((n for n in range(1, max_nodes + 1) if runtime(n) <= target_seconds), max_nodes)
+    expected_seconds = runtime(nodes)
+    return JobEstimate(
+        nodes=nodes,
+        walltime='{}m'.format(ceil(padded_walltime_seconds(expected_seconds) / 60)),
+        expected_seconds=float(expected_seconds),
+    )
+
+
+def padded_walltime_seconds(expected_seconds: float) -> int:
+    """
+    >>> padded_walltime_seconds(3600)
+    4500
+    >>> padded_walltime_seconds(1)
+    600
+    """
+    return int(min(MAX_WALLTIME_SECONDS, max(MIN_WALLTIME_SECONDS, ceil(expected_seconds * WALLTIME_PADDING))))
+
+
+def format_walltime(seconds: float) -> str:
+    """
+    A PBS walltime, as given to "qsub -l walltime=".
+
+    >>> format_walltime(4500)
+    '1:15:00'
+    """
+    seconds = int(seconds)
+    return '{}:{:02}:{:02}'.format(seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+
+def suggest_walltime(expected_seconds: Optional[float], default: str) -> str:
+    """
+    A padded walltime for the expected runtime, or the default if it's unknown.
+
+    >>> suggest_walltime(3600, default='20:00:00')
+    '1:15:00'
+    >>> suggest_walltime(None, default='20:00:00')
+    '20:00:00'
+    """
+    if expected_seconds is None:
+        return default
+    return format_walltime(padded_walltime_seconds(expected_seconds))
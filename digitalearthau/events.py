@@ -70,6 +70,24 @@ class Status(Enum):
     CANCELLED = 7
 
 
+class TaskResources(NamedTuple):
+    """
+    How long a task took to run, and what it used, as measured by the worker that ran it.
+    """
+    # When the task was sent to the workers (by the clock of the submitting node), if known
+    submitted: Optional[datetime.datetime]
+    started: datetime.datetime
+    finished: datetime.datetime
+
+    # Peak resident memory of the worker process while running the task
+    peak_rss_bytes: Optional[int] = None
+
+    # Bytes read and written by the worker process while running the task, including over the network.
+    # (As counted by Linux: None elsewhere)
+    read_bytes: Optional[int] = None
+    write_bytes: Optional[int] = None
+
+
 class TaskEvent(NamedTuple):
     ################
     # Base fields (common to all events)
@@ -121,3 +139,6 @@ class TaskEvent(NamedTuple):
     # The parent of this task
     # If we're running in a pbs job, the default will set the pbs job as the parent.
     parent_id: uuid.UUID = pbs.current_job_task_id()
+
+    # The time and resources the task used, if measured. (see qsub.MeasuredTask)
+    resources: Optional[TaskResources] = None
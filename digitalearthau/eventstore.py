@@ -0,0 +1,566 @@
+"""
+Query the task events of a run: which tasks failed, how long tasks took on each node.
+
+Task events are appended to JSON-Lines files in a run's events folder (see `TaskDescription.events_path`),
+one file per collecting host. Rather than re-reading them all for every question, they're ingested into
+an SQLite database beside them, with a row per event and a summary row per task, indexed by task id,
+status and time.
+
+Tasks measured by their workers (with the run option --measure-tasks) are summarised separately, by
+the `resources` command: their times, peak memory and bytes read and written, by node.
+
+Ingesting is incremental: each file is read on from where the last ingest stopped, so a running job's
+events can be queried repeatedly. Every query command ingests any new events first.
+"""
+import datetime
+import json
+import logging
+import sqlite3
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import click
+from boltons.iterutils import chunked
+from dateutil import tz
+
+from digitalearthau import serialise
+
+_LOG = logging.getLogger(__name__)
+
+# Created in the events folder, unless told otherwise.
+DEFAULT_STORE_NAME = 'events.sqlite'
+
+# Events per transaction while ingesting.
+INGEST_BATCH_SIZE = 10000
+
+# The statuses (as serialised) that end a task.
+FINISHED_STATUSES = ('complete', 'failed', 'cancelled')
+
+_SCHEMA = """
+create table if not exists event (
+    task_id text not null,
+    timestamp real not null,
+    status text not null,
+    event text not null,
+    hostname text,
+    pid integer,
+    message text,
+    -- Comma-separated dataset ids
+    input_datasets text
+);
+create index if not exists event_task_id on event (task_id, timestamp);
+create index if not exists event_timestamp on event (timestamp);
+
+-- The latest state of each task.
+create table if not exists task (
+    id text primary key,
+    name text,
+    status text not null,
+    -- When the latest event was sent
+    updated real not null,
+    -- First went active
+    started real,
+    finished real,
+    -- Where it last ran
+    hostname text,
+    message text
+);
+-- Covering the status counts and the durations by node.
+create index if not exists task_status on task (status, hostname, started, finished);
+create index if not exists task_duration on task (status, finished - started);
+create index if not exists task_updated on task (status, updated);
+
+-- Tasks measured by their workers (see qsub.MeasuredTask). They're kept apart from the tasks above, as
+-- they're recorded under their own ids, alongside the runner's events for the same tasks.
+create table if not exists measurement (
+    id text primary key,
+    name text,
+    status text not null,
+    hostname text,
+    -- The task, as logged
+    description text,
+    submitted real,
+    started real not null,
+    finished real not null,
+    peak_rss_bytes integer,
+    read_bytes integer,
+    write_bytes integer
+);
+create index if not exists measurement_hostname on measurement (hostname);
+create index if not exists measurement_duration on measurement (finished - started);
+
+-- How far each events file has been ingested.
+create table if not exists ingested_file (
+    name text primary key,
+    offset integer not null
+);
+"""
+
+# How many tasks to look up at once when merging a batch into the task table (under SQLite's 999 variables)
+_TASK_LOOKUP_CHUNK = 500
+
+
+class TaskSummary(NamedTuple):
+    id: str
+    name: Optional[str]
+    status: str
+    updated: datetime.datetime
+    started: Optional[datetime.datetime]
+    finished: Optional[datetime.datetime]
+    hostname: Optional[str]
+    message: Optional[str]
+
+    @property
+    def duration_seconds(self) -> Optional[float]:
+        if self.started is None or self.finished is None:
+            return None
+        return (self.finished - self.started).total_seconds()
+
+
+class NodeResources(NamedTuple):
+    hostname: str
+    task_count: int
+    mean_seconds: float
+    # From submission until a worker started the task
+    mean_wait_seconds: Optional[float]
+    max_peak_rss_bytes: Optional[int]
+    read_bytes: Optional[int]
+    write_bytes: Optional[int]
+
+
+class MeasuredTaskSummary(NamedTuple):
+    id: str
+    status: str
+    hostname: Optional[str]
+    description: Optional[str]
+    seconds: float
+    peak_rss_bytes: Optional[int]
+    read_bytes: Optional[int]
+    write_bytes: Optional[int]
+
+
+class DurationSummary(NamedTuple):
+    # The hostname or task name grouped by
+    group: str
+    task_count: int
+    mean_seconds: float
+    max_seconds: float
+    total_seconds: float
+
+
+def _timestamp(value: str) -> float:
+    """
+    >>> _timestamp('2017-10-05T22:11:45.717952+00:00')
+    1507241505.717952
+    >>> _timestamp('2017-10-05T22:11:45.717952')
+    1507241505.717952
+    """
+    dt = serialise.dict_to_type(value, datetime.datetime)
+    if dt.tzinfo is None:
+        # Events are recorded in UTC.
+        dt = dt.replace(tzinfo=tz.tzutc())
+    return dt.timestamp()
+
+
+def _datetime(timestamp: Optional[float]) -> Optional[datetime.datetime]:
+    if timestamp is None:
+        return None
+    return datetime.datetime.fromtimestamp(timestamp, tz=tz.tzutc())
+
+
+def _event_rows(event: dict) -> Tuple[tuple, tuple]:
+    """
+    The event row, and the task row to merge, for a task event as serialised.
+    """
+    timestamp = _timestamp(event['timestamp'])
+    status = event['status']
+    node = event.get('node') or {}
+    hostname = node.get('hostname')
+    message = event.get('message')
+    input_datasets = event.get('input_datasets')
+
+    event_row = (
+        event['id'], timestamp, status, event['event'], hostname, node.get('pid'), message,
+        ','.join(input_datasets) if input_datasets else None,
+    )
+    task_row = (
+        event['id'], event.get('name'), status, timestamp,
+        timestamp if status == 'active' else None,
+        timestamp if status in FINISHED_STATUSES else None,
+        hostname, message,
+    )
+    return event_row, task_row
+
+
+def _measurement_row(event: dict) -> tuple:
+    """
+    The measurement row for a task event with resources, as serialised.
+    """
+    resources = event['resources']
+    node = event.get('node') or {}
+    return (
+        event['id'], event.get('name'), event['status'], node.get('hostname'), _first_line(event.get('message')),
+        _timestamp(resources['submitted']) if resources.get('submitted') else None,
+        _timestamp(resources['started']),
+        _timestamp(resources['finished']),
+        resources.get('peak_rss_bytes'), resources.get('read_bytes'), resources.get('write_bytes'),
+    )
+
+
+def _merge_task_rows(old: tuple, new: tuple) -> tuple:
+    """
+    Merge two task rows: keep the newest status and node of the task, and its first start and last finish.
+    """
+    id_, name, status, updated, started, finished, hostname, message = old
+    _, new_name, new_status, new_updated, new_started, new_finished, new_hostname, new_message = new
+    if new_updated >= updated:
+        status, hostname, message = new_status, new_hostname or hostname, new_message
+    starts = [t for t in (started, new_started) if t is not None]
+    finishes = [t for t in (finished, new_finished) if t is not None]
+    return (
+        id_,
+        new_name or name,
+        status,
+        max(updated, new_updated),
+        min(starts) if starts else None,
+        max(finishes) if finishes else None,
+        hostname,
+        message,
+    )
+
+
+def _read_new_lines(path: Path, offset: int) -> Iterable[Tuple[bytes, int]]:
+    """
+    Each complete line after the offset, with the offset after it.
+
+    A line still being written (without its newline) is left for the next ingest.
+    """
+    with path.open('rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                return
+            offset += len(line)
+            yield line, offset
+
+
+class EventStore:
+    """
+    The task events of a run, in an SQLite database.
+    """
+
+    def __init__(self, db_path: Path) -> None:
+        self.db_path = db_path
+        self._db = sqlite3.connect(str(db_path))
+        self._db.executescript(_SCHEMA)
+
+    @classmethod
+    def for_events_path(cls, events_path: Path, db_path: Path = None) -> 'EventStore':
+        return cls(db_path or events_path.joinpath(DEFAULT_STORE_NAME))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def ingest(self, events_path: Path) -> int:
+        """
+        Ingest any events added to the folder's JSON-Lines files since the last ingest.
+
+        :returns: how many events were added.
+        """
+        total = 0
+        for jsonl_path in sorted(events_path.glob('*.jsonl')):
+            total += self.ingest_file(jsonl_path)
+        return total
+
+    def ingest_file(self, path: Path) -> int:
+        """
+        Ingest the new events of one file of the events folder. (files are tracked by name)
+        """
+        row = self._db.execute('select offset from ingested_file where name = ?', (path.name,)).fetchone()
+        offset = row[0] if row else 0
+        if path.stat().st_size <= offset:
+            return 0
+
+        count = 0
+        events = []
+        tasks = {}  # type: Dict[str, tuple]
+        measurements = []
+
+        def write_batch():
+            # Events and the file offset they reach are committed together, so an interrupted
+            # ingest is picked up again without duplicates.
+            with self._db:
+                self._db.executemany('insert into event values (?, ?, ?, ?, ?, ?, ?, ?)', events)
+                self._write_tasks(tasks)
+                self._db.executemany('insert or replace into measurement values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                     measurements)
+                self._db.execute('insert or replace into ingested_file values (?, ?)', (path.name, offset))
+            events.clear()
+            tasks.clear()
+            measurements.clear()
+
+        for line, next_offset in _read_new_lines(path, offset):
+            offset = next_offset
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if 'status' not in event:
+                # Not a task event.
+                continue
+            count += 1
+            if event.get('resources'):
+                measurements.append(_measurement_row(event))
+            else:
+                event_row, task_row = _event_rows(event)
+                events.append(event_row)
+                task_id = task_row[0]
+                tasks[task_id] = _merge_task_rows(tasks[task_id], task_row) if task_id in tasks else task_row
+            if len(events) + len(measurements) >= INGEST_BATCH_SIZE:
+                write_batch()
+        write_batch()
+
+        _LOG.debug('Ingested %d events from %s', count, path)
+        return count
+
+    def _write_tasks(self, tasks: Dict[str, tuple]):
+        """
+        Merge the task rows into the task table.
+
+        (In Python rather than with an upsert, which needs SQLite 3.24)
+        """
+        merged = dict(tasks)
+        for ids in chunked(list(tasks), _TASK_LOOKUP_CHUNK):
+            existing = self._db.execute(
+                'select id, name, status, updated, started, finished, hostname, message '
+                'from task where id in ({})'.format(', '.join('?' * len(ids))),
+                ids
+            )
+            for old in existing:
+                merged[old[0]] = _merge_task_rows(old, tasks[old[0]])
+        self._db.executemany('insert or replace into task values (?, ?, ?, ?, ?, ?, ?, ?)', merged.values())
+
+    def status_counts(self) -> Dict[str, int]:
+        return dict(self._db.execute('select status, count(*) from task group by status'))
+
+    def tasks(self, status: str = None, limit: int = None) -> List[TaskSummary]:
+        """
+        The tasks, optionally only those with the given (latest) status, in order of their latest event.
+        """
+        query = 'select id, name, status, updated, started, finished, hostname, message from task'
+        params = []  # type: List
+        if status:
+            query += ' where status = ?'
+            params.append(status)
+        query += ' order by updated'
+        if limit:
+            query += ' limit ?'
+            params.append(limit)
+        return [self._task_summary(row) for row in self._db.execute(query, params)]
+
+    def slowest_tasks(self, limit: int = 10) -> List[TaskSummary]:
+        rows = self._db.execute(
+            'select id, name, status, updated, started, finished, hostname, message from task '
+            'where status = ? and started is not null '
+            'order by finished - started desc limit ?',
+            ('complete', limit)
+        )
+        return [self._task_summary(row) for row in rows]
+
+    def durations(self, by: str = 'hostname') -> List[DurationSummary]:
+        """
+        How long completed tasks took (from going active to completion), grouped by hostname or task name.
+        """
+        if by not in ('hostname', 'name'):
+            raise ValueError(f'Unknown grouping {by!r}: expected hostname or name')
+        rows = self._db.execute(
+            f'select {by}, count(*), avg(finished - started), max(finished - started), sum(finished - started) '
+            f'from task where status = ? and started is not null '
+            f'group by {by} order by {by}',
+            ('complete',)
+        )
+        return [DurationSummary(*row) for row in rows]
+
+    def node_resources(self) -> List[NodeResources]:
+        """
+        The time and resources used by the measured tasks on each node.
+        """
+        rows = self._db.execute(
+            'select hostname, count(*), avg(finished - started), avg(started - submitted), '
+            'max(peak_rss_bytes), sum(read_bytes), sum(write_bytes) '
+            'from measurement group by hostname order by hostname'
+        )
+        return [NodeResources(*row) for row in rows]
+
+    def slowest_measured_tasks(self, limit: int = 10) -> List[MeasuredTaskSummary]:
+        rows = self._db.execute(
+            'select id, status, hostname, description, finished - started, peak_rss_bytes, read_bytes, write_bytes '
+            'from measurement order by finished - started desc limit ?',
+            (limit,)
+        )
+        return [MeasuredTaskSummary(*row) for row in rows]
+
+    def task_events(self, task_id: str) -> List[dict]:
+        rows = self._db.execute(
+            'select timestamp, status, event, hostname, pid, message, input_datasets '
+            'from event where task_id = ? order by timestamp',
+            (task_id,)
+        )
+        return [
+            dict(
+                timestamp=_datetime(timestamp),
+                status=status,
+                event=event,
+                hostname=hostname,
+                pid=pid,
+                message=message,
+                input_datasets=input_datasets.split(',') if input_datasets else None,
+            )
+            for timestamp, status, event, hostname, pid, message, input_datasets in rows
+        ]
+
+    @staticmethod
+    def _task_summary(row: tuple) -> TaskSummary:
+        id_, name, status, updated, started, finished, hostname, message = row
+        return TaskSummary(id_, name, status, _datetime(updated), _datetime(started), _datetime(finished),
+                           hostname, message)
+
+
+def _open_store(events_path: str, db: Optional[str], update: bool = True) -> EventStore:
+    events_path = Path(events_path)
+    store = EventStore.for_events_path(events_path, Path(db) if db else None)
+    if update:
+        count = store.ingest(events_path)
+        _LOG.info('Ingested %d new events', count)
+    return store
+
+
+def _first_line(message: Optional[str]) -> str:
+    """
+    >>> _first_line('Traceback (most recent call last):\\n  File "x.py"')
+    'Traceback (most recent call last):'
+    >>> _first_line(None)
+    ''
+    """
+    return message.strip().splitlines()[0] if message and message.strip() else ''
+
+
+def _format_time(dt: Optional[datetime.datetime]) -> str:
+    return dt.isoformat() if dt else '-'
+
+
+def _store_options(f):
+    f = click.option('--db', type=click.Path(dir_okay=False),
+                     help=f'The store to use (default: {DEFAULT_STORE_NAME} in the events folder)')(f)
+    f = click.argument('events_path', type=click.Path(exists=True, file_okay=False))(f)
+    return f
+
+
+_update_option = click.option('--update/--no-update', default=True,
+                              help='Ingest new events before querying (default), or query the store as is')
+
+
+@click.group(help=__doc__)
+def cli():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+
+@cli.command(help='Ingest new events from the JSON-Lines files of an events folder')
+@_store_options
+def ingest(events_path, db):
+    with _open_store(events_path, db):
+        pass
+
+
+@cli.command(help='Count the tasks in each status')
+@_store_options
+@_update_option
+def status(events_path, db, update):
+    with _open_store(events_path, db, update) as store:
+        for status_, count in sorted(store.status_counts().items()):
+            click.echo(f'{status_}\t{count}')
+
+
+@cli.command(help='List the tasks whose latest status is failed, with the first line of their message')
+@click.option('--limit', type=click.IntRange(1), default=None)
+@_store_options
+@_update_option
+def failed(events_path, db, update, limit):
+    with _open_store(events_path, db, update) as store:
+        for task in store.tasks(status='failed', limit=limit):
+            click.echo(f'{task.id}\t{_format_time(task.updated)}\t{task.hostname}\t{_first_line(task.message)}')
+
+
+@cli.command(help='Summarise how long completed tasks took, by node or by task name')
+@click.option('--by', type=click.Choice(['hostname', 'name']), default='hostname')
+@_store_options
+@_update_option
+def durations(events_path, db, update, by):
+    with _open_store(events_path, db, update) as store:
+        click.echo(f'{by}\ttasks\tmean_seconds\tmax_seconds\ttotal_seconds')
+        for d in store.durations(by=by):
+            click.echo(f'{d.group}\t{d.task_count}\t{d.mean_seconds:.1f}\t{d.max_seconds:.1f}\t{d.total_seconds:.1f}')
+
+
+@cli.command(help='List the slowest completed tasks')
+@click.option('--limit', type=click.IntRange(1), default=10)
+@_store_options
+@_update_option
+def slowest(events_path, db, update, limit):
+    with _open_store(events_path, db, update) as store:
+        for task in store.slowest_tasks(limit=limit):
+            click.echo(f'{task.id}\t{task.duration_seconds:.1f}\t{task.hostname}\t{_format_time(task.started)}')
+
+
+def _format_bytes(value: Optional[int], unit=1024 * 1024) -> str:
+    """
+    In MiB by default.
+
+    >>> _format_bytes(3 * 1024 * 1024)
+    '3.0'
+    >>> _format_bytes(None)
+    '-'
+    """
+    return '-' if value is None else f'{value / unit:.1f}'
+
+
+@cli.command(help='Summarise the time and resources of measured tasks by node (see run options --measure-tasks)')
+@click.option('--slowest', type=click.IntRange(1), default=None,
+              help='List this many of the slowest tasks instead, with their descriptions (eg. tile index)')
+@_store_options
+@_update_option
+def resources(events_path, db, update, slowest):
+    with _open_store(events_path, db, update) as store:
+        if slowest:
+            click.echo('id\tstatus\thostname\tseconds\tpeak_rss_mib\tread_mib\twrite_mib\tdescription')
+            for t in store.slowest_measured_tasks(limit=slowest):
+                click.echo(f'{t.id}\t{t.status}\t{t.hostname}\t{t.seconds:.1f}\t{_format_bytes(t.peak_rss_bytes)}\t'
+                           f'{_format_bytes(t.read_bytes)}\t{_format_bytes(t.write_bytes)}\t{t.description}')
+            return
+
+        click.echo('hostname\ttasks\tmean_seconds\tmean_wait_seconds\tmax_peak_rss_mib\tread_mib\twrite_mib')
+        for n in store.node_resources():
+            wait = '-' if n.mean_wait_seconds is None else f'{n.mean_wait_seconds:.1f}'
+            click.echo(f'{n.hostname}\t{n.task_count}\t{n.mean_seconds:.1f}\t{wait}\t'
+                       f'{_format_bytes(n.max_peak_rss_bytes)}\t{_format_bytes(n.read_bytes)}\t'
+                       f'{_format_bytes(n.write_bytes)}')
+
+
+@cli.command(help='Show every event of a task')
+@click.argument('task_id')
+@_store_options
+@_update_option
+def show(task_id, events_path, db, update):
+    with _open_store(events_path, db, update) as store:
+        for event in store.task_events(task_id):
+            click.echo(f"{_format_time(event['timestamp'])}\t{event['status']}\t{event['hostname']}\t"
+                       f"{_first_line(event['message'])}")
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,10 +1,16 @@
 import uuid
+import numpy
 import structlog
+from boltons.iterutils import chunked, chunked_iter
+from dateutil import tz
+from psycopg2.extras import Range as PgRange
 
 from datetime import datetime
-from typing import Iterable
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Sequence, Set, Tuple
+from sqlalchemy import and_, select
+from datacube.drivers.postgres import _api as pgapi
 from datacube.index import Index
-from datacube.model import Dataset
+from datacube.model import Dataset, Range
 from datacube.utils import uri_to_local_path
 from digitalearthau.utils import simple_object_repr
 from datacube.ui.common import ui_path_doc_stream
@@ -12,6 +18,12 @@ from datacube.index.hl import Doc2Dataset, check_dataset_consistent
 
 _LOG = structlog.getLogger('dea-dataset')
 
+# How many datasets to archive in each index transaction.
+DEFAULT_ARCHIVE_CHUNK_SIZE = 500
+
+# How many rows to put in each array from search_arrays()
+DEFAULT_ROW_BATCH_SIZE = 10000
+
 
 class DatasetLite:
     """
@@ -61,6 +73,135 @@ class DatasetLite:
         return simple_object_repr(self)
 
 
+def search_rows(index: Index, field_names: Sequence[str], batch_size: int = None, **query) -> Iterator:
+    """
+    Stream only the given fields of the matching datasets, as named tuples.
+
+    This skips building full Dataset objects (and their metadata documents) when a tool only needs a few fields.
+    Requesting 'uri' returns one row per location.
+
+    If a batch size is given, lists of up to that many rows are yielded instead.
+    """
+    rows = index.datasets.search_returning(list(field_names), **query)
+    if batch_size is None:
+        return rows
+    return chunked_iter(rows, batch_size)
+
+
+# pylint: disable=protected-access
+def local_uris(index: Index, dataset_ids: Iterable[uuid.UUID]) -> Dict[uuid.UUID, str]:
+    """
+    The newest active file location of each dataset (as Dataset.local_uri), in one query.
+
+    Datasets without one are left out.
+    """
+    location = pgapi.DATASET_LOCATION
+    query = select(
+        [location.c.dataset_ref, pgapi._dataset_uri_field(location)]
+    ).where(
+        and_(
+            location.c.dataset_ref.in_(list(dataset_ids)),
+            location.c.archived == None,  # noqa: E711
+            location.c.uri_scheme == 'file',
+        )
+    ).order_by(
+        location.c.dataset_ref, location.c.added.desc(), location.c.id.desc()
+    )
+
+    uris = {}
+    with index.datasets._db.connect() as db:
+        for dataset_id, uri in db._connection.execute(query):
+            uris.setdefault(dataset_id, uri)
+    return uris
+
+
+def search_arrays(index: Index,
+                  fields: Sequence[Tuple[str, str]],
+                  batch_size: int = DEFAULT_ROW_BATCH_SIZE,
+                  **query) -> Iterator[numpy.ndarray]:
+    """
+    Stream the given fields of the matching datasets as numpy structured arrays of up to batch_size rows.
+
+    :param fields: (field name, numpy dtype) pairs. A range field is reduced to its start, unless the name asks
+                   for one end of it, such as 'lat.end'. The array column is named with an underscore ('lat_end').
+    """
+    row_fields = _row_fields(fields)
+    dtype = _array_dtype(fields)
+
+    for batch in search_rows(index, row_fields, batch_size=batch_size, **query):
+        yield rows_to_array(batch, fields, dtype=dtype, row_fields=row_fields)
+
+
+def rows_to_array(rows: Sequence[tuple],
+                  fields: Sequence[Tuple[str, str]],
+                  dtype: numpy.dtype = None,
+                  row_fields: Sequence[str] = None) -> numpy.ndarray:
+    """
+    Convert search rows to a structured array.
+
+    :param row_fields: The field of each column of the rows (by default, the fields in the order given)
+
+    >>> from psycopg2.extras import DateTimeRange, NumericRange
+    >>> time = DateTimeRange(datetime(2016, 9, 26, 2, 16), datetime(2016, 9, 26, 2, 17))
+    >>> a = rows_to_array([(time, NumericRange(-12.5, -10.5), 114)],
+    ...                   [('time', 'datetime64[s]'), ('time.end', 'datetime64[s]'),
+    ...                    ('lat.end', 'f8'), ('sat_path', 'i4')])
+    >>> str(a['time'][0]), str(a['time_end'][0]), float(a['lat_end'][0]), int(a['sat_path'][0])
+    ('2016-09-26T02:16:00', '2016-09-26T02:17:00', -10.5, 114)
+    """
+    if dtype is None:
+        dtype = _array_dtype(fields)
+    if row_fields is None:
+        row_fields = _row_fields(fields)
+
+    columns = dict(zip(row_fields, zip(*rows))) if rows else {}
+
+    array = numpy.empty(len(rows), dtype=dtype)
+    for (name, _), column_name in zip(fields, dtype.names):
+        field, _, end = name.partition('.')
+        values = [_range_value(v, end) for v in columns.get(field, ())]
+        if dtype[column_name].kind == 'M':
+            values = [_as_naive_utc(v) for v in values]
+        array[column_name] = values
+    return array
+
+
+def _row_fields(fields: Sequence[Tuple[str, str]]) -> List[str]:
+    """
+    The distinct index fields needed for the array fields.
+
+    >>> _row_fields([('time', 'M8[s]'), ('time.end', 'M8[s]'), ('lat.begin', 'f8')])
+    ['time', 'lat']
+    """
+    names = []
+    for name, _ in fields:
+        field = name.split('.')[0]
+        if field not in names:
+            names.append(field)
+    return names
+
+
+def _array_dtype(fields: Sequence[Tuple[str, str]]) -> numpy.dtype:
+    return numpy.dtype([(name.replace('.', '_'), type_) for name, type_ in fields])
+
+
+def _range_value(value, end: str):
+    # Both psycopg2 ranges (lower/upper) and datacube.model.Range (begin/end)
+    if isinstance(value, PgRange):
+        return value.upper if end == 'end' else value.lower
+    if isinstance(value, Range):
+        return value.end if end == 'end' else value.begin
+    return value
+
+
+def _as_naive_utc(value):
+    if value is None:
+        return numpy.datetime64('NaT')
+    if value.tzinfo is not None:
+        value = value.astimezone(tz.tzutc()).replace(tzinfo=None)
+    return value
+
+
 def add_dataset(index: Index, dataset_id: uuid.UUID, uri: str):
     """
     Index a dataset from a file uri.
@@ -104,3 +245,104 @@ def get_datasets_for_uri(index: Index, uri: str) -> Iterable[DatasetLite]:
     """Get all datasets at the given uri"""
     for d in index.datasets.get_datasets_for_location(uri=uri):
         yield DatasetLite.from_agdc(d)
+
+
+class ArchiveSummary(NamedTuple):
+    dataset_count: int
+    location_count: int
+    # Decisions that had already been made (eg. the same sibling found from both sides)
+    repeated_count: int
+    dry_run: bool
+
+
+class ArchiveBatcher:
+    """
+    Collect dataset and location archive decisions, and commit them to the index in chunks.
+
+    Each dataset or location is only archived once, however many times it is requested. In a
+    dry run nothing is changed, but the summary still counts what would have been archived.
+
+        with ArchiveBatcher(index, dry_run=dry_run) as archiver:
+            archiver.archive([dataset.id])
+            archiver.archive_location(dataset.id, dataset.local_uri)
+    """
+
+    def __init__(self, index: Index, chunk_size: int = DEFAULT_ARCHIVE_CHUNK_SIZE, dry_run=False, log=_LOG) -> None:
+        self.index = index
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        self.log = log
+
+        self._datasets: Set[uuid.UUID] = set()
+        self._locations: Set[Tuple[uuid.UUID, str]] = set()
+        self._pending_datasets: List[uuid.UUID] = []
+        self._pending_locations: List[Tuple[uuid.UUID, str]] = []
+        self._repeated_count = 0
+
+    def __contains__(self, dataset_id: uuid.UUID):
+        return _as_uuid(dataset_id) in self._datasets
+
+    def archive(self, dataset_ids: Iterable[uuid.UUID]):
+        for dataset_id in dataset_ids:
+            dataset_id = _as_uuid(dataset_id)
+            if dataset_id in self._datasets:
+                self._repeated_count += 1
+                continue
+            self._datasets.add(dataset_id)
+            self._pending_datasets.append(dataset_id)
+
+        if len(self._pending_datasets) >= self.chunk_size:
+            self._flush_datasets()
+
+    def archive_location(self, dataset_id: uuid.UUID, uri: str):
+        location = (_as_uuid(dataset_id), uri)
+        if location in self._locations:
+            self._repeated_count += 1
+            return
+        self._locations.add(location)
+        self._pending_locations.append(location)
+
+        if len(self._pending_locations) >= self.chunk_size:
+            self._flush_locations()
+
+    def flush(self):
+        self._flush_datasets()
+        self._flush_locations()
+
+    def _flush_datasets(self):
+        for chunk in chunked(self._pending_datasets, self.chunk_size):
+            self.log.debug('archive.datasets', count=len(chunk), dry_run=self.dry_run)
+            if not self.dry_run:
+                self.index.datasets.archive(chunk)
+        self._pending_datasets = []
+
+    def _flush_locations(self):
+        if not self._pending_locations:
+            return
+        self.log.debug('archive.locations', count=len(self._pending_locations), dry_run=self.dry_run)
+        if not self.dry_run:
+            for dataset_id, uri in self._pending_locations:
+                self.index.datasets.archive_location(dataset_id, uri)
+        self._pending_locations = []
+
+    def summary(self) -> ArchiveSummary:
+        return ArchiveSummary(
+            dataset_count=len(self._datasets),
+            location_count=len(self._locations),
+            repeated_count=self._repeated_count,
+            dry_run=self.dry_run,
+        )
+
+    def close(self):
+        self.flush()
+        self.log.info('archive.summary', **self.summary()._asdict())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _as_uuid(dataset_id) -> uuid.UUID:
+    return dataset_id if isinstance(dataset_id, uuid.UUID) else uuid.UUID(str(dataset_id))
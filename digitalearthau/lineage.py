@@ -0,0 +1,260 @@
+# coding=utf-8
+"""
+Load the lineage around a set of datasets into memory, so it can be checked without a query per dataset.
+
+Datasets are numbered densely, and their source edges are held as CSR arrays in both directions:
+the sources of dataset ``i`` are ``sources[source_offsets[i]:source_offsets[i + 1]]``, and its
+derived datasets are ``derived[derived_offsets[i]:derived_offsets[i + 1]]``.
+"""
+import uuid
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy
+import structlog
+from boltons.iterutils import chunked
+from sqlalchemy import and_, func, select
+
+from datacube.drivers.postgres import _api as pgapi
+from datacube.index import Index, fields
+
+_LOG = structlog.get_logger()
+
+# How many ids to send in each "IN (...)" query.
+QUERY_CHUNK_SIZE = 10000
+
+
+class LineageGraph:
+    """
+    Datasets and their source edges.
+
+    The sources of the datasets in scope are complete, as are the derived datasets of those sources
+    (their siblings). Other nodes only have the edges that were needed to reach them.
+    """
+
+    def __init__(self,
+                 ids: Sequence[uuid.UUID],
+                 in_scope: numpy.ndarray,
+                 product: numpy.ndarray,
+                 archived: numpy.ndarray,
+                 indexed_time: Sequence[datetime],
+                 location_count: numpy.ndarray,
+                 edges: Sequence[Tuple[int, int, str]]) -> None:
+        self.ids = list(ids)
+        self.in_scope = in_scope
+        self.product = product
+        self.archived = archived
+        self.indexed_time = list(indexed_time)
+        self.location_count = location_count
+
+        node_count = len(self.ids)
+        edge_child = numpy.fromiter((e[0] for e in edges), dtype=numpy.int64, count=len(edges))
+        edge_source = numpy.fromiter((e[1] for e in edges), dtype=numpy.int64, count=len(edges))
+        classifiers = numpy.array([e[2] for e in edges], dtype=object)
+
+        by_child = numpy.argsort(edge_child, kind='stable')
+        self.edge_child = edge_child[by_child]
+        self.sources = edge_source[by_child]
+        self.classifiers = classifiers[by_child]
+        self.source_offsets = _offsets(self.edge_child, node_count)
+
+        by_source = numpy.argsort(edge_source, kind='stable')
+        self.derived = edge_child[by_source]
+        self.derived_offsets = _offsets(edge_source[by_source], node_count)
+
+        self._index = {id_: i for i, id_ in enumerate(self.ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index_of(self, id_: uuid.UUID) -> int:
+        return self._index[id_]
+
+    def scope(self) -> numpy.ndarray:
+        return numpy.flatnonzero(self.in_scope)
+
+    def sources_of(self, i: int) -> numpy.ndarray:
+        return self.sources[self.source_offsets[i]:self.source_offsets[i + 1]]
+
+    def derived_of(self, i: int) -> numpy.ndarray:
+        return self.derived[self.derived_offsets[i]:self.derived_offsets[i + 1]]
+
+    def locationless(self) -> numpy.ndarray:
+        """
+        Datasets in scope with no active locations.
+        """
+        return numpy.flatnonzero(self.in_scope & (self.location_count == 0))
+
+    def archived_sources(self) -> Iterator[Tuple[int, str, int]]:
+        """
+        (dataset, classifier, source) for every archived source of a dataset in scope.
+        """
+        edges = numpy.flatnonzero(self.in_scope[self.edge_child] & self.archived[self.sources])
+        for e in edges:
+            yield int(self.edge_child[e]), self.classifiers[e], int(self.sources[e])
+
+    def sibling_groups(self) -> Iterator[Tuple[int, int, numpy.ndarray]]:
+        """
+        (dataset, source, siblings) for every active source of a dataset in scope that has other
+        active children of the same product.
+
+        (this only applies to source products that are 1:1 with descendants, not pass-to-scene or
+        scene-to-tile conversions)
+        """
+        edges = numpy.flatnonzero(self.in_scope[self.edge_child] & ~self.archived[self.sources])
+        child, source = self.edge_child[edges], self.sources[edges]
+
+        # Expand each (child, source) edge into one candidate pair per child of the source.
+        starts = self.derived_offsets[source]
+        counts = self.derived_offsets[source + 1] - starts
+        pair = numpy.repeat(numpy.arange(len(edges)), counts)
+        position = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        sibling = self.derived[numpy.repeat(starts, counts) + position]
+
+        same_product = self.product[sibling] == self.product[child[pair]]
+        keep = (sibling != child[pair]) & ~self.archived[sibling] & same_product
+        pair, sibling = pair[keep], sibling[keep]
+        if not len(pair):
+            return
+
+        # Pairs are still in edge order, so each edge's siblings are contiguous.
+        bounds = numpy.flatnonzero(numpy.diff(pair)) + 1
+        for group_pair, siblings in zip(numpy.split(pair, bounds), numpy.split(sibling, bounds)):
+            p = group_pair[0]
+            yield int(child[p]), int(source[p]), siblings
+
+    def mark_archived(self, indices: Iterable[int]):
+        self.archived[list(indices)] = True
+
+
+def _offsets(sorted_nodes: numpy.ndarray, node_count: int) -> numpy.ndarray:
+    """
+    CSR offsets for edges already sorted by node.
+
+    >>> _offsets(numpy.array([0, 0, 2]), 4).tolist()
+    [0, 2, 2, 3, 3]
+    """
+    offsets = numpy.zeros(node_count + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(sorted_nodes, minlength=node_count), out=offsets[1:])
+    return offsets
+
+
+# TODO: expand api to support this?
+# pylint: disable=protected-access
+def load_lineage(index: Index,
+                 expressions: dict,
+                 id_range: Optional[Tuple[uuid.UUID, uuid.UUID]] = None,
+                 chunk_size: int = QUERY_CHUNK_SIZE) -> LineageGraph:
+    """
+    Load the datasets matching the search expressions, their sources, and the other children of those sources.
+
+    This is a handful of queries per chunk of datasets rather than several per dataset.
+
+    :param id_range: Only include datasets whose ids are within this (inclusive) range.
+    """
+    if id_range is None:
+        scope_ids = [id_ for id_, in index.datasets.search_returning(['id'], **expressions)]
+    else:
+        scope_ids = list(_select_ids_in_range(index, expressions, id_range))
+
+    with index.datasets._db.connect() as db:
+        edges = {}
+        for chunk in chunked(scope_ids, chunk_size):
+            edges.update(_select_edges(db, pgapi.DATASET_SOURCE.c.dataset_ref, chunk))
+
+        source_ids = set(source for (_, source) in edges)
+        for chunk in chunked(source_ids, chunk_size):
+            edges.update(_select_edges(db, pgapi.DATASET_SOURCE.c.source_dataset_ref, chunk))
+
+        node_ids = list(scope_ids)
+        node_ids.extend(set(id_ for edge in edges for id_ in edge).difference(scope_ids))
+
+        attributes: Dict[uuid.UUID, tuple] = {}
+        for chunk in chunked(node_ids, chunk_size):
+            attributes.update(_select_attributes(db, chunk))
+
+    ids = [id_ for id_ in node_ids if id_ in attributes]
+    index_of = {id_: i for i, id_ in enumerate(ids)}
+
+    in_scope = numpy.zeros(len(ids), dtype=bool)
+    in_scope[[index_of[id_] for id_ in scope_ids if id_ in index_of]] = True
+    products, archived, indexed_times, location_counts = zip(*(attributes[id_] for id_ in ids)) if ids else ((),) * 4
+
+    graph = LineageGraph(
+        ids,
+        in_scope=in_scope,
+        product=numpy.array(products, dtype=numpy.int64),
+        archived=numpy.array(archived, dtype=bool),
+        indexed_time=indexed_times,
+        location_count=numpy.array(location_counts, dtype=numpy.int64),
+        edges=[(index_of[child], index_of[source], classifier)
+               for (child, source), classifier in edges.items()
+               if child in index_of and source in index_of],
+    )
+    _LOG.info('lineage.loaded',
+              dataset_count=int(in_scope.sum()),
+              node_count=len(ids),
+              edge_count=len(graph.sources))
+    return graph
+
+
+def _select_ids_in_range(index: Index, expressions: dict, id_range: Tuple[uuid.UUID, uuid.UUID]) -> Iterator[uuid.UUID]:
+    """
+    The active datasets matching the search expressions, within the id range.
+
+    (the id field can't be searched by range through the index api)
+    """
+    low, high = id_range
+    for query, product in index.datasets._get_product_queries(expressions):
+        query_exprs = tuple(fields.to_expressions(product.metadata_type.dataset_fields.get, **query))
+        with index.datasets._db.connect() as db:
+            for id_, in db._connection.execute(
+                    select(
+                        [pgapi.DATASET.c.id]
+                    ).select_from(
+                        pgapi.PostgresDbAPI._from_expression(pgapi.DATASET, query_exprs)
+                    ).where(
+                        and_(
+                            pgapi.DATASET.c.archived == None,  # noqa: E711
+                            pgapi.DATASET.c.id.between(low, high),
+                            *pgapi.PostgresDbAPI._alchemify_expressions(query_exprs)
+                        )
+                    )
+            ):
+                yield id_
+
+
+def _select_edges(db, column, ids: List[uuid.UUID]) -> Iterator[Tuple[Tuple[uuid.UUID, uuid.UUID], str]]:
+    for child, source, classifier in db._connection.execute(
+            select([
+                pgapi.DATASET_SOURCE.c.dataset_ref,
+                pgapi.DATASET_SOURCE.c.source_dataset_ref,
+                pgapi.DATASET_SOURCE.c.classifier,
+            ]).where(column.in_(ids))
+    ):
+        yield (child, source), classifier
+
+
+def _select_attributes(db, ids: List[uuid.UUID]) -> Iterator[Tuple[uuid.UUID, tuple]]:
+    """
+    (product id, is archived, indexed time, active location count) of each dataset.
+    """
+    active_locations = select(
+        [func.count()]
+    ).where(
+        and_(
+            pgapi.DATASET_LOCATION.c.dataset_ref == pgapi.DATASET.c.id,
+            pgapi.DATASET_LOCATION.c.archived == None  # noqa: E711
+        )
+    ).as_scalar()
+
+    for id_, product, archived, added, location_count in db._connection.execute(
+            select([
+                pgapi.DATASET.c.id,
+                pgapi.DATASET.c.dataset_type_ref,
+                pgapi.DATASET.c.archived,
+                pgapi.DATASET.c.added,
+                active_locations,
+            ]).where(pgapi.DATASET.c.id.in_(ids))
+    ):
+        yield id_, (product, archived is not None, added, location_count)
@@ -5,54 +5,82 @@ from __future__ import print_function
 import os
 import shutil
 import tempfile
+import threading
+import uuid
 from contextlib import suppress
+from datetime import datetime
+from enum import Enum, unique
 from pathlib import Path
-from typing import Iterable
+from functools import partial
+from typing import Iterable, Dict, NamedTuple, Optional, List, Tuple
 
 import click
 import structlog
 from boltons import fileutils
-from eodatasets3 import verify
+from boltons.jsonutils import JSONLIterator
+from dateutil import tz
 
 from datacube.index import Index
 from datacube.model import Dataset
 from datacube.ui import click as ui
-from digitalearthau import paths as path_utils
+from digitalearthau import paths as path_utils, serialise
 from digitalearthau.collections import init_nci_collections, get_collections_in_path
 from digitalearthau.paths import is_base_directory, BASE_DIRECTORIES, get_dataset_paths, split_path_from_base
-from digitalearthau.uiutil import init_logging
+from digitalearthau.qsub import with_qsub_runner, BatchProcessingError, TaskRunner
+from digitalearthau.runners.model import TaskDescription
+from digitalearthau.runners.util import init_run_directory
+from digitalearthau.uiutil import init_logging, profile_option
 
 _LOG = structlog.get_logger()
 
 
 @click.command()
 @ui.global_cli_options
+@profile_option
 @click.option('--dry-run', is_flag=True, default=False)
 @click.option('--checksum/--no-checksum', is_flag=True, default=True)
 @click.option('--destination', '-d',
               required=True,
               type=click.Path(exists=True, writable=True),
               help="Base folder where datasets will be placed inside")
+@click.option('--manifest',
+              type=click.Path(dir_okay=False, writable=True),
+              help="Manifest file to record progress in (default: a new file in the DEA work directory)")
+@click.option('--resume', is_flag=True, default=False,
+              help="Skip datasets that the given --manifest records as already moved")
 @click.argument('paths',
                 type=click.Path(exists=True, readable=True),
                 nargs=-1)
+@with_qsub_runner()
 @ui.pass_index('move')
-def cli(index, dry_run, paths, destination, checksum):
+def cli(index, dry_run, paths, destination, checksum, manifest, resume, runner: TaskRunner, qsub):
     """
     Move the given folder of datasets into the given destination folder.
 
-    This will checksum the data, copy it to the destination, and mark the original as archived in the DEA index.
+    This will copy the data to the destination, checksum the copy, and mark the original as archived in
+    the DEA index.
 
 
     Notes:
 
     * An operator can later run dea-clean to trash the archived original locations.
 
-    * Source datasets with failing checksums will be left as-is, with a warning logged.
+    * Datasets whose copies fail their checksums will be left as-is at the source, with an error logged.
 
     * Both the source(s) and destination paths are expected to be paths containing existing DEA collections.
     (See collections.py and paths.py)
+
+    * Progress is appended to a manifest file as each dataset is planned, copied, verified and indexed.
+    A killed run can be continued with `--resume --manifest <file>`.
+
+    * Copies can be spread across processes or nodes with `--parallel`, `--dask`, `--celery` or `--qsub`.
+    All index updates are still made by this (the submitting) process.
     """
+    if qsub is not None:
+        exit_code, output = qsub(auto=True)
+        click.echo(output)
+        raise click.exceptions.Exit(exit_code)
+
     init_logging()
     init_nci_collections(index)
 
@@ -63,38 +91,245 @@ def cli(index, dry_run, paths, destination, checksum):
                 '\n\t'.join(BASE_DIRECTORIES))
         )
 
+    if resume and not manifest:
+        raise click.BadOptionUsage('resume', "--resume requires the --manifest of the previous run")
+
     # We want to iterate all datasets in the given input folder, so we find collections that exist in
     # that folder and then iterate through all the collection datasets within that folder. Simple :)
 
-    # We do this aggressively to find errors in arguments immediately. (with the downside of `paths` memory usage)
-    resulting_paths = []
+    # Collections are matched aggressively to find errors in arguments immediately, but the
+    # datasets within them are streamed, as a large move may cover millions of them.
+    input_collections = []
     for input_path in map(Path, paths):
         collections = list(get_collections_in_path(input_path))
         if not collections:
             raise click.BadArgumentUsage(f"Directory doesn't match any known collections: {input_path}")
+        input_collections.extend((input_path, collection) for collection in collections)
+
+    resulting_paths = (
+        dataset_path
+        for input_path, collection in input_collections
+        for dataset_path in collection.iter_fs_paths_within(input_path)
+    )
+
+    # A dry run writes nothing, unless the runner itself needs somewhere for its logs.
+    task_desc = None
+    if runner.needs_work_directory() or not (dry_run or manifest):
+        task_desc = init_run_directory('move', dict(paths=list(paths), destination=destination))
+
+    manifest_path = Path(manifest) if manifest else None
+    if manifest_path is None and not dry_run:
+        manifest_path = task_desc.jobs_path.parent.joinpath('move-manifest.jsonl')
+
+    _LOG.info("dataset.input", input_count=len(paths), manifest=manifest_path, runner=repr(runner))
+
+    with MoveManifest(manifest_path, resume=resume, dry_run=dry_run) as move_manifest:
+        try:
+            move_all(
+                index,
+                resulting_paths,
+                Path(destination),
+                dry_run=dry_run,
+                checksum=checksum,
+                manifest=move_manifest,
+                runner=runner,
+                task_desc=task_desc,
+            )
+        finally:
+            runner.stop()
+
+
+def move_all(index: Index,
+             paths: Iterable[Path],
+             destination_base_path: Path,
+             dry_run=False,
+             checksum=True,
+             manifest: 'MoveManifest' = None,
+             runner: TaskRunner = None,
+             task_desc: TaskDescription = None):
+    """
+    Move all of the given dataset paths.
 
-        for collection in collections:
-            resulting_paths.extend(list(collection.iter_fs_paths_within(input_path)))
+    The copying and checksumming of datasets is run as tasks on the given runner (serially in this process
+    by default), while all index updates and manifest records are made here, as each task completes. When the
+    runner processes results in the background, each batch of them is indexed in one transaction.
+    """
+    manifest = manifest or MoveManifest(None)
+    runner = runner or TaskRunner()
+
+    counts = dict(dataset_count=0, previously_completed_count=0)
+
+    def iter_tasks():
+        for path in paths:
+            path = path.absolute()
+            counts['dataset_count'] += 1
+
+            previous_stage = manifest.completed_stage(path)
+            if previous_stage is MoveStage.INDEXED:
+                _LOG.debug("skip.completed", path=path)
+                counts['previously_completed_count'] += 1
+                continue
+
+            mover = FileMover.evaluate_and_create(index, path, dest_base_path=destination_base_path,
+                                                  resume_stage=previous_stage)
+            if not mover:
+                continue
+
+            if previous_stage in (None, MoveStage.FAILED):
+                manifest.record(mover, MoveStage.PLANNED)
+            yield mover, previous_stage
+
+    def on_copied(results: List[Tuple['FileMover', List['MoveStage']]]):
+        copied, failed_paths = [], []
+        for mover, stages in results:
+            for stage in stages:
+                manifest.record(mover, stage)
+            if MoveStage.FAILED in stages:
+                failed_paths.append(str(mover.dest_path))
+            else:
+                copied.append(mover)
+
+        FileMover.update_index(index, copied, dry_run=dry_run)
+        for mover in copied:
+            manifest.record(mover, MoveStage.INDEXED)
 
-    _LOG.info("dataset.count", input_count=len(paths), dataset_count=len(resulting_paths))
+        if failed_paths:
+            raise BatchProcessingError("Checksum failure on " + ', '.join(failed_paths), len(failed_paths))
 
-    # TODO: @ui.executor_cli_options
-    move_all(
-        index,
-        resulting_paths,
-        Path(destination),
-        dry_run=dry_run,
-        checksum=checksum
+    successful, failed = runner(
+        task_desc,
+        iter_tasks(),
+        partial(_copy_dataset, dry_run=dry_run, checksum=checksum),
+        on_batch_complete=on_copied
     )
 
+    _LOG.info("dataset.count", moved_count=successful, failed_count=failed, **counts)
+
+
+def _copy_dataset(task: Tuple['FileMover', Optional['MoveStage']],
+                  dry_run=False,
+                  checksum=True) -> Tuple['FileMover', List['MoveStage']]:
+    """
+    Run the disk half of a move (possibly on a worker node), returning the stages reached.
+
+    A copy that fails its checksum is returned as FAILED, so that the manifest records it.
+    """
+    mover, resume_stage = task
+    try:
+        return mover, mover.copy(dry_run=dry_run, checksum=checksum, resume_stage=resume_stage)
+    except ChecksumFailure:
+        return mover, [MoveStage.FAILED]
+
+
+class ChecksumFailure(RuntimeError):
+    """The copy at the destination didn't match the package checksums, and has been removed."""
+
+
+@unique
+class MoveStage(Enum):
+    """
+    How far a dataset has progressed through a move, in the order they happen.
+    """
+    # Found on disk and in the index: a move will be attempted.
+    PLANNED = 1
+    # Present at the destination (renamed into place atomically).
+    COPIED = 2
+    # The destination copy matches the package checksums.
+    VERIFIED = 3
+    # The destination location is active in the index, and the source location archived.
+    INDEXED = 4
+    # The copy failed its checksum and was removed: a resumed run copies it again.
+    FAILED = 0
+
+
+class MoveRecord(NamedTuple):
+    """
+    A line in a move manifest: a dataset reached the given stage.
+    """
+    timestamp: datetime
+    stage: MoveStage
+    # The path given to the move (as found in the collection), used to identify the dataset when resuming.
+    input_path: Path
+    dest_path: Path
+    dataset_id: uuid.UUID
+
+
+class MoveManifest:
+    """
+    An append-only JSON-Lines record of the stages reached by each dataset in a dea-move run.
+
+    Records are flushed as they are written, so the file is usable even after a killed run. When resuming,
+    the last stage recorded for each input path is read back so that completed datasets can be skipped without
+    touching the disk.
+
+    A manifest without a path (or in a dry run) records nothing. Records may be made from several threads.
+    """
+
+    def __init__(self, path: Optional[Path], resume=False, dry_run=False) -> None:
+        self.path = path
+        self.dry_run = dry_run
+
+        self._stages: Dict[str, MoveStage] = {}
+        if resume:
+            if not path or not path.exists():
+                raise click.BadOptionUsage('manifest', f"No manifest to resume from: {path}")
+            self._stages = self.read_stages(path)
+            _LOG.info("manifest.resume",
+                      manifest=path,
+                      dataset_count=len(self._stages),
+                      completed_count=sum(1 for s in self._stages.values() if s is MoveStage.INDEXED))
+
+        self._writer = None
+        self._lock = threading.Lock()
+        if path and not dry_run:
+            fileutils.mkdir_p(str(path.parent))
+            self._writer = serialise.JsonLinesWriter(path.open('a'))
+
+    @staticmethod
+    def read_stages(path: Path) -> Dict[str, MoveStage]:
+        """
+        The last stage recorded for each input path in the manifest file.
+
+        (Each dataset's stages are recorded in the order they happen, so this is its current state)
+        """
+        stages = {}
+        with path.open('r') as f:
+            for record in JSONLIterator(f):
+                stages[record['input_path']] = serialise.dict_to_type(record['stage'], MoveStage)
+        return stages
+
+    def completed_stage(self, input_path: Path) -> Optional[MoveStage]:
+        """
+        The last stage recorded for this path in the manifest we resumed from, if any.
+        """
+        return self._stages.get(str(input_path))
+
+    def record(self, mover: 'FileMover', stage: MoveStage):
+        if self._writer is None:
+            return
+
+        item = MoveRecord(
+            timestamp=datetime.utcnow().replace(tzinfo=tz.tzutc()),
+            stage=stage,
+            input_path=mover.input_path,
+            dest_path=mover.dest_path,
+            dataset_id=mover.dataset.id,
+        )
+        with self._lock:
+            if self._writer is not None:
+                self._writer.write_item(item)
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.__exit__(None, None, None)
+                self._writer = None
 
-def move_all(index: Index, paths: Iterable[Path], destination_base_path: Path, dry_run=False, checksum=True):
-    for path in paths:
-        mover = FileMover.evaluate_and_create(index, path, dest_base_path=destination_base_path)
-        if not mover:
-            continue
+    def __enter__(self):
+        return self
 
-        mover.move(dry_run=dry_run, checksum=checksum)
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
 class FileMover:
@@ -118,7 +353,9 @@ class FileMover:
                  source_metadata_path: Path,
                  dest_metadata_path: Path,
                  dataset: Dataset,
-                 index: Index) -> None:
+                 index: Index,
+                 input_path: Path = None) -> None:
+        self.input_path = input_path or source_path
         self.source_path = source_path
         self.dest_path = dest_path
         self.from_metadata_path = source_metadata_path
@@ -140,9 +377,14 @@ class FileMover:
             raise NotImplementedError("Only metadata stored within a dataset is currently supported ")
 
     @classmethod
-    def evaluate_and_create(cls, index: Index, path: Path, dest_base_path: Path):
+    def evaluate_and_create(cls, index: Index, path: Path, dest_base_path: Path,
+                            resume_stage: MoveStage = None):
         """
         Create a move task if this path is movable.
+
+        :param resume_stage: the stage a previous run reached for this path. The destination is expected
+                             to exist if it was already copied, and may exist if it was only planned (the
+                             run stopped between the copy and its record): it's verified either way.
         """
         path = path.absolute()
         log = _LOG.bind(path=path)
@@ -151,9 +393,17 @@ class FileMover:
         log.debug("found.metadata_path", metadata_path=metadata_path)
 
         dataset_path, dest_path, dest_md_path = cls._compute_paths(metadata_path, dest_base_path)
-        if dest_path.exists() or dest_md_path.exists():
-            log.info("skip.exists", dest_path=dest_path)
-            return None
+        already_copied = resume_stage is not None and resume_stage.value >= MoveStage.COPIED.value
+        if already_copied:
+            if not dest_md_path.exists():
+                log.warning("resume.dest_missing", dest_path=dest_path, resume_stage=resume_stage)
+                return None
+        elif dest_path.exists() or dest_md_path.exists():
+            if resume_stage is not MoveStage.PLANNED:
+                log.info("skip.exists", dest_path=dest_path)
+                return None
+            # Nothing was at the destination when we planned it, so it's our own unrecorded copy.
+            log.info("resume.dest_found", dest_path=dest_path)
 
         dataset_id = path_utils.get_path_dataset_id(metadata_path)
         log = log.bind(dataset_id=dataset_id)
@@ -172,25 +422,68 @@ class FileMover:
             source_metadata_path=metadata_path,
             dest_metadata_path=dest_md_path,
             dataset=dataset,
-            index=index
+            index=index,
+            input_path=path,
         )
 
-    def move(self, dry_run=True, checksum=True):
-        dest_metadata_uri = self._do_copy(dry_run=dry_run, checksum=checksum)
-        if not dest_metadata_uri:
-            self.log.debug("index.skip")
-            return
+    def __repr__(self):
+        return '%s(%r, %r)' % (self.__class__.__name__, str(self.source_path), str(self.dest_path))
 
-        # Record destination location in index
-        if not dry_run:
-            self.index.datasets.add_location(self.dataset.id, uri=dest_metadata_uri)
-        self.log.info('index.dest.added', uri=dest_metadata_uri)
+    def __getstate__(self):
+        # Movers are sent to workers for copying, which never touch the index: updates are made back in the
+        # submitting process. (so there's no connection to pickle)
+        state = dict(self.__dict__, index=None)
+        del state['log']
+        return state
 
-        # Archive source file in index (for deletion soon)
-        if not dry_run:
-            self.index.datasets.archive_location(self.dataset.id, self.source_uri)
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.log = _LOG.bind(source_path=self.source_path)
 
-        self.log.info('index.source.archived', uri=self.source_uri)
+    def copy(self, dry_run=True, checksum=True, resume_stage: MoveStage = None) -> List[MoveStage]:
+        """
+        Copy and verify the dataset at its destination, without touching the index.
+
+        :return: The stages that were completed.
+        """
+        resume_stage_value = resume_stage.value if resume_stage else 0
+        completed = []
+
+        if resume_stage_value < MoveStage.COPIED.value:
+            if resume_stage is MoveStage.PLANNED and self.dest_path.exists():
+                # Copies are renamed into place atomically, so an existing one is complete.
+                self.log.info("copy.resume.found", dest_path=self.dest_path)
+            else:
+                self._do_copy(dry_run=dry_run)
+            completed.append(MoveStage.COPIED)
+        else:
+            self.log.info("copy.resume.skip", resume_stage=resume_stage)
+
+        if resume_stage_value < MoveStage.VERIFIED.value:
+            if checksum:
+                self._do_verify(dry_run=dry_run)
+            completed.append(MoveStage.VERIFIED)
+
+        return completed
+
+    @staticmethod
+    def update_index(index: Index, movers: List['FileMover'], dry_run=True):
+        """
+        Point the index at the destination copies, archiving the source locations.
+
+        All of the movers are updated in one transaction.
+        """
+        if not dry_run and movers:
+            with index.datasets._db.begin() as transaction:
+                for mover in movers:
+                    # Record destination location in index
+                    transaction.insert_dataset_location(mover.dataset.id, mover.dest_uri)
+                    # Archive source file in index (for deletion soon)
+                    transaction.archive_location(mover.dataset.id, mover.source_uri)
+
+        for mover in movers:
+            mover.log.info('index.dest.added', uri=mover.dest_uri)
+            mover.log.info('index.source.archived', uri=mover.source_uri)
 
     @staticmethod
     def _compute_paths(source_metadata_path, destination_base_path):
@@ -208,27 +501,36 @@ class FileMover:
 
         return dataset_path, new_dataset_location, new_metadata_location
 
-    def _do_copy(self, dry_run=True, checksum=True):
+    def _do_copy(self, dry_run=True):
         log = self.log
         dest_path = self.dest_path
         dataset_path = self.source_path
 
-        if checksum:
-            successful_checksum = _verify_checksum(self.log, self.from_metadata_path,
-                                                   dry_run=dry_run)
-            self.log.info("checksum.complete", passes_checksum=successful_checksum)
-            if not successful_checksum:
-                raise RuntimeError("Checksum failure on " + str(self.from_metadata_path))
-
         if dataset_path.is_dir():
             self.copy_directory(dataset_path, dest_path, dry_run, log)
         elif self.dest_path == self.dest_metadata_path:  # Metadata is contained within the dataset file. eg. *.nc
-            self.copy_file(dataset_path, dest_path, log)
+            if not dry_run:
+                self.copy_file(dataset_path, dest_path, log)
         else:
             # Datasets that are dataset file + sibling or metadata separate to data
             raise NotImplementedError("TODO: dataset files not yet supported")
 
-        return self.dest_uri
+    def _do_verify(self, dry_run=True):
+        """
+        Check the copy at the destination against the source's package checksums.
+
+        A copy that fails is removed again, leaving the source untouched.
+        """
+        successful_checksum = _verify_checksum(self.log, self.from_metadata_path,
+                                               dry_run=dry_run, copied_to=self.dest_path)
+        self.log.info("checksum.complete", passes_checksum=successful_checksum)
+        if successful_checksum is False:
+            self.log.error("copy.remove_failed", dest_path=self.dest_path)
+            if self.dest_path.is_dir():
+                shutil.rmtree(self.dest_path)
+            else:
+                self.dest_path.unlink()
+            raise ChecksumFailure("Checksum failure on " + str(self.dest_path))
 
     def copy_file(self, from_, to, log):
         to_directory = to.parent
@@ -269,7 +571,13 @@ class FileMover:
             shutil.rmtree(tmp_dir, ignore_errors=True)
 
 
-def _verify_checksum(log, metadata_path, dry_run=True):
+def _verify_checksum(log, metadata_path, dry_run=True, copied_to: Path = None):
+    """
+    Verify the files of a dataset against its package checksum file.
+
+    :param copied_to: Verify the copy of the dataset at this path rather than the original.
+                      (The checksum file itself is read from the original.)
+    """
     dataset_path, all_files = path_utils.get_dataset_paths(metadata_path)
     checksum_file = _expected_checksum_path(dataset_path)
     if not checksum_file.exists():
@@ -277,11 +585,21 @@ def _verify_checksum(log, metadata_path, dry_run=True):
         log.warning("checksum.missing", checksum_file=checksum_file)
         return None
 
+    from eodatasets3 import verify
+
     ch = verify.PackageChecksum()
     ch.read(checksum_file)
     if not dry_run:
-        for file, successful in ch.iteratively_verify():
-            if successful:
+        # Checksum paths are relative to the checksum file's folder.
+        checksum_root = checksum_file.parent
+        copied_root = None
+        if copied_to is not None:
+            copied_root = copied_to if dataset_path.is_dir() else copied_to.parent
+
+        for file, expected_hash in ch.items():
+            if copied_root is not None:
+                file = copied_root.joinpath(file.relative_to(checksum_root))
+            if verify.calculate_file_hash(file) == expected_hash:
                 log.debug("checksum.pass", file=file)
             else:
                 log.error("checksum.failure", file=file)
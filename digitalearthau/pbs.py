@@ -7,7 +7,9 @@ import re
 import functools
 import shlex
 from collections import namedtuple, OrderedDict
-from typing import Optional
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Optional
 
 ENV_VARS_TO_PASS = set(['PATH', 'LANG', 'LD_LIBRARY_PATH', 'HOME', 'USER',
                         'CPL_ZIP_ENCODING'])
@@ -16,6 +18,9 @@ ENV_REGEXES_TO_PASS = ['^PYTHON.*', '^GDAL.*', '^LC.*', '^DATACUBE.*',
 
 Node = namedtuple('Node', ['name', 'num_cores', 'offset', 'is_main'])
 
+# When set, pbsdsh commands run as local processes. (see emulated_pbs())
+EMULATE_PBS_ENV = 'DEA_EMULATE_PBS'
+
 
 def hostname():
     return platform.node()
@@ -25,6 +30,10 @@ def is_under_pbs():
     return 'PBS_NODEFILE' in os.environ
 
 
+def is_emulated():
+    return os.environ.get(EMULATE_PBS_ENV) == '1'
+
+
 def current_pbs_job_id() -> Optional[str]:
     return os.environ.get('PBS_JOBID')
 
@@ -57,6 +66,49 @@ def parse_nodes_file(fname=None):
     return [Node(**x) for x in _nodes.values()]
 
 
+def write_nodes_file(path: Path, node_count: int, cores_per_node: int, main_hostname: str = None):
+    """
+    Write a file in the format of PBS_NODEFILE: a line per core, naming its node. The main node is first.
+
+    >>> import tempfile
+    >>> path = Path(tempfile.mkdtemp()) / 'nodes'
+    >>> write_nodes_file(path, 2, 2, main_hostname='gadi-cpu-1')
+    >>> path.read_text().split()
+    ['gadi-cpu-1', 'gadi-cpu-1', 'gadi-cpu-1-emulated-1', 'gadi-cpu-1-emulated-1']
+    >>> [(n.name, n.num_cores, n.offset) for n in parse_nodes_file(str(path))]
+    [('gadi-cpu-1', 2, 0), ('gadi-cpu-1-emulated-1', 2, 2)]
+    """
+    main_hostname = main_hostname or hostname()
+    names = [main_hostname] + ['{}-emulated-{}'.format(main_hostname, i) for i in range(1, node_count)]
+    path.write_text(''.join('{}\n'.format(name) * cores_per_node for name in names))
+
+
+@contextmanager
+def emulated_pbs(work_path: Path, node_count: int = 2, cores_per_node: int = 4) -> List[Node]:
+    """
+    Pretend to be the main node of a multi-node PBS job, with every "node" running on this machine.
+
+    A node file is written to the work path, and pbsdsh runs its commands locally, so the pbs_celery
+    runner's full launch path can be run (and timed) without PBS.
+    """
+    nodes_file = work_path.joinpath('emulated-nodefile')
+    write_nodes_file(nodes_file, node_count, cores_per_node)
+
+    emulated_env = {'PBS_NODEFILE': str(nodes_file), EMULATE_PBS_ENV: '1'}
+    original_env = {k: os.environ.get(k) for k in emulated_env}
+    os.environ.update(emulated_env)
+    nodes.cache_clear()
+    try:
+        yield nodes()
+    finally:
+        for k, v in original_env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        nodes.cache_clear()
+
+
 # This is defined in document "DEA Event structure", to produce stable & consistent task ids for pbs jobs.
 # https://docs.google.com/document/d/1VNpK3GL1r4kbjwAO-sJ6_BMk2FSHhNnoDg4VHeylyAE/edit?usp=sharing
 NCI_PBS_UUID_NAMESPACE = uuid.UUID('85d36430-538f-4ecd-85d0-d0ef9edfc266')
@@ -82,7 +134,9 @@ def current_job_task_id() -> Optional[uuid.UUID]:
 
 def task_id_for_pbs_job(pbs_job_id: str) -> uuid.UUID:
     """
-    Get a stable UUID for the the given PBS job id. Expects the whole job name ("8894425.gadi-pbs"), not just the number).
+    Get a stable UUID for the the given PBS job id.
+
+    Expects the whole job name ("8894425.gadi-pbs"), not just the number.
 
     >>> task_id_for_pbs_job('7818401.gadi-pbs')
     UUID('47d97d2d-9aeb-5e07-8072-ebcf9424fc97')
@@ -150,7 +204,7 @@ def pbsdsh(cpu_num, script, env=None, test_mode=False) -> subprocess.Popen:
 
     hdr = mk_exports(env) + '\n\n'
 
-    if test_mode:
+    if test_mode or is_emulated():
         args = "env -i bash --norc -c".split(' ')
     else:
         args = "pbsdsh -n {} -- bash -c".format(cpu_num).split(' ')
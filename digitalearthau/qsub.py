@@ -1,23 +1,41 @@
+import atexit
+import concurrent.futures
+import getpass
+import hashlib
 import itertools
+import json
 import logging
+import os
+import queue
+import random
 import re
 import shlex
+import shutil
 import sys
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime
 from functools import update_wrapper
 from pathlib import Path
 from subprocess import Popen, PIPE
 from pprint import pprint
 import click
+import cloudpickle
 import yaml
+from boltons import fileutils
+from dateutil import tz
 from pydash import pick
-from typing import List, Tuple
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
 from datacube.executor import (SerialExecutor,
                                mk_celery_executor,
                                _get_concurrent_executor,
                                _get_distributed_executor)
-from . import pbs
-from .runners import celery_environment
+from . import pbs, serialise
+from .events import NodeMessage, Status, TaskEvent, TaskResources
 from .runners.model import TaskDescription
 
 NUM_CPUS_PER_NODE = 48  # Gadi: 48 CPUs/node, 192 GB RAM/node, 400 GB PBS_JOBFS/node.
@@ -113,19 +131,8 @@ class QSubLauncher(object):
         Throws JobSubmissionError on failure.
         """
         qsub_args, script = self.build_submission(*commands)
-
-        proc = Popen(['qsub'] + qsub_args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        proc.stdin.write(script.encode('utf-8'))
-        proc.stdin.close()
-        stdout = proc.stdout.read().decode('utf-8')
-        stderr = proc.stdout.read().decode('utf-8')
-        exit_code = proc.wait()
-
-        if exit_code != 0:
-            raise JobSubmissionError("Error submitting qsub job", stdout, stderr)
-
-        job_id = stdout.strip(' \n')
-        return job_id
+        # Retried if the PBS server is briefly unavailable.
+        return SubmissionEngine(concurrency=1).submit(QSubSubmission(None, qsub_args, script)).job_id
 
     def build_submission(self, *commands: str) -> Tuple[List[str], str]:
         """Get the qsub arguments and script that would be submitted, but don't submit it."""
@@ -141,6 +148,347 @@ class JobSubmissionError(Exception):
     pass
 
 
+class PossiblySubmittedError(JobSubmissionError):
+    """qsub failed, but the job may have been accepted anyway: it mustn't be submitted again without checking."""
+
+
+# qsub errors that mean the PBS server is busy or briefly unreachable, and rejected the job: a later retry may
+# succeed.
+TRANSIENT_QSUB_ERRORS = re.compile(
+    'server busy|try again|cannot connect|connection refused|pbs_iff|maximum number of jobs',
+    re.IGNORECASE
+)
+
+# qsub errors where the connection was lost mid-request: the server may have accepted the job anyway. qsub isn't
+# idempotent, so these are only retried once no job of that name is found.
+AMBIGUOUS_QSUB_ERRORS = re.compile(
+    'timed out|end of file|communication failure',
+    re.IGNORECASE
+)
+
+
+def run_qsub(args: List[str], script: Optional[str] = None) -> str:
+    """
+    Run qsub once, returning the job_id.
+
+    Throws JobSubmissionError on failure.
+    """
+    proc = Popen(['qsub'] + [str(arg) for arg in args], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    stdout, stderr = proc.communicate(script.encode('utf-8') if script is not None else None)
+    if proc.returncode != 0:
+        raise JobSubmissionError("Error submitting qsub job", stdout.decode('utf-8'), stderr.decode('utf-8'))
+    return stdout.decode('utf-8').strip(' \n')
+
+
+def is_transient_error(error: JobSubmissionError) -> bool:
+    """
+    >>> is_transient_error(JobSubmissionError("Error submitting qsub job", '', 'qsub: Server busy, try again'))
+    True
+    >>> is_transient_error(JobSubmissionError("Error submitting qsub job", '', 'qsub: Unknown queue'))
+    False
+    """
+    return any(TRANSIENT_QSUB_ERRORS.search(str(message)) for message in error.args[1:])
+
+
+def is_ambiguous_error(error: JobSubmissionError) -> bool:
+    """
+    >>> is_ambiguous_error(JobSubmissionError("Error submitting qsub job", '', 'qsub: End of File'))
+    True
+    >>> is_ambiguous_error(JobSubmissionError("Error submitting qsub job", '', 'qsub: Server busy, try again'))
+    False
+    """
+    return any(AMBIGUOUS_QSUB_ERRORS.search(str(message)) for message in error.args[1:])
+
+
+def find_jobs_named(name: str) -> List[str]:
+    """
+    The ids of this user's queued, held or running jobs with the given name.
+
+    Throws JobSubmissionError if PBS can't be asked.
+    """
+    proc = Popen(['qselect', '-N', name, '-u', getpass.getuser()], stdout=PIPE, stderr=PIPE)
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+        raise JobSubmissionError("Error listing qsub jobs", stdout.decode('utf-8'), stderr.decode('utf-8'))
+    return stdout.decode('utf-8').split()
+
+
+def _job_name(args: List[str]) -> Optional[str]:
+    """
+    >>> _job_name(['-N', 'sync-01', '--', 'echo'])
+    'sync-01'
+    >>> _job_name(['--', 'echo', '-N', 'x'])
+    """
+    options_end = args.index('--') if '--' in args else len(args)
+    for i in range(options_end - 1):
+        if args[i] == '-N':
+            return str(args[i + 1])
+    return None
+
+
+class QSubSubmission(NamedTuple):
+    # Identifies the job across runs, for the submission record. None to always submit.
+    key: Optional[str]
+    # Arguments to qsub (not including the executable)
+    args: List[str]
+    # The job script, given on stdin. None if the args give the command (after '--')
+    script: Optional[str] = None
+    # The key of an earlier submission that must finish before this job runs.
+    depends_on: Optional[str] = None
+    # The job's folder for logs, kept in the submission record.
+    run_path: Optional[Path] = None
+
+
+class SubmissionResult(NamedTuple):
+    submission: QSubSubmission
+    # The final qsub arguments, including any dependency.
+    args: List[str]
+    job_id: Optional[str]
+    error: Optional[Exception]
+    attempts: int
+    # Was it found in the submission record, rather than submitted now?
+    recorded: bool = False
+    # The job's folder: from the record if it was submitted by an earlier run.
+    run_path: Optional[Path] = None
+
+
+class SubmissionRecord:
+    """
+    The jobs already submitted, kept as a JSON-Lines file so that an interrupted run can be rerun without
+    submitting them again.
+
+    With no path, nothing is remembered.
+    """
+
+    def __init__(self, path: Optional[Path] = None) -> None:
+        self.path = path
+        self._job_ids = {}  # type: Dict[str, str]
+        self._run_paths = {}  # type: Dict[str, Path]
+        self._lock = threading.Lock()
+
+        if path is not None and path.exists():
+            with path.open('r') as f:
+                for line in f:
+                    if line.strip():
+                        item = json.loads(line)
+                        self._job_ids[item['key']] = item['job_id']
+                        if item.get('run_path'):
+                            self._run_paths[item['key']] = Path(item['run_path'])
+
+    def get(self, key: Optional[str]) -> Optional[str]:
+        return self._job_ids.get(key) if key is not None else None
+
+    def run_path(self, key: Optional[str]) -> Optional[Path]:
+        return self._run_paths.get(key) if key is not None else None
+
+    def add(self, key: Optional[str], job_id: str, args: List[str], run_path: Optional[Path] = None):
+        if key is None:
+            return
+        with self._lock:
+            self._job_ids[key] = job_id
+            if run_path is not None:
+                self._run_paths[key] = run_path
+            if self.path is not None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with self.path.open('a') as f:
+                    f.write(json.dumps(dict(key=key, job_id=job_id, args=[str(a) for a in args],
+                                            run_path=str(run_path) if run_path is not None else None,
+                                            submit_time=datetime.utcnow().isoformat())) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def __len__(self):
+        return len(self._job_ids)
+
+
+class _SubmitRateLimiter:
+    """
+    Space out qsub calls, based on how the PBS server responds.
+
+    The gap doubles each time the server reports it is busy, and halves with each success, back down to
+    the minimum.
+    """
+
+    def __init__(self, min_interval_secs: float, max_interval_secs: float) -> None:
+        self.min_interval_secs = min_interval_secs
+        self.max_interval_secs = max_interval_secs
+        self.interval_secs = min_interval_secs
+        self._next_time = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_time)
+            self._next_time = start + self.interval_secs
+        if start > now:
+            time.sleep(start - now)
+
+    def succeeded(self):
+        with self._lock:
+            self.interval_secs = max(self.min_interval_secs, self.interval_secs / 2)
+
+    def throttled(self):
+        with self._lock:
+            self.interval_secs = min(self.max_interval_secs, max(self.interval_secs * 2, 0.5))
+
+
+class SubmissionEngine:
+    """
+    Submit many qsub jobs, several at once.
+
+    Transient PBS errors are retried with exponential backoff, and each job is recorded once submitted
+    (see SubmissionRecord), so that a rerun only submits what's missing.
+
+    When the connection is lost mid-submission, the job may have been accepted regardless. These are only retried
+    if the job is named, and PBS has no job of that name: otherwise they fail rather than risk a duplicate.
+
+    A job that depends on another is submitted once that job has an id.
+    """
+
+    def __init__(self,
+                 record: SubmissionRecord = None,
+                 concurrency: int = 4,
+                 max_attempts: int = 5,
+                 backoff_secs: float = 2.0,
+                 max_backoff_secs: float = 120.0,
+                 min_interval_secs: float = 0.0,
+                 qsub=run_qsub,
+                 find_jobs=find_jobs_named) -> None:
+        """
+        :param qsub: function to run qsub once: (args, script) -> job_id
+        :param find_jobs: function to list the ids of existing jobs with a name: (name) -> [job_id]
+        """
+        self.record = record if record is not None else SubmissionRecord()
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff_secs = backoff_secs
+        self.max_backoff_secs = max_backoff_secs
+        self._limiter = _SubmitRateLimiter(min_interval_secs, max_backoff_secs)
+        self._qsub = qsub
+        self._find_jobs = find_jobs
+
+    def submit_all(self, submissions: Iterable[QSubSubmission]) -> Iterator[SubmissionResult]:
+        """
+        Submit all jobs, yielding their results in the order given.
+
+        A failed submission doesn't stop the others, but jobs that depend on it are not submitted.
+        """
+        futures = {}  # type: Dict[str, concurrent.futures.Future]
+        ordered = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for submission in submissions:
+                dependency = futures.get(submission.depends_on)
+                if submission.depends_on is not None and dependency is None:
+                    raise ValueError(f"Unknown dependency {submission.depends_on!r}: it must be submitted earlier")
+
+                # Dependencies are always submitted earlier, so the pool starts them first and can't deadlock.
+                future = pool.submit(self._submit_after, submission, dependency)
+                if submission.key is not None:
+                    futures[submission.key] = future
+                ordered.append(future)
+
+            for future in ordered:
+                yield future.result()
+
+    def submit(self, submission: QSubSubmission, depends_on_job: Optional[str] = None) -> SubmissionResult:
+        """
+        Submit one job, retrying transient failures.
+
+        Throws JobSubmissionError if it couldn't be submitted.
+        """
+        result = self._submit(submission, depends_on_job)
+        if result.error is not None:
+            raise result.error
+        return result
+
+    def _submit_after(self, submission: QSubSubmission, dependency: Optional[concurrent.futures.Future]):
+        depends_on_job = None
+        if dependency is not None:
+            required = dependency.result()
+            if required.job_id is None:
+                error = JobSubmissionError(f"Dependency {submission.depends_on!r} was not submitted")
+                return SubmissionResult(submission, submission.args, None, error, attempts=0,
+                                        run_path=submission.run_path)
+            depends_on_job = required.job_id
+        return self._submit(submission, depends_on_job)
+
+    def _submit(self, submission: QSubSubmission, depends_on_job: Optional[str]) -> SubmissionResult:
+        args = list(submission.args)
+        if depends_on_job is not None:
+            args = with_job_dependency(args, depends_on_job)
+
+        job_id = self.record.get(submission.key)
+        if job_id is not None:
+            _LOG.info('Already submitted %s as %s', submission.key, job_id)
+            return SubmissionResult(submission, args, job_id, None, attempts=0, recorded=True,
+                                    run_path=self.record.run_path(submission.key))
+
+        attempt = 0
+        while True:
+            attempt += 1
+            self._limiter.wait()
+            try:
+                job_id = self._qsub(args, submission.script)
+            except JobSubmissionError as e:
+                retryable = is_transient_error(e)
+                if is_ambiguous_error(e):
+                    e = self._check_not_submitted(args, e)
+                    retryable = not isinstance(e, PossiblySubmittedError)
+                if attempt >= self.max_attempts or not retryable:
+                    _LOG.error('Failed to submit %s after %d attempt(s): %s', submission.key, attempt, e)
+                    return SubmissionResult(submission, args, None, e, attempts=attempt,
+                                            run_path=submission.run_path)
+
+                self._limiter.throttled()
+                delay = min(self.max_backoff_secs, self.backoff_secs * 2 ** (attempt - 1))
+                delay *= random.uniform(0.5, 1.0)
+                _LOG.warning('PBS error submitting %s, retrying in %.1fs: %s', submission.key, delay, e)
+                time.sleep(delay)
+                continue
+
+            self._limiter.succeeded()
+            self.record.add(submission.key, job_id, args, submission.run_path)
+            return SubmissionResult(submission, args, job_id, None, attempts=attempt, run_path=submission.run_path)
+
+    def _check_not_submitted(self, args: List[str], error: JobSubmissionError) -> JobSubmissionError:
+        """
+        After an ambiguous error, return it if the job surely wasn't submitted (so it can be retried), or else
+        a PossiblySubmittedError.
+        """
+        name = _job_name(args)
+        if name is None:
+            return PossiblySubmittedError("Job may have been submitted (it has no name to check)", *error.args[1:])
+        try:
+            existing = self._find_jobs(name)
+        except JobSubmissionError as e:
+            return PossiblySubmittedError("Job may have been submitted (its name couldn't be checked)",
+                                          *error.args[1:], *e.args[1:])
+        if existing:
+            return PossiblySubmittedError("Job may have been submitted: found {} named {!r}".format(existing, name),
+                                          *error.args[1:])
+        return error
+
+
+def with_job_dependency(args: List[str], job_id: str) -> List[str]:
+    """
+    Add a dependency on the given job to qsub arguments, merging it into any existing -W attributes.
+
+    >>> with_job_dependency(['-N', 'sync-01', '--', 'echo'], '1234.gadi-pbs')
+    ['-W', 'depend=afterany:1234.gadi-pbs', '-N', 'sync-01', '--', 'echo']
+    >>> with_job_dependency(['-W', 'umask=33', '--', 'echo'], '1234.gadi-pbs')
+    ['-W', 'umask=33,depend=afterany:1234.gadi-pbs', '--', 'echo']
+    """
+    args = list(args)
+    options_end = args.index('--') if '--' in args else len(args)
+    attributes = 'depend=afterany:{}'.format(job_id.strip())
+    for i, arg in enumerate(args[:options_end - 1]):
+        if arg == '-W':
+            args[i + 1] = '{},{}'.format(args[i + 1], attributes)
+            return args
+    return ['-W', attributes] + args
+
+
 class QSubParamType(click.ParamType):
     name = 'opts'
 
@@ -179,7 +527,9 @@ Examples:
 
             p = norm_qsub_params(p)
             return QSubLauncher(p, ('--celery', 'pbs-launch'),
-                                [('--qsub', 1), ('--queue-size', 1)])
+                                [('--qsub', 1), ('--queue-size', 1), ('--adaptive-queue', 0), ('--warm-workers', 0),
+                                 ('--queue-max-memory', 1), ('--task-batch-size', 1), ('--result-workers', 1),
+                                 ('--result-batch-size', 1), ('--measure-tasks', 0)])
         except ValueError:
             self.fail('Failed to parse: {}'.format(value), param, ctx)
 
@@ -469,7 +819,444 @@ def describe_task(task):
     return repr(task)
 
 
-def run_tasks(tasks, executor, run_task, process_result=None, queue_size=50):
+class QueueMetrics(NamedTuple):
+    # How many tasks may be in flight now
+    window: int
+    in_flight: int
+    completed: int
+    # Tasks completed per second, smoothed
+    completion_rate: float
+    # Seconds from submitting a task to receiving its result, smoothed
+    latency_secs: float
+    # Memory used by this (head node) process
+    rss_mb: float
+
+
+class AdaptiveQueueSize:
+    """
+    How many tasks to keep in flight, adjusted as results come back.
+
+    While workers sit idle (fewer tasks in flight than workers), or results come back about as quickly
+    as the baseline, the window grows by one task per result. When results start taking much longer than
+    the baseline (tasks are queueing rather than running) or this process's memory passes the limit, the
+    window shrinks by a quarter, though not below the number of workers for latency alone. It then holds
+    until the tasks that were in flight have returned.
+
+    The baseline is the fastest latency seen, unless shrinking the window didn't bring latency down: the
+    tasks themselves got slower, so their latency becomes the new baseline.
+    """
+
+    def __init__(self,
+                 initial: int,
+                 minimum: int = 1,
+                 maximum: int = None,
+                 workers: int = None,
+                 max_rss_mb: float = None,
+                 latency_tolerance: float = 2.0,
+                 smoothing: float = 0.2) -> None:
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum or initial * 4
+        self.workers = workers
+        self.max_rss_mb = max_rss_mb
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+
+        self.completed = 0
+        self.latency_secs = None  # type: Optional[float]
+        self.completion_rate = 0.0
+        self._baseline_latency_secs = None  # type: Optional[float]
+        self._last_completion = None  # type: Optional[float]
+        self._rss_mb = 0.0
+        # Results still to come back from before the last shrink, and the latency that caused it.
+        self._awaiting_results = 0
+        self._latency_at_shrink = None  # type: Optional[float]
+
+    def task_completed(self,
+                       latency_secs: float,
+                       now: float = None,
+                       rss_mb: float = None,
+                       in_flight: int = None) -> int:
+        """
+        Record a result, returning the new window size.
+
+        :param in_flight: How many tasks are still running, not counting this one.
+        """
+        now = time.monotonic() if now is None else now
+        self._rss_mb = _current_rss_mb() if rss_mb is None else rss_mb
+        self.completed += 1
+
+        self.latency_secs = self._smooth(self.latency_secs, latency_secs)
+        if self._last_completion is not None:
+            gap = max(now - self._last_completion, 1e-6)
+            self.completion_rate = self._smooth(self.completion_rate or None, 1 / gap)
+        self._last_completion = now
+
+        # Smoothed, so a single quick task doesn't set an unreachable baseline.
+        if self._baseline_latency_secs is None or self.latency_secs < self._baseline_latency_secs:
+            self._baseline_latency_secs = self.latency_secs
+
+        if self._awaiting_results:
+            self._awaiting_results -= 1
+            # A quarter fewer tasks queued should mean about a quarter less latency. If the smaller
+            # window didn't help, the tasks are slower rather than queueing.
+            if not self._awaiting_results and self.latency_secs > self._latency_at_shrink * 0.9:
+                self._baseline_latency_secs = self.latency_secs
+
+        workers_idle = self.workers is not None and in_flight is not None and in_flight < self.workers
+
+        if self.max_rss_mb is not None and self._rss_mb > self.max_rss_mb:
+            self._shrink(self.minimum, in_flight, latency_secs)
+        elif workers_idle:
+            self.size = min(self.maximum, max(self.size + 1, self.workers))
+        elif self._awaiting_results:
+            # Wait to see the effect of the last shrink.
+            pass
+        elif self.latency_secs > self._baseline_latency_secs * self.latency_tolerance:
+            self._shrink(max(self.minimum, self.workers or 0), in_flight, latency_secs)
+        else:
+            self.size = min(self.maximum, self.size + 1)
+        return self.size
+
+    def _shrink(self, floor: int, in_flight: Optional[int], latency_secs: float):
+        self.size = max(floor, self.size - max(1, self.size // 4))
+        self._awaiting_results = max(1, self.size if in_flight is None else in_flight)
+        self._latency_at_shrink = latency_secs
+
+    def _smooth(self, average: Optional[float], value: float) -> float:
+        if average is None:
+            return value
+        return average + self.smoothing * (value - average)
+
+    def metrics(self, in_flight: int) -> QueueMetrics:
+        return QueueMetrics(
+            window=self.size,
+            in_flight=in_flight,
+            completed=self.completed,
+            completion_rate=self.completion_rate,
+            latency_secs=self.latency_secs or 0.0,
+            rss_mb=self._rss_mb,
+        )
+
+
+def _current_rss_mb() -> float:
+    """Resident memory of this process."""
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        # Not linux: the peak is the best we have (kilobytes on linux, bytes on mac).
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# How often run_tasks() logs its queue metrics
+QUEUE_METRICS_INTERVAL_SECS = 60
+
+
+class SharedTaskFunction:
+    """
+    A task function pickled once to a file that all workers can read.
+
+    Batches of tasks then only carry the file's path: each worker process loads the function the first
+    time it sees that path, rather than unpickling the whole config again for every task.
+
+    (The file's name is the digest of its content, so it is only ever written once.)
+    """
+
+    def __init__(self, run_task, directory: Path) -> None:
+        payload = cloudpickle.dumps(run_task)
+        self.path = directory.joinpath('run-task-{}.pickle'.format(hashlib.sha1(payload).hexdigest()))
+        if not self.path.exists():
+            directory.mkdir(parents=True, exist_ok=True)
+            with fileutils.atomic_save(str(self.path)) as f:
+                f.write(payload)
+
+
+class TaskFailure(NamedTuple):
+    """A task within a batch that raised an exception (as exceptions may not survive pickling)"""
+    error: str
+    traceback: str
+
+
+class TaskFailedError(Exception):
+    """
+    Raised in a worker after a task (or a task within a batch) failed, so that the executor records it as failed.
+
+    It carries what would have been returned, for run_tasks() to handle: a TaskMeasurement, or a batch's results.
+    """
+
+    def __init__(self, result) -> None:
+        super().__init__(result)
+        self.result = result
+
+
+# Task functions already loaded in this (worker) process, by path.
+_LOADED_TASK_FUNCTIONS = {}  # type: Dict[str, object]
+
+
+def run_task_batch(function_path: str, tasks: list) -> list:
+    """
+    Run a batch of tasks in a worker, returning each task's result.
+
+    If any failed, a TaskFailedError is raised once the batch finishes instead, with a TaskFailure for each
+    failed task among the results.
+    """
+    run_task = _LOADED_TASK_FUNCTIONS.get(function_path)
+    if run_task is None:
+        run_task = cloudpickle.loads(Path(function_path).read_bytes())
+        _LOADED_TASK_FUNCTIONS[function_path] = run_task
+
+    results = []
+    failed = False
+    for task in tasks:
+        try:
+            results.append(run_task(task=task))
+        except TaskFailedError as e:
+            # Already measured (see MeasuredTask)
+            results.append(e.result)
+            failed = True
+        except Exception as e:  # pylint: disable=broad-except
+            results.append(TaskFailure(repr(e), traceback.format_exc()))
+            failed = True
+    if failed:
+        raise TaskFailedError(results)
+    return results
+
+
+def _reset_peak_rss() -> bool:
+    """Reset the peak resident memory of this process, so that it can be measured per task. (Linux 4.0+)"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_bytes() -> Optional[int]:
+    """Peak resident memory of this process, since it was last reset."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _io_bytes() -> Tuple[Optional[int], Optional[int]]:
+    """Bytes read and written by this process so far, by any means (files, network...). (Linux only)"""
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(':', 1) for line in f)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _utc_datetime(timestamp: Optional[float]) -> Optional[datetime]:
+    return datetime.fromtimestamp(timestamp, tz=tz.tzutc()) if timestamp is not None else None
+
+
+class TaskMeasurement(NamedTuple):
+    """
+    A task's result, and how it ran. (see MeasuredTask)
+    """
+    # The task's return value, or a TaskFailure
+    result: object
+    # The task, as logged (see describe_task)
+    description: str
+    node: NodeMessage
+    started: float
+    finished: float
+    peak_rss_bytes: Optional[int]
+    read_bytes: Optional[int]
+    write_bytes: Optional[int]
+    # Set by run_tasks() (by the clock of the submitting node)
+    submitted: Optional[float] = None
+
+    def task_event(self, task_desc: TaskDescription = None) -> TaskEvent:
+        failure = self.result if isinstance(self.result, TaskFailure) else None
+        status = Status.FAILED if failure else Status.COMPLETE
+        return TaskEvent(
+            timestamp=_utc_datetime(self.finished),
+            event='task.{}'.format(status.name.lower()),
+            user=getpass.getuser(),
+            node=self.node,
+            message='{}\n{}'.format(self.description, failure.traceback) if failure else self.description,
+            id=uuid.uuid4(),
+            status=status,
+            name=task_desc.type_ if task_desc else 'task',
+            job_parameters=task_desc.parameters if task_desc else {},
+            resources=TaskResources(
+                submitted=_utc_datetime(self.submitted),
+                started=_utc_datetime(self.started),
+                finished=_utc_datetime(self.finished),
+                peak_rss_bytes=self.peak_rss_bytes,
+                read_bytes=self.read_bytes,
+                write_bytes=self.write_bytes,
+            ),
+        )
+
+
+class MeasuredTask:
+    """
+    Wraps a task function to measure each task in the worker that runs it: when it started and finished,
+    which node ran it, and the peak memory and the bytes read and written by the worker process meanwhile.
+
+    The wrapped function returns a TaskMeasurement. If the task fails, a TaskFailedError is raised with the
+    measurement (its result a TaskFailure), so that failed tasks are measured too.
+    """
+
+    def __init__(self, run_task) -> None:
+        self.run_task = run_task
+
+    def __call__(self, task) -> TaskMeasurement:
+        peak_was_reset = _reset_peak_rss()
+        read_before, written_before = _io_bytes()
+        started = time.time()
+        try:
+            result = self.run_task(task=task)
+        except Exception as e:  # pylint: disable=broad-except
+            result = TaskFailure(repr(e), traceback.format_exc())
+        finished = time.time()
+        read_after, written_after = _io_bytes()
+
+        measurement = TaskMeasurement(
+            result=result,
+            description=describe_task(task),
+            node=NodeMessage.current_node(),
+            started=started,
+            finished=finished,
+            peak_rss_bytes=_peak_rss_bytes() if peak_was_reset else None,
+            read_bytes=read_after - read_before if read_before is not None else None,
+            write_bytes=written_after - written_before if written_before is not None else None,
+        )
+        if isinstance(result, TaskFailure):
+            raise TaskFailedError(measurement)
+        return measurement
+
+
+# Queued to stop a ResultProcessor thread.
+_STOP_PROCESSING = object()
+
+
+class BatchProcessingError(Exception):
+    """
+    Raised by a batch result handler when only some of its results failed: the others were processed.
+    """
+
+    def __init__(self, message: str, failed_count: int) -> None:
+        super().__init__(message)
+        self.failed_count = failed_count
+
+
+class ResultProcessor:
+    """
+    Process task results on background threads, so that slow handling (such as index writes) doesn't hold
+    up the submission of new tasks.
+
+    Up to `max_pending` results wait to be processed: beyond that, submit() blocks until there's room,
+    slowing the task loop to the speed of result handling rather than buffering without limit.
+
+    Results are handled in batches of up to `batch_size` when a `process_batch` function is given,
+    such as to make several index writes at once. Batches are not held back waiting to fill.
+
+    Handlers are called one batch at a time, whatever the number of workers, unless they're `thread_safe`.
+    """
+
+    def __init__(self,
+                 process_result=None,
+                 process_batch=None,
+                 workers: int = 1,
+                 max_pending: int = 100,
+                 batch_size: int = 1,
+                 thread_safe: bool = False) -> None:
+        if process_batch is None:
+            if process_result is None:
+                raise ValueError("Expected a process_result or process_batch function")
+
+            def process_batch(results):
+                for result in results:
+                    process_result(result)
+
+        self._process_batch = process_batch
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._handler_lock = None if thread_safe else threading.Lock()
+        self.successful = 0
+        self.failed = 0
+
+        self._threads = [
+            threading.Thread(target=self._work, name='result-processor-{}'.format(i), daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, result):
+        self._queue.put(result)
+
+    def _work(self):
+        stopping = False
+        while not stopping:
+            if self._handler_lock is None:
+                stopping = self._next_batch()
+            else:
+                # Taken before the batch, so that results wait in the queue (to fill the next batch) rather than
+                # in another worker.
+                with self._handler_lock:
+                    stopping = self._next_batch()
+
+    def _next_batch(self) -> bool:
+        """
+        Process the next batch of results, returning whether this worker should stop.
+        """
+        batch = [self._queue.get()]
+        while len(batch) < self.batch_size and batch[-1] is not _STOP_PROCESSING:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        stopping = batch[-1] is _STOP_PROCESSING
+        if stopping:
+            batch.pop()
+        if batch:
+            self._run_batch(batch)
+        return stopping
+
+    def _run_batch(self, batch):
+        try:
+            self._process_batch(batch)
+            successful, failed = len(batch), 0
+        except BatchProcessingError as err:
+            _LOG.error('Processing %d of %d result(s) failed: %s', err.failed_count, len(batch), err)
+            successful, failed = len(batch) - err.failed_count, err.failed_count
+        except Exception as err:  # pylint: disable=broad-except
+            _LOG.exception('Processing %d result(s) failed: %s', len(batch), err)
+            successful, failed = 0, len(batch)
+        with self._lock:
+            self.successful += successful
+            self.failed += failed
+
+    def close(self) -> Tuple[int, int]:
+        """
+        Wait for all results to be processed, returning the count of (successful, failed) results.
+        """
+        for _ in self._threads:
+            self._queue.put(_STOP_PROCESSING)
+        for thread in self._threads:
+            thread.join()
+        return self.successful, self.failed
+
+
+def run_tasks(tasks, executor, run_task, process_result=None, queue_size=50, batch_size=None, shared_dir=None,
+              result_processor: ResultProcessor = None, on_task_measured=None):
     """
 
     :param tasks: iterable of tasks. Usually a generator to create them as required.
@@ -479,41 +1266,132 @@ def run_tasks(tasks, executor, run_task, process_result=None, queue_size=50):
                            takes a single argument, the return value from `run_task(task)`
     :param queue_size: How large the queue of tasks should be. Will depend on how fast tasks are
                        processed, and how much memory is available to buffer them.
+                       Either a fixed size or an AdaptiveQueueSize.
+    :param batch_size: Send tasks to the executor in batches of this many, with run_task shared via a
+                       file (see SharedTaskFunction) rather than sent in every message.
+    :param shared_dir: A folder that all workers can read, for the shared run_task.
+                       (a temporary folder by default, which only suits workers on this machine)
+    :param result_processor: Process results in the background with this, rather than calling
+                             process_result in the task loop. It is closed when the tasks finish.
+    :param on_task_measured: Measure each task in its worker (see MeasuredTask), and give the
+                             TaskMeasurement of each finished task to this function.
     """
     _LOG.debug('Starting running tasks...')
+    tasks = iter(tasks)
+    window = queue_size if isinstance(queue_size, AdaptiveQueueSize) else None
     results = []
-    task_queue = itertools.islice(tasks, queue_size)
-    for task in task_queue:
-        _LOG.info('Running task: %s', describe_task(task))
-        results.append(executor.submit(run_task, task=task))
-
-        _LOG.debug('Task queue filled, waiting for first result...')
+    # Submission time (monotonic and wall clock) and task count of each result
+    submitted = {}  # type: Dict[int, Tuple[float, float, int]]
+
+    if on_task_measured is not None:
+        run_task = MeasuredTask(run_task)
+
+    if batch_size and batch_size > 1:
+        if shared_dir is None:
+            shared_dir = tempfile.mkdtemp(prefix='dea-run-tasks-')
+            atexit.register(shutil.rmtree, shared_dir, True)
+        function_path = str(SharedTaskFunction(run_task, Path(shared_dir)).path)
+
+        def submit_next():
+            batch = list(itertools.islice(tasks, batch_size))
+            if not batch:
+                return None
+            _LOG.info('Running %d tasks: %s...', len(batch), describe_task(batch[0]))
+            return executor.submit(run_task_batch, function_path=function_path, tasks=batch), len(batch)
+    else:
+        def submit_next():
+            task = next(tasks, None)
+            if task is None:
+                return None
+            _LOG.info('Running task: %s', describe_task(task))
+            return executor.submit(run_task, task=task), 1
+
+    def fill_queue():
+        limit = window.size if window else queue_size
+        while sum(count for _, _, count in submitted.values()) < limit:
+            next_submission = submit_next()
+            if next_submission is None:
+                return
+            result, task_count = next_submission
+            submitted[id(result)] = (time.monotonic(), time.time(), task_count)
+            results.append(result)
+
+    fill_queue()
+    _LOG.debug('Task queue filled, waiting for first result...')
 
     successful = failed = 0
+
+    def process(actual_result, submitted_at):
+        nonlocal successful, failed
+        if isinstance(actual_result, TaskMeasurement):
+            try:
+                on_task_measured(actual_result._replace(submitted=submitted_at))
+            except Exception as err:  # pylint: disable=broad-except
+                _LOG.exception('Recording task measurement failed: %s', err)
+            actual_result = actual_result.result
+        try:
+            if isinstance(actual_result, TaskFailure):
+                _LOG.error('Task failed: %s\n%s', actual_result.error, actual_result.traceback)
+                failed += 1
+                return
+            if result_processor is not None:
+                # Counted once processed.
+                result_processor.submit(actual_result)
+                return
+            if process_result is not None:
+                process_result(actual_result)
+            successful += 1
+        except Exception as err:  # pylint: disable=broad-except
+            _LOG.exception('Task failed: %s', err)
+            failed += 1
+
+    last_metrics_log = time.monotonic()
     while results:
         result, results = executor.next_completed(results, None)
 
-        # submit a new _task to replace the one we just finished
-        task = next(tasks, None)
-        if task:
-            _LOG.info('Running _task: %s', describe_task(task))
-            results.append(executor.submit(run_task, task=task))
+        completed_time = time.monotonic()
+        started_time, submitted_at, task_count = submitted.pop(id(result), (completed_time, None, 1))
+        if window:
+            window.task_completed(completed_time - started_time,
+                                  now=completed_time,
+                                  in_flight=sum(count for _, _, count in submitted.values()))
+            if completed_time - last_metrics_log > QUEUE_METRICS_INTERVAL_SECS:
+                _LOG.info('Task queue: %s', window.metrics(len(results)))
+                last_metrics_log = completed_time
+
+        # submit new tasks to replace the one we just finished
+        fill_queue()
 
         # Process the result
         try:
             actual_result = executor.result(result)
-            if process_result is not None:
-                process_result(actual_result)
-            successful += 1
+        except TaskFailedError as err:
+            # Failed tasks that were still measured, or a batch containing failures.
+            actual_result = err.result
         except Exception as err:  # pylint: disable=broad-except
             _LOG.exception('Task failed: %s', err)
-            failed += 1
+            failed += task_count
+            executor.release(result)
             continue
+
+        try:
+            if batch_size and batch_size > 1:
+                for batch_result in actual_result:
+                    process(batch_result, submitted_at)
+            else:
+                process(actual_result, submitted_at)
         finally:
             # Release the _task to free memory so there is no leak in executor/scheduler/worker process
             executor.release(result)
 
+    if result_processor is not None:
+        processed, processing_failed = result_processor.close()
+        successful += processed
+        failed += processing_failed
+
     _LOG.info('%d successful, %d failed', successful, failed)
+    if window:
+        _LOG.info('Task queue: %s', window.metrics(0))
     return successful, failed
 
 
@@ -525,7 +1403,14 @@ class TaskRunner(object):
         self._shutdown = None
         self._queue_size = None
         self._user_queue_size = None
+        self._adaptive_queue = False
         self._workers_per_node = None
+        self._warm_workers = False
+        self._max_rss_mb = None
+        self._batch_size = None
+        self._result_workers = None
+        self._result_batch_size = 1
+        self._measure_tasks = False
 
     def __repr__(self):
         args = '' if self._opts is None else '-{}'.format(str(self._opts))
@@ -534,43 +1419,92 @@ class TaskRunner(object):
     def set_qsize(self, qsize):
         self._user_queue_size = qsize
 
+    def set_adaptive_queue(self, value):
+        """Adapt the queue size to how quickly tasks complete (see AdaptiveQueueSize), unless a size is set."""
+        self._adaptive_queue = value
+
     def set_workers_per_node(self, value):
         self._workers_per_node = value
 
+    def set_warm_workers(self, value):
+        """Start each node's celery workers from one process that has already imported them. (see warm_worker)"""
+        self._warm_workers = value
+
+    def set_batch_size(self, value):
+        """Send tasks to workers in batches of this many."""
+        self._batch_size = value
+
+    def set_result_workers(self, value):
+        """Process task results on this many background threads, rather than between tasks."""
+        self._result_workers = value
+
+    def set_result_batch_size(self, value):
+        """Give up to this many results at once to a batch result handler."""
+        self._result_batch_size = value
+
+    def set_measure_tasks(self, value):
+        """Record the times and resources of each task as events. (see MeasuredTask)"""
+        self._measure_tasks = value
+
+    def set_max_rss_mb(self, value):
+        """Shrink an adaptive task queue when the head process uses more memory than this."""
+        self._max_rss_mb = value
+
+    def needs_work_directory(self) -> bool:
+        """
+        Does this runner need a TaskDescription with a work directory: for its logs and events, or to share
+        batched task functions with workers on other nodes?
+        """
+        if self._kind == 'pbs_celery' or self._measure_tasks:
+            return True
+        return bool(self._batch_size) and self._kind in ('celery', 'dask')
+
+    def queue_metrics(self) -> Optional[QueueMetrics]:
+        """The current state of an adaptive task queue, or None if it's a fixed size."""
+        if isinstance(self._queue_size, AdaptiveQueueSize):
+            return self._queue_size.metrics(in_flight=0)
+        return None
+
     def start(self, task_desc: TaskDescription = None):
         def noop():
             pass
 
         def mk_pbs_celery(task_desc: TaskDescription):
+            # Celery and redis are only imported when they're used.
+            from .runners import celery_environment
+
             qsize = pbs.preferred_queue_size()
+            workers = sum(n.num_cores if self._workers_per_node is None else min(n.num_cores, self._workers_per_node)
+                          for n in pbs.nodes())
             port = 6379  # TODO: randomise
             maxmemory = "4096mb"  # TODO: compute maxmemory from qsize
             executor, shutdown = celery_environment.launch_celery_worker_environment(
                 task_desc=task_desc,
                 redis_params=dict(port=port, maxmemory=maxmemory),
-                workers_per_node=self._workers_per_node
+                workers_per_node=self._workers_per_node,
+                warm_start=self._warm_workers,
             )
-            return (executor, qsize, shutdown)
+            return (executor, qsize, workers, shutdown)
 
         def mk_dask(task_desc: TaskDescription):
             qsize = 100
             executor = _get_distributed_executor(self._opts)
-            return (executor, qsize, noop)
+            return (executor, qsize, None, noop)
 
         def mk_celery(task_desc: TaskDescription):
             qsize = 100
             executor = mk_celery_executor(*self._opts)
-            return (executor, qsize, noop)
+            return (executor, qsize, None, noop)
 
         def mk_multiproc(task_desc: TaskDescription):
             qsize = 100
             executor = _get_concurrent_executor(self._opts)
-            return (executor, qsize, noop)
+            return (executor, qsize, self._opts, noop)
 
         def mk_serial(task_desc: TaskDescription):
             qsize = 10
             executor = SerialExecutor()
-            return (executor, qsize, noop)
+            return (executor, qsize, 1, noop)
 
         mk = dict(pbs_celery=mk_pbs_celery,
                   celery=mk_celery,
@@ -581,6 +1515,7 @@ class TaskRunner(object):
         try:
             (self._executor,
              default_queue_size,
+             workers,
              self._shutdown) = mk.get(self._kind, mk_serial)(task_desc)
         except RuntimeError:
             _LOG.exception("Error starting executor")
@@ -588,6 +1523,9 @@ class TaskRunner(object):
 
         if self._user_queue_size is not None:
             self._queue_size = self._user_queue_size
+        elif self._adaptive_queue:
+            # Start from the executor's default, and adapt to how quickly the workers get through tasks.
+            self._queue_size = AdaptiveQueueSize(default_queue_size, workers=workers, max_rss_mb=self._max_rss_mb)
         else:
             self._queue_size = default_queue_size
 
@@ -598,12 +1536,52 @@ class TaskRunner(object):
             self._queue_size = None
             self._shutdown = None
 
-    def __call__(self, task_desc: TaskDescription, tasks, run_task, on_task_complete=None):
+    def __call__(self, task_desc: TaskDescription, tasks, run_task, on_task_complete=None, on_batch_complete=None):
+        """
+        Run the tasks, calling on_task_complete with each result.
+
+        on_batch_complete, if given, takes a list of results instead: used when results are processed in the
+        background (see set_result_workers), so that they can be written together. Otherwise it's given each
+        result alone. It may raise BatchProcessingError when only some of them failed.
+
+        Neither is called from more than one thread at a time.
+        """
         if self._executor is None:
             if self.start(task_desc) is False:
                 raise RuntimeError('Failed to launch worker pool')
 
-        return run_tasks(tasks, self._executor, run_task, on_task_complete, self._queue_size)
+        shared_dir = None
+        if task_desc is not None and task_desc.jobs_path is not None:
+            # The work directory is on a filesystem shared by all of the job's nodes.
+            shared_dir = task_desc.jobs_path.parent.joinpath('shared')
+
+        if on_task_complete is None and on_batch_complete is not None:
+            def on_task_complete(result):
+                on_batch_complete([result])
+
+        result_processor = None
+        if self._result_workers and on_task_complete:
+            result_processor = ResultProcessor(on_task_complete, on_batch_complete,
+                                               workers=self._result_workers,
+                                               batch_size=self._result_batch_size)
+
+        if not (self._measure_tasks and task_desc is not None and task_desc.events_path is not None):
+            return run_tasks(tasks, self._executor, run_task, on_task_complete, self._queue_size,
+                             batch_size=self._batch_size, shared_dir=shared_dir,
+                             result_processor=result_processor)
+
+        events_path = task_desc.events_path.joinpath(
+            '{}-{}-task-measurements.jsonl'.format(int(time.time()), pbs.hostname())
+        )
+        _LOG.info('Recording task measurements to %s', events_path)
+        with serialise.JsonLinesWriter(events_path.open('a'),
+                                       buffer_size=64 * 1024,
+                                       flush_interval=5,
+                                       fast_json=True) as events:
+            return run_tasks(tasks, self._executor, run_task, on_task_complete, self._queue_size,
+                             batch_size=self._batch_size, shared_dir=shared_dir,
+                             result_processor=result_processor,
+                             on_task_measured=lambda m: events.write_item(m.task_event(task_desc)))
 
 
 def get_current_obj(ctx=None):
@@ -621,6 +1599,13 @@ class QsubRunState:
         self.qsub: QSubLauncher = None
         self.qsize: int = None
         self.workers_per_node: int = None
+        self.max_rss_mb: int = None
+        self.batch_size: int = None
+        self.result_workers: int = None
+        self.result_batch_size: int = None
+        self.measure_tasks: bool = False
+        self.adaptive_queue: bool = False
+        self.warm_workers: bool = False
 
 
 def with_qsub_runner():
@@ -631,6 +1616,14 @@ def with_qsub_runner():
     --dask 'host:port'
     --celery 'host:port'|'pbs-launch'
     --queue-size <int>
+    --adaptive-queue
+    --workers-per-node <int>
+    --warm-workers
+    --queue-max-memory <int>
+    --task-batch-size <int>
+    --result-workers <int>
+    --result-batch-size <int>
+    --measure-tasks
     --qsub <qsub-params>
 
     Will populate variables
@@ -670,11 +1663,40 @@ def with_qsub_runner():
             return
         state(ctx).qsize = value
 
+    def set_adaptive_queue(ctx, param, value):
+        state(ctx).adaptive_queue = value
+
     def set_workers_per_node(ctx, param, value):
         if value is None:
             return
         state(ctx).workers_per_node = value
 
+    def set_warm_workers(ctx, param, value):
+        state(ctx).warm_workers = value
+
+    def set_max_rss(ctx, param, value):
+        if value is None:
+            return
+        state(ctx).max_rss_mb = value
+
+    def set_batch_size(ctx, param, value):
+        if value is None:
+            return
+        state(ctx).batch_size = value
+
+    def set_result_workers(ctx, param, value):
+        if value is None:
+            return
+        state(ctx).result_workers = value
+
+    def set_result_batch_size(ctx, param, value):
+        if value is None:
+            return
+        state(ctx).result_batch_size = value
+
+    def set_measure_tasks(ctx, param, value):
+        state(ctx).measure_tasks = value
+
     def capture_qsub(ctx, param, value):
         if value is None:
             return None
@@ -710,11 +1732,48 @@ def with_qsub_runner():
                          help='Overwrite defaults for queue size',
                          expose_value=False,
                          callback=add_qsize),
+            click.option('--adaptive-queue',
+                         is_flag=True,
+                         expose_value=False,
+                         callback=set_adaptive_queue,
+                         help='Adapt the queue size to how quickly tasks complete (unless --queue-size is given)'),
             click.option('--workers-per-node',
                          type=int,
                          expose_value=False,
                          callback=set_workers_per_node,
                          help='For code that parallelizes over cores'),
+            click.option('--warm-workers',
+                         is_flag=True,
+                         expose_value=False,
+                         callback=set_warm_workers,
+                         help="With --celery pbs-launch, fork each node's workers after importing them once"),
+            click.option('--queue-max-memory',
+                         type=int,
+                         expose_value=False,
+                         callback=set_max_rss,
+                         help='With --adaptive-queue, shrink the queue when the main process uses more than '
+                              'this memory (MB)'),
+            click.option('--task-batch-size',
+                         type=click.IntRange(1),
+                         expose_value=False,
+                         callback=set_batch_size,
+                         help='Send tasks to workers in batches of this many'),
+            click.option('--result-workers',
+                         type=click.IntRange(1),
+                         expose_value=False,
+                         callback=set_result_workers,
+                         help='Process task results (eg. index writes) on this many background threads. '
+                              'Their handlers still run one batch at a time'),
+            click.option('--result-batch-size',
+                         type=click.IntRange(1),
+                         expose_value=False,
+                         callback=set_result_batch_size,
+                         help='Process up to this many task results at once, with --result-workers'),
+            click.option('--measure-tasks',
+                         is_flag=True,
+                         expose_value=False,
+                         callback=set_measure_tasks,
+                         help="Record each task's times, node, peak memory and bytes read/written as events"),
             click.option('--qsub',
                          type=QSubParamType(),
                          callback=capture_qsub,
@@ -738,6 +1797,12 @@ def with_qsub_runner():
             if s.qsub is not None and s.qsize is not None:
                 s.qsub.add_internal_args('--queue-size', s.qsize)
 
+            if s.qsub is not None and s.adaptive_queue:
+                s.qsub.add_internal_args('--adaptive-queue')
+
+            if s.runner is not None and s.adaptive_queue:
+                s.runner.set_adaptive_queue(s.adaptive_queue)
+
             if s.qsub is not None and s.workers_per_node is not None:
                 s.qsub.add_internal_args('--workers-per-node',
                                          str(s.workers_per_node))
@@ -745,6 +1810,42 @@ def with_qsub_runner():
             if s.runner is not None and s.workers_per_node is not None:
                 s.runner.set_workers_per_node(s.workers_per_node)
 
+            if s.qsub is not None and s.warm_workers:
+                s.qsub.add_internal_args('--warm-workers')
+
+            if s.runner is not None and s.warm_workers:
+                s.runner.set_warm_workers(s.warm_workers)
+
+            if s.qsub is not None and s.max_rss_mb is not None:
+                s.qsub.add_internal_args('--queue-max-memory', str(s.max_rss_mb))
+
+            if s.runner is not None and s.max_rss_mb is not None:
+                s.runner.set_max_rss_mb(s.max_rss_mb)
+
+            if s.qsub is not None and s.batch_size is not None:
+                s.qsub.add_internal_args('--task-batch-size', str(s.batch_size))
+
+            if s.runner is not None and s.batch_size is not None:
+                s.runner.set_batch_size(s.batch_size)
+
+            if s.qsub is not None and s.result_workers is not None:
+                s.qsub.add_internal_args('--result-workers', str(s.result_workers))
+
+            if s.runner is not None and s.result_workers is not None:
+                s.runner.set_result_workers(s.result_workers)
+
+            if s.qsub is not None and s.result_batch_size is not None:
+                s.qsub.add_internal_args('--result-batch-size', str(s.result_batch_size))
+
+            if s.runner is not None and s.result_batch_size is not None:
+                s.runner.set_result_batch_size(s.result_batch_size)
+
+            if s.qsub is not None and s.measure_tasks:
+                s.qsub.add_internal_args('--measure-tasks')
+
+            if s.runner is not None and s.measure_tasks:
+                s.runner.set_measure_tasks(s.measure_tasks)
+
         def extract_runner(*args, **kwargs):
             finalise_state()
             kwargs.update({arg_name: state().runner})
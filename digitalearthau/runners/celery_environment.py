@@ -15,9 +15,12 @@ import subprocess
 from celery.events import EventReceiver
 from dateutil import tz
 from multiprocessing import Process
-from typing import Optional, List, Iterable
+from pathlib import Path
+from typing import Callable, Counter, Dict, Iterable, List, Optional, Tuple
 
 from datacube import _celery_runner as cr
+from datacube.api.grid_workflow import Tile
+from datacube.model import Dataset
 from digitalearthau import serialise, pbs
 
 from digitalearthau.events import Status, TaskEvent, NodeMessage
@@ -48,6 +51,25 @@ _EXAMPLE_TASK_KWARGS = "{'task': {'nbar': Tile<sources=<xarray.DataArray (time:
                        "'filename': '/g/data/fk4/datacube/002/LS8_OLI_FC/-11_-28/LS8_OLI_FC_3577_-11_-28_" \
                        "20150131015103000000_v1507076205.nc'}}"
 
+# Run on each node to start its celery workers.
+WORKER_MODULE = 'datacube_apps.worker'
+# Starts the worker module from an interpreter with the heavy modules already imported.
+WARM_WORKER_MODULE = 'digitalearthau.runners.warm_worker'
+
+# Task events are written out in batches: whichever of these is reached first.
+EVENT_BUFFER_BYTES = 64 * 1024
+EVENT_FLUSH_SECONDS = 5
+
+# How often the logger reports the count of tasks in each state.
+STATE_SUMMARY_SECONDS = 60
+# Far more than any queue of tasks we submit. (Older tasks are dropped from the celery State beyond this.)
+MAX_TASKS_IN_FLIGHT = 100000
+# How many finished tasks to remember, to ignore their late events. (eg. from a node with a skewed clock)
+FINISHED_TASK_MEMORY = 100000
+
+# Prefixes the task kwargs sent by DatasetHeaderCeleryExecutor, in place of their repr()
+INPUT_DATASETS_HEADER = 'input_datasets='
+
 TASK_ID_RE_EXTRACT = re.compile('Dataset <id=([a-z0-9-]{36}) ')
 
 
@@ -67,11 +89,82 @@ def _extract_task_args_dataset_id(kwargs: str) -> Optional[uuid.UUID]:
     return uuid.UUID(m.group(1))
 
 
-def _get_task_input_dataset_id(task: celery_state.Task) -> Optional[uuid.UUID]:
+def task_input_dataset_ids(task, max_depth=4) -> Tuple[uuid.UUID, ...]:
+    """
+    The ids of a task's input datasets: the Datasets within it, and within the sources of its Tiles.
+
+    >>> task_input_dataset_ids({'tile_index': (-11, -28), 'filename': 'LS8_OLI_FC_3577_-11_-28.nc'})
+    ()
+    """
+    ids = collections.OrderedDict()  # type: collections.OrderedDict[uuid.UUID, None]
+
+    def visit(o, depth):
+        if isinstance(o, Dataset):
+            ids[o.id] = None
+        elif isinstance(o, Tile):
+            # A tuple of datasets for each time
+            for datasets in o.sources.values.ravel():
+                ids.update((dataset.id, None) for dataset in datasets)
+        elif isinstance(o, dict) and depth < max_depth:
+            for item in o.values():
+                visit(item, depth + 1)
+        elif isinstance(o, (list, tuple, set)) and depth < max_depth:
+            for item in o:
+                visit(item, depth + 1)
+
+    visit(task, 0)
+    return tuple(ids)
+
+
+def _input_datasets_header(dataset_ids: Iterable[uuid.UUID]) -> str:
+    """
+    A compact description of a task's input datasets, sent in place of celery's repr() of the task arguments
+
+    >>> _input_datasets_header([uuid.UUID('d514c26a-d98f-47f1-b0de-15f7fe78c209')])
+    'input_datasets=d514c26a-d98f-47f1-b0de-15f7fe78c209'
+    """
+    return INPUT_DATASETS_HEADER + ','.join(str(dataset_id) for dataset_id in dataset_ids)
+
+
+def _get_task_input_dataset_ids(task: celery_state.Task) -> Optional[Tuple[uuid.UUID, ...]]:
+    """
+    Get the input dataset ids, if known, for the given celery task
+    """
+    kwargs: str = task.kwargs
+    if not kwargs:
+        return None
+
+    if kwargs.startswith(INPUT_DATASETS_HEADER):
+        ids = kwargs[len(INPUT_DATASETS_HEADER):]
+        return tuple(uuid.UUID(dataset_id) for dataset_id in ids.split(',')) if ids else None
+
+    # Submitted without the header: search the repr() of its arguments.
+    dataset_id = _extract_task_args_dataset_id(kwargs)
+    return (dataset_id,) if dataset_id else None
+
+
+class DatasetHeaderCeleryExecutor(cr.CeleryExecutor):
     """
-    Get the input dataset id, if known, for the given celery task
+    A CeleryExecutor that describes each task by the ids of its input datasets.
+
+    Celery otherwise sends a repr() of the task arguments, which includes every source and geobox of
+    a tile, and which the event logger would have to search on every state change of the task.
     """
-    return _extract_task_args_dataset_id(task.kwargs)
+
+    def submit(self, func, *args, **kwargs):
+        # As submitted by qsub.run_tasks: one task, or a batch of them.
+        if 'task' in kwargs:
+            tasks = [kwargs['task']]
+        elif 'tasks' in kwargs:
+            tasks = kwargs['tasks']
+        else:
+            return super().submit(func, *args, **kwargs)
+
+        dataset_ids = collections.OrderedDict.fromkeys(
+            dataset_id for task in tasks for dataset_id in task_input_dataset_ids(task)
+        )
+        return cr.run_function.apply_async(args=(func,) + args, kwargs=kwargs,
+                                           kwargsrepr=_input_datasets_header(dataset_ids))
 
 
 # Map celery states to our states
@@ -110,7 +203,7 @@ def _celery_event_to_task(task_desc: TaskDescription,
         message = celery_task.traceback
 
     celery_worker: celery_state.Worker = celery_task.worker
-    dataset_id = _get_task_input_dataset_id(celery_task)
+    dataset_ids = _get_task_input_dataset_ids(celery_task)
     return TaskEvent(
         timestamp=_utc_datetime(celery_task.timestamp) if celery_task.timestamp else datetime.datetime.utcnow(),
         event=f"task.{status.name.lower()}",
@@ -121,7 +214,7 @@ def _celery_event_to_task(task_desc: TaskDescription,
         parent_id=pbs.current_job_task_id(),
         job_parameters=task_desc.parameters,
         message=message,
-        input_datasets=(dataset_id,) if dataset_id else None,
+        input_datasets=dataset_ids,
         output_datasets=None,
         node=NodeMessage(
             hostname=_just_the_hostname(celery_worker.hostname),
@@ -140,7 +233,8 @@ def _run_celery_task_logging(
     """
 
     _LOG.info("Logger process started")
-    state: celery_state.State = app.events.State()
+    # Finished tasks are evicted as they're recorded, so this only needs to hold the tasks in flight.
+    state: celery_state.State = app.events.State(max_tasks_in_memory=MAX_TASKS_IN_FLIGHT)
 
     # TODO: handling immature shutdown cleanly? The celery runner itself might need better support for it...
 
@@ -149,34 +243,21 @@ def _run_celery_task_logging(
     signal.signal(signal.SIGINT, signal.SIG_IGN)
     signal.signal(signal.SIGTERM, signal.SIG_IGN)
 
-    def handle_task(event):
-
-        state.event(event)
-
-        event_type: str = event['type']
-
-        if not event_type.startswith('task-'):
-            _LOG.debug("Skipping event %r", event_type)
-            return
-
-        # task name is sent only with -received event, and state
-        # will keep track of this for us.
-        task: celery_state.Task = state.tasks.get(event['uuid'])
-
-        if not task:
-            _LOG.warning(f"No task found {event_type}")
-            return
-        output.write_item(_celery_event_to_task(task_desc, task))
-        _log_task_states(state)
-
     timestamp = datetime.datetime.utcnow().timestamp()
     events_path = task_desc.events_path.joinpath(f'{int(timestamp)}-{socket.gethostname()}-collected-events.jsonl')
 
-    with serialise.JsonLinesWriter(events_path.open('a')) as output:
+    with serialise.JsonLinesWriter(events_path.open('a'),
+                                   buffer_size=EVENT_BUFFER_BYTES,
+                                   flush_interval=EVENT_FLUSH_SECONDS,
+                                   fast_json=True) as output:
+        # The signals are still ignored, but events received so far are saved.
+        output.sync_on_signals(signal.SIGINT, signal.SIGTERM)
+        recorder = _TaskEventRecorder(state, task_desc, output.write_item)
+
         with app.connection() as connection:
 
             recv: EventReceiver = app.events.Receiver(connection, handlers={
-                '*': handle_task,
+                '*': recorder.handle_event,
             })
 
             shutdown_received = None
@@ -188,6 +269,8 @@ def _run_celery_task_logging(
                         pass
                 except socket.timeout:
                     pass
+                output.flush_if_due()
+                recorder.log_summary_if_due()
 
                 # We get a signal from the main process when it has terminated all workers, but there may still be
                 # events to consume.
@@ -206,7 +289,7 @@ def _run_celery_task_logging(
 
             _LOG.info("Celery event subscription finished")
 
-    _log_task_states(state)
+    recorder.log_summary()
 
     # According to our recorded state we should have seen all workers stop.
     workers: List[celery_state.Worker] = list(state.workers.values())
@@ -224,11 +307,86 @@ def _run_celery_task_logging(
     _LOG.info("Logger process exiting")
 
 
-def _log_task_states(state):
-    # Print count of tasks in each state.
-    tasks: Iterable[celery_state.Task] = state.tasks.values()
-    task_states = collections.Counter(t.state for t in tasks)
-    _LOG.info("Task states: %s", ", ".join(f"{v} {k}" for (k, v) in task_states.items()))
+class _TaskEventRecorder:
+    """
+    Record each task state change from the celery events, keeping a running count of tasks in each state.
+
+    Tasks are evicted from the celery State once their final event is recorded, so memory use follows the
+    number of tasks in flight rather than the length of the run.
+    """
+
+    def __init__(self,
+                 state: celery_state.State,
+                 task_desc: TaskDescription,
+                 write: Callable[[TaskEvent], None],
+                 summary_interval: float = STATE_SUMMARY_SECONDS) -> None:
+        self.state = state
+        self.task_desc = task_desc
+        self._write = write
+        self.summary_interval = summary_interval
+
+        # The count of tasks in each celery state. Finished tasks stay counted after they're evicted.
+        self.counts = collections.Counter()  # type: Counter[str]
+        # The current state of each unfinished task.
+        self._task_states = {}  # type: Dict[str, str]
+        # Recently finished tasks, to ignore any events that arrive after their final one.
+        self._finished = collections.OrderedDict()  # type: collections.OrderedDict[str, None]
+        self._last_summary = time()
+
+    def handle_event(self, event: dict):
+        task_id = event.get('uuid')
+        if task_id is not None and task_id in self._finished:
+            _LOG.debug("Skipping late %r event for finished task %s", event['type'], task_id)
+            return
+
+        self.state.event(event)
+
+        event_type: str = event['type']
+        if not event_type.startswith('task-'):
+            _LOG.debug("Skipping event %r", event_type)
+            return
+
+        # task name is sent only with -received event, and state
+        # will keep track of this for us.
+        task: celery_state.Task = self.state.tasks.get(task_id)
+        if not task:
+            _LOG.warning(f"No task found {event_type}")
+            return
+
+        self._count(task_id, task.state)
+        self._write(_celery_event_to_task(self.task_desc, task))
+
+        if task.state in celery.states.READY_STATES:
+            self._evict(task_id)
+
+        self.log_summary_if_due()
+
+    def _count(self, task_id: str, new_state: str):
+        previous_state = self._task_states.get(task_id)
+        if previous_state == new_state:
+            return
+        if previous_state is not None:
+            self.counts[previous_state] -= 1
+            if not self.counts[previous_state]:
+                del self.counts[previous_state]
+        self.counts[new_state] += 1
+        self._task_states[task_id] = new_state
+
+    def _evict(self, task_id: str):
+        del self._task_states[task_id]
+        self.state.tasks.pop(task_id, None)
+
+        self._finished[task_id] = None
+        if len(self._finished) > FINISHED_TASK_MEMORY:
+            self._finished.popitem(last=False)
+
+    def log_summary_if_due(self):
+        if time() - self._last_summary >= self.summary_interval:
+            self.log_summary()
+
+    def log_summary(self):
+        self._last_summary = time()
+        _LOG.info("Task states: %s", ", ".join(f"{v} {k}" for (k, v) in self.counts.items()))
 
 
 def _utc_datetime(timestamp: float):
@@ -262,7 +420,16 @@ def _just_the_hostname(hostname: str):
 
 def launch_celery_worker_environment(task_desc: TaskDescription,
                                      redis_params: dict,
-                                     workers_per_node: int = None):
+                                     workers_per_node: int = None,
+                                     worker_module: str = WORKER_MODULE,
+                                     warm_start: bool = False,
+                                     import_profile: bool = False):
+    """
+    Launch Redis, the event logger and the celery workers of every node in the PBS job.
+
+    :param warm_start: Import the heavy modules once per node before forking its workers (see warm_worker)
+    :param import_profile: Write a report of each node's import times to the job's logs folder.
+    """
     redis_port = redis_params['port']
     redis_host = pbs.hostname()
     redis_password = cr.get_redis_password(generate_if_missing=True)
@@ -277,7 +444,7 @@ def launch_celery_worker_environment(task_desc: TaskDescription,
         if cr.check_redis(redis_host, redis_port, redis_password) is False:
             sleep(0.5)
 
-    executor = cr.CeleryExecutor(
+    executor = DatasetHeaderCeleryExecutor(
         redis_host,
         redis_port,
         password=redis_password,
@@ -292,7 +459,10 @@ def launch_celery_worker_environment(task_desc: TaskDescription,
 
     worker_procs = list(_spawn_pbs_workers(redis_host,
                                            redis_port,
-                                           workers_per_node))
+                                           workers_per_node,
+                                           worker_module,
+                                           warm_start=warm_start,
+                                           import_profile_path=task_desc.logs_path if import_profile else None))
 
     _LOG.info('%d workers launched.', len(worker_procs))
 
@@ -320,9 +490,35 @@ def launch_celery_worker_environment(task_desc: TaskDescription,
     return executor, shutdown
 
 
+def _worker_python_args(worker_module: str,
+                        worker_args: str,
+                        warm_start: bool = False,
+                        import_profile_file: Path = None) -> str:
+    """
+    The python arguments to start a node's workers.
+
+    >>> _worker_python_args('worker', '--nprocs 4')
+    '-m worker --nprocs 4'
+    >>> _worker_python_args('worker', '--nprocs 4', warm_start=True)
+    '-m digitalearthau.runners.warm_worker --worker-module worker -- --nprocs 4'
+    >>> _worker_python_args('worker', '--nprocs 4', warm_start=True, import_profile_file=Path('p.txt')).split(' -m ')
+    ['-X importtime', 'digitalearthau.runners.warm_worker --worker-module worker --import-profile p.txt -- --nprocs 4']
+    """
+    if not warm_start:
+        return f'-m {worker_module} {worker_args}'
+
+    launcher_args = f'-m {WARM_WORKER_MODULE} --worker-module {worker_module}'
+    if import_profile_file is not None:
+        launcher_args = f'-X importtime {launcher_args} --import-profile {import_profile_file}'
+    return f'{launcher_args} -- {worker_args}'
+
+
 def _spawn_pbs_workers(redis_host: str,
                        redis_port: str,
-                       workers_per_node: int = None) -> Iterable[subprocess.Popen]:
+                       workers_per_node: int = None,
+                       worker_module: str = WORKER_MODULE,
+                       warm_start: bool = False,
+                       import_profile_path: Path = None) -> Iterable[subprocess.Popen]:
     worker_env = pbs.get_env()
 
     _LOG.info('Launching PBS workers.')
@@ -337,11 +533,18 @@ def _spawn_pbs_workers(redis_host: str,
         if workers_per_node is not None:
             nprocs = min(workers_per_node, nprocs)
 
-        _LOG.info(f'datacube_apps.worker --executor celery {redis_host}:{redis_port} --nprocs {nprocs}')
+        import_profile_file = None
+        if import_profile_path is not None:
+            import_profile_file = import_profile_path.joinpath(f'import-profile-{node.name}.txt')
+        python_args = _worker_python_args(worker_module,
+                                          f'--executor celery {redis_host}:{redis_port} --nprocs {nprocs}',
+                                          warm_start=warm_start,
+                                          import_profile_file=import_profile_file)
+        _LOG.info(f'python {python_args}')
 
         proc = pbs.pbsdsh(
             node.offset,
-            f'exec python -m datacube_apps.worker --executor celery {redis_host}:{redis_port} --nprocs {nprocs}',
+            f'exec python {python_args}',
             env=worker_env
         )
         _LOG.info(f"Started node {node.offset} named {node.name} (pbsdsh pid {proc.pid})")
@@ -0,0 +1,150 @@
+"""
+Run the pbs_celery runner on one machine, with emulated PBS nodes, to measure its overheads.
+
+The full `celery_environment.launch_celery_worker_environment()` path is run: a Redis server is
+launched, the event logger process is started, and each "node" from the emulated node file starts
+its own celery workers (via a local pbsdsh). Real worker processes run trivial tasks, so the timings
+are of the runner itself: start-up, scheduling and event logging.
+
+A `redis-server` executable must be on the PATH (a Redis, or any compatible server, stands in for
+the one launched on the main node of a job).
+"""
+import datetime
+import logging
+import shutil
+import socket
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+from dateutil import tz
+
+from digitalearthau import pbs
+from digitalearthau.qsub import run_tasks
+from digitalearthau.runners import celery_environment
+from digitalearthau.runners.model import DefaultJobParameters, TaskDescription
+
+_LOG = logging.getLogger(__name__)
+
+
+class RunnerTimings(NamedTuple):
+    node_count: int
+    task_count: int
+    successful: int
+    failed: int
+    # Launching Redis, the event logger and the node workers.
+    startup_seconds: float
+    # From launch until the first task result: how long before workers are taking tasks.
+    first_result_seconds: float
+    # From launch until the last task result.
+    run_seconds: float
+    tasks_per_second: float
+    # Stopping workers, and waiting for the logger to record their last events.
+    shutdown_seconds: float
+    event_count: int
+    events_per_second: float
+
+
+def sleep_task(task: float) -> float:
+    """
+    A task that only takes time: run by the workers, so it needs to be importable by them.
+    """
+    time.sleep(task)
+    return task
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('', 0))
+        return s.getsockname()[1]
+
+
+def benchmark_task_description(work_path: Path) -> TaskDescription:
+    task_desc = TaskDescription(
+        type_='runner-benchmark',
+        task_dt=datetime.datetime.utcnow().replace(tzinfo=tz.tzutc()),
+        events_path=work_path.joinpath('events'),
+        logs_path=work_path.joinpath('logs'),
+        jobs_path=work_path.joinpath('jobs'),
+        parameters=DefaultJobParameters(query={}, source_products=[], output_products=[]),
+    )
+    for path in (task_desc.events_path, task_desc.logs_path, task_desc.jobs_path):
+        path.mkdir(parents=True, exist_ok=True)
+    return task_desc
+
+
+def count_events(events_path: Path) -> int:
+    count = 0
+    for path in events_path.glob('*.jsonl'):
+        with path.open('r') as f:
+            count += sum(1 for line in f if line.strip())
+    return count
+
+
+def benchmark_runner(work_path: Path,
+                     node_count: int = 2,
+                     cores_per_node: int = 4,
+                     task_count: int = 1000,
+                     task_seconds: float = 0.0,
+                     workers_per_node: int = None,
+                     worker_module: str = celery_environment.WORKER_MODULE,
+                     warm_start: bool = False,
+                     import_profile: bool = False) -> RunnerTimings:
+    """
+    Launch the pbs_celery environment on emulated nodes, run trivial tasks through it, and time each stage.
+
+    With import_profile, each node's import report is written to the logs folder of the work path.
+    """
+    if shutil.which('redis-server') is None:
+        raise RuntimeError("No redis-server found on the PATH")
+
+    task_desc = benchmark_task_description(work_path)
+    first_result = None
+
+    def record_result(_):
+        nonlocal first_result
+        if first_result is None:
+            first_result = time.monotonic()
+
+    with pbs.emulated_pbs(work_path, node_count=node_count, cores_per_node=cores_per_node):
+        start = time.monotonic()
+        executor, shutdown = celery_environment.launch_celery_worker_environment(
+            task_desc=task_desc,
+            redis_params=dict(port=free_port(), maxmemory='1024mb'),
+            workers_per_node=workers_per_node,
+            worker_module=worker_module,
+            warm_start=warm_start,
+            import_profile=import_profile,
+        )
+        launched = time.monotonic()
+        try:
+            successful, failed = run_tasks(
+                (task_seconds for _ in range(task_count)),
+                executor,
+                sleep_task,
+                process_result=record_result,
+                queue_size=pbs.preferred_queue_size(),
+            )
+            finished = time.monotonic()
+        finally:
+            shutdown_start = time.monotonic()
+            shutdown()
+            stopped = time.monotonic()
+
+    event_count = count_events(task_desc.events_path)
+    run_seconds = finished - start
+    timings = RunnerTimings(
+        node_count=node_count,
+        task_count=task_count,
+        successful=successful,
+        failed=failed,
+        startup_seconds=launched - start,
+        first_result_seconds=(first_result or finished) - start,
+        run_seconds=run_seconds,
+        tasks_per_second=task_count / (finished - launched),
+        shutdown_seconds=stopped - shutdown_start,
+        event_count=event_count,
+        events_per_second=event_count / (stopped - launched),
+    )
+    _LOG.info('Runner timings: %s', timings)
+    return timings
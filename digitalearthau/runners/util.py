@@ -72,6 +72,35 @@ def init_task_app(
     return task_desc, task_desc_path
 
 
+def init_run_directory(job_type: str, query: dict) -> TaskDescription:
+    """
+    Create a work directory for a command run on a TaskRunner (rather than the task_app framework),
+    for the runner's logs, events and shared files.
+    """
+    task_datetime = datetime.utcnow().replace(tzinfo=tz.tzutc())
+    work_path = paths.get_product_work_directory('all', time=task_datetime, task_type=job_type)
+    _LOG.info("Created work directory %s", work_path)
+
+    task_desc = TaskDescription(
+        type_=job_type,
+        task_dt=task_datetime,
+        events_path=work_path.joinpath('events'),
+        logs_path=work_path.joinpath('logs'),
+        jobs_path=work_path.joinpath('jobs'),
+        parameters=DefaultJobParameters(
+            query=query,
+            source_products=[],
+            output_products=[],
+        ),
+    )
+    task_desc.logs_path.mkdir(parents=True, exist_ok=False)
+    task_desc.events_path.mkdir(parents=True, exist_ok=False)
+    task_desc.jobs_path.mkdir(parents=True, exist_ok=False)
+
+    serialise.dump_structure(work_path.joinpath('task-description.json'), task_desc)
+    return task_desc
+
+
 def submit_subjob(
         name: str,
         task_desc: TaskDescription,
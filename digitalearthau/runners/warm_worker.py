@@ -0,0 +1,154 @@
+"""
+Start a node's celery workers from a "warm" interpreter.
+
+Each worker process would otherwise import datacube, GDAL, xarray etc. itself, from Lustre: that can take
+tens of seconds per process on a cold node. Here the heavy modules are imported once, and the worker module
+(eg. datacube_apps.worker) is then run in the same process: celery's prefork pool forks its worker
+processes from this warm parent, so they start with everything already imported.
+
+    python -m digitalearthau.runners.warm_worker -- --executor celery host:port --nprocs 46
+
+With --import-profile, a report of where the imports spent their time is written. The interpreter must
+be started with "-X importtime" for the full breakdown; otherwise only the preload total for each module
+is known.
+"""
+import importlib
+import logging
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Sequence
+
+import click
+
+_LOG = logging.getLogger(__name__)
+
+# Imported by the parent before any worker is forked. Missing modules are skipped.
+DEFAULT_PRELOAD_MODULES = (
+    'numpy',
+    'pandas',
+    'xarray',
+    'osgeo.gdal',
+    'rasterio',
+    'netCDF4',
+    'datacube',
+    'datacube.api',
+    'celery',
+)
+
+# How many of the slowest imports to show in the report.
+PROFILE_REPORT_SIZE = 30
+
+
+class ImportTiming(NamedTuple):
+    module: str
+    self_us: int
+    # Including the modules it imported.
+    cumulative_us: int
+
+
+def preload(modules: Iterable[str]) -> Dict[str, float]:
+    """
+    Import the modules, returning the seconds each took. (Zero if it was already imported.)
+    """
+    timings = {}
+    for module in modules:
+        start = time.perf_counter()
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            _LOG.warning('Not preloading %s: %s', module, e)
+            continue
+        timings[module] = time.perf_counter() - start
+    return timings
+
+
+def parse_importtime(lines: Iterable[str]) -> List[ImportTiming]:
+    """
+    Read the output of "python -X importtime". Other lines are ignored, so it can be mixed with a log.
+
+    >>> [tuple(t) for t in parse_importtime([
+    ...     'import time: self [us] | cumulative | imported package',
+    ...     'import time:       310 |        310 |   _io',
+    ...     'INFO some log line',
+    ...     'import time:      1200 |       1510 | numpy',
+    ... ])]
+    [('_io', 310, 310), ('numpy', 1200, 1510)]
+    """
+    timings = []
+    for line in lines:
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        self_us, cumulative_us, module = fields
+        timings.append(ImportTiming(module.strip(), int(self_us), int(cumulative_us)))
+    return timings
+
+
+def import_profile_report(preload_seconds: Dict[str, float],
+                          timings: Sequence[ImportTiming],
+                          top: int = PROFILE_REPORT_SIZE) -> str:
+    """
+    >>> print(import_profile_report({'numpy': 0.25}, [ImportTiming('numpy', 1200, 250000)]))
+    Preloaded in 0.25s:
+        0.250s  numpy
+    Slowest imports (self, cumulative):
+        0.001s    0.250s  numpy
+    """
+    lines = ['Preloaded in {:.2f}s:'.format(sum(preload_seconds.values()))]
+    lines.extend('    {:.3f}s  {}'.format(seconds, module)
+                 for module, seconds in sorted(preload_seconds.items(), key=lambda i: -i[1]))
+    if timings:
+        lines.append('Slowest imports (self, cumulative):')
+        lines.extend('    {:.3f}s  {:>7.3f}s  {}'.format(t.self_us / 1e6, t.cumulative_us / 1e6, t.module)
+                     for t in sorted(timings, key=lambda t: -t.self_us)[:top])
+    return '\n'.join(lines)
+
+
+def profiled_preload(modules: Iterable[str], report_path: Path) -> Dict[str, float]:
+    """
+    Preload the modules, capturing any "-X importtime" output (written to stderr) for the report.
+    """
+    with tempfile.TemporaryFile('w+') as captured:
+        sys.stderr.flush()
+        original_stderr = os.dup(2)
+        os.dup2(captured.fileno(), 2)
+        try:
+            preload_seconds = preload(modules)
+        finally:
+            sys.stderr.flush()
+            os.dup2(original_stderr, 2)
+            os.close(original_stderr)
+        captured.seek(0)
+        timings = parse_importtime(captured)
+
+    report_path.write_text(import_profile_report(preload_seconds, timings) + '\n')
+    return preload_seconds
+
+
+@click.command(context_settings=dict(ignore_unknown_options=True))
+@click.option('--worker-module', default='datacube_apps.worker', help='Module whose main() runs the workers')
+@click.option('--preload', 'preload_modules', multiple=True,
+              help='Module to import before starting workers (default: common heavy modules)')
+@click.option('--import-profile', type=click.Path(dir_okay=False), help='Write a report of import times here')
+@click.argument('worker_args', nargs=-1, type=click.UNPROCESSED)
+def main(worker_module, preload_modules, import_profile, worker_args):
+    logging.basicConfig(level=logging.INFO)
+    modules = preload_modules or DEFAULT_PRELOAD_MODULES
+
+    if import_profile:
+        preload_seconds = profiled_preload(modules, Path(import_profile))
+    else:
+        preload_seconds = preload(modules)
+    _LOG.info('Preloaded %d modules in %.2fs', len(preload_seconds), sum(preload_seconds.values()))
+
+    worker = importlib.import_module(worker_module)
+    worker.main(args=list(worker_args), prog_name=worker_module)
+
+
+if __name__ == '__main__':
+    main()
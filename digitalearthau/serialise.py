@@ -8,15 +8,23 @@ common types (events, runner model objects)
 A lot of the previous dict-based code grew unwieldy, especially as it neutered pycharm/pylint.
 Normal classes are an option too, but they'd need their own serialization code regardless.)
 """
+import collections.abc
+import contextlib
 import enum
+import functools
+import io
 import json
+import os
 import pathlib
+import signal
+import time
+import typing
 import uuid
 
 import datetime
 import dateutil.parser
 import yaml
-from typing import Dict
+from typing import Callable, List, Union
 
 from digitalearthau import paths
 from digitalearthau.events import Status
@@ -25,19 +33,118 @@ from digitalearthau.events import Status
 class JsonLinesWriter:
     """
     Stream events (or any Namedtuple) to a file in JSON-Lines format.
+
+    By default every item is flushed as it's written. Given a buffer_size (bytes) or flush_interval (seconds),
+    lines are instead buffered until either is reached: much faster for many small items, such as task events
+    on Lustre. Buffered lines can also be written with flush(), or with flush_if_due() when idle.
+
+    The file is fsynced when closed, or by sync(). Use sync_on_signals() to also sync when signalled.
+
+    fast_json skips the key sorting and checks of to_lenient_json(): keys are written in field order.
     """
 
-    def __init__(self, file_obj) -> None:
+    def __init__(self,
+                 file_obj,
+                 buffer_size: int = None,
+                 flush_interval: float = None,
+                 fast_json: bool = False) -> None:
         self._file_obj = file_obj
+        self._buffered = buffer_size is not None or flush_interval is not None
+        self._buffer_size = buffer_size
+        self._flush_interval = flush_interval
+        self._to_json = _FAST_JSON_ENCODER.encode if fast_json else functools.partial(to_lenient_json, compact=True)
+
+        self._lines = []  # type: List[str]
+        self._pending_bytes = 0
+        self._last_flush = time.monotonic()
+        # Set when a signal arrives mid-write: the sync is done once the write finishes.
+        self._writing = False
+        self._sync_requested = False
 
     def __enter__(self):
         return self
 
     def write_item(self, item):
-        self._file_obj.write(to_lenient_json(type_to_dict(item), compact=True) + '\n')
-        self._file_obj.flush()
+        line = self._to_json(type_to_dict(item)) + '\n'
+        with self._writing_file():
+            if not self._buffered:
+                self._file_obj.write(line)
+                self._file_obj.flush()
+            else:
+                self._lines.append(line)
+                self._pending_bytes += len(line)
+                self.flush_if_due()
+
+    def flush_if_due(self):
+        """
+        Flush the buffered lines if there's enough of them, or they've waited long enough.
+        """
+        if not self._lines:
+            return
+        if (self._buffer_size is not None and self._pending_bytes >= self._buffer_size) or \
+                (self._flush_interval is not None and time.monotonic() - self._last_flush >= self._flush_interval):
+            self.flush()
+
+    def flush(self):
+        with self._writing_file():
+            if self._lines:
+                self._file_obj.write(''.join(self._lines))
+                self._lines = []
+                self._pending_bytes = 0
+            self._file_obj.flush()
+            self._last_flush = time.monotonic()
+
+    def sync(self):
+        """
+        Flush, and make sure everything written so far is on disk.
+        """
+        with self._writing_file():
+            self._sync_requested = False
+            self.flush()
+            try:
+                os.fsync(self._file_obj.fileno())
+            except (io.UnsupportedOperation, AttributeError):
+                # Not a real file (eg. StringIO)
+                pass
+
+    @contextlib.contextmanager
+    def _writing_file(self):
+        """
+        A signal handler mustn't write while we are: a sync it requests is done once the outermost write finishes.
+        """
+        if self._writing:
+            yield
+            return
+
+        self._writing = True
+        try:
+            yield
+        finally:
+            self._writing = False
+
+        if self._sync_requested:
+            self.sync()
+
+    def sync_on_signals(self, *signums):
+        """
+        Sync the file when any of the signals are received, before calling any previous handler.
+        """
+        for signum in signums:
+            previous_handler = signal.getsignal(signum)
+
+            def handle(signum, frame, previous_handler=previous_handler):
+                if self._writing:
+                    self._sync_requested = True
+                else:
+                    self.sync()
+                if callable(previous_handler):
+                    previous_handler(signum, frame)
+
+            signal.signal(signum, handle)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self._file_obj.closed:
+            self.sync()
         self._file_obj.close()
 
 
@@ -96,6 +203,14 @@ def _lenient_json_fallback(obj):
         return repr(obj)
 
 
+# Built once for JsonLinesWriter's fast path.
+_FAST_JSON_ENCODER = json.JSONEncoder(
+    default=_lenient_json_fallback,
+    separators=(', ', ':'),
+    check_circular=False,
+)
+
+
 def dump_document(path: pathlib.Path, obj, allow_unsafe=False):
     """
     Write the given object to a file (json/yaml), in readable/indented format
@@ -161,29 +276,76 @@ def simplify_obj(obj):
 
 def type_to_dict(o):
     """
-    Convert a named tuple and all of its directly-embedded named tuples to dicts/etc suitable for json/yaml
+    Convert a named tuple, and any named tuples (or other types) within it, to dicts/etc suitable for json/yaml
 
-    TODO: Doesn't handle indirectly embedded NamedTuples, such as within a list.
-    (It's currently only used for simple cases, not complex hierarchies)
+    Values are converted by their type, with a converter compiled once for each type (see _encoder())
 
     >>> type_to_dict(Status.ACTIVE)
     'active'
     >>> # More tests in test_serialise.py
     """
+    return _encoder(type(o))(o)
 
-    # We can't isinstance() for NamedTuple, the noraml way is to see if attributes like _fields exist.
-    try:
-        return dict(zip(o._fields, (type_to_dict(value) for value in o)))
-    except AttributeError:
-        return simplify_obj(o)
+
+@functools.lru_cache(maxsize=None)
+def _encoder(type_: type) -> Callable:
+    """
+    A function to convert values of the given type, as simplify_obj() would, recursing into containers.
+    """
+    # We can't issubclass() for NamedTuple, the normal way is to see if attributes like _fields exist.
+    if issubclass(type_, tuple) and hasattr(type_, '_fields'):
+        field_names = type_._fields
+
+        def encode_named_tuple(o):
+            return {name: _encoder(type(value))(value) for name, value in zip(field_names, o)}
+        return encode_named_tuple
+
+    if issubclass(type_, (list, tuple, set, frozenset)):
+        def encode_sequence(o):
+            return [_encoder(type(value))(value) for value in o]
+        return encode_sequence
+
+    if issubclass(type_, dict):
+        def encode_dict(o):
+            return {k: _encoder(type(value))(value) for k, value in o.items()}
+        return encode_dict
+
+    # Leaf values, as simplify_obj() would convert them.
+    if issubclass(type_, enum.Enum):
+        return _enum_name
+    if issubclass(type_, (str, int, float, type(None))):
+        return _identity
+    if issubclass(type_, (datetime.datetime, datetime.date)):
+        return _isoformat
+    if issubclass(type_, (pathlib.PurePath, uuid.UUID)):
+        return str
+    if hasattr(type_, 'to_dict'):
+        return _to_dict
+    return _identity
+
+
+def _identity(o):
+    return o
+
+
+def _enum_name(o: enum.Enum):
+    return o.name.lower()
+
+
+def _isoformat(o):
+    return o.isoformat()
+
+
+def _to_dict(o):
+    return o.to_dict()
 
 
 def dict_to_type(o, expected_type):
     """
     Try to parse the given dict (from json/etc) into the given NamedTuple.
 
-    TODO: Doesn't handle indirectly embedded NamedTuples, such as within a list, or Optionals/Unions/etc
-    (It's currently only used for simple cases, not complex hierarchies)
+    Fields are parsed by their type hints, including Optionals, Lists, Tuples, Sets and Dicts of types. The parser
+    is compiled once for each type (see _decoder())
 
     >>>
     >>> Status.ACTIVE == dict_to_type('active', expected_type=Status)
@@ -192,35 +354,114 @@ def dict_to_type(o, expected_type):
     Traceback (most recent call last):
     ...
     digitalearthau.serialise.SerialisationError: Unknown field EATING for Status. Expected one of ...
+    >>> dict_to_type(['4c7bfae1-2f3e-4ba2-8e59-4b1b5dc7a47e', None], typing.List[typing.Optional[uuid.UUID]])
+    [UUID('4c7bfae1-2f3e-4ba2-8e59-4b1b5dc7a47e'), None]
     >>> # More tests in test_serialise.py
     """
     if o is None:
         return None
+    return _decoder(expected_type)(o)
+
+
+@functools.lru_cache(maxsize=None)
+def _decoder(expected_type) -> Callable:
+    """
+    A function to parse values (that aren't None) into the expected type.
+    """
+    # Python 3.6's generics have the typing class as their origin (List[int].__origin__ is List),
+    # and the runtime class as their "extra".
+    origin = getattr(expected_type, '__extra__', None) or getattr(expected_type, '__origin__', None)
+    args = getattr(expected_type, '__args__', None) or ()
+
+    if origin is Union:
+        types = [t for t in args if t is not type(None)]
+        if len(types) == 1:
+            return _decoder(types[0])
+        # We can't tell which of several types it is.
+        return _identity
+
+    if origin in (list, set, frozenset, collections.abc.Sequence, collections.abc.Set):
+        item_decoder = _optional(args[0]) if args else _identity
+        container = set if origin in (set, collections.abc.Set) else origin if origin is frozenset else list
+
+        def decode_sequence(o):
+            return container(item_decoder(v) for v in o)
+        return decode_sequence
+
+    if origin is tuple:
+        if len(args) == 2 and args[1] is Ellipsis:
+            item_decoder = _optional(args[0])
+
+            def decode_tuple(o):
+                return tuple(item_decoder(v) for v in o)
+            return decode_tuple
+
+        item_decoders = [_optional(t) for t in args]
+
+        def decode_fixed_tuple(o):
+            return tuple(decode(v) for decode, v in zip(item_decoders, o))
+        return decode_fixed_tuple
+
+    if origin in (dict, collections.abc.Mapping):
+        value_decoder = _optional(args[1]) if len(args) == 2 else _identity
+
+        def decode_dict(o):
+            return {k: value_decoder(v) for k, v in o.items()}
+        return decode_dict
+
+    if not isinstance(expected_type, type):
+        # Any, TypeVars etc.
+        return _identity
 
     if expected_type in (pathlib.Path, uuid.UUID):
-        return expected_type(o)
+        return expected_type
 
     if expected_type == datetime.datetime:
-        return dateutil.parser.parse(o)
+        def decode_datetime(o):
+            # Yaml may have parsed it already.
+            if isinstance(o, datetime.datetime):
+                return o
+            # We write isoformat(), which is much quicker to read back than to parse generally.
+            try:
+                return dateutil.parser.isoparse(o)
+            except ValueError:
+                return dateutil.parser.parse(o)
+        return decode_datetime
 
     if issubclass(expected_type, enum.Enum):
-        name = str(o).upper()
-        v = expected_type.__members__.get(name)
-        if not v:
-            raise SerialisationError(f"Unknown field {name} for {expected_type.__name__}. "
-                                     f"Expected one of {', '.join(expected_type.__members__)}")
-        return v
-    try:
-        # We can't isinstance() for NamedTuple, the noraml way is to see if attributes like _fields exist.
-        # pylint: disable=protected-access
-        field_types: Dict = expected_type._field_types
-        assert isinstance(o, dict)
-        return expected_type(
-            **{k: dict_to_type(v, field_types[k]) for (k, v) in o.items()}
-        )
-    except AttributeError:
-        pass
-    return o
+        def decode_enum(o):
+            name = str(o).upper()
+            v = expected_type.__members__.get(name)
+            if not v:
+                raise SerialisationError(f"Unknown field {name} for {expected_type.__name__}. "
+                                         f"Expected one of {', '.join(expected_type.__members__)}")
+            return v
+        return decode_enum
+
+    if issubclass(expected_type, tuple) and hasattr(expected_type, '_fields'):
+        field_decoders = {name: _optional(hint) for name, hint in typing.get_type_hints(expected_type).items()}
+
+        def decode_named_tuple(o):
+            assert isinstance(o, dict)
+            try:
+                return expected_type(**{k: field_decoders[k](v) for (k, v) in o.items()})
+            except KeyError as e:
+                raise SerialisationError(f"Unknown field {e.args[0]} for {expected_type.__name__}. "
+                                         f"Expected one of {', '.join(expected_type._fields)}")
+        return decode_named_tuple
+
+    return _identity
+
+
+def _optional(expected_type) -> Callable:
+    """
+    A decoder that also allows None.
+    """
+    decoder = _decoder(expected_type)
+
+    def decode(o):
+        return None if o is None else decoder(o)
+    return decode
 
 
 class SerialisationError(Exception):
@@ -27,7 +27,6 @@ As such, it is a three step process, with the second two happening automatically
 import logging
 from datetime import datetime
 from functools import partial
-from math import ceil
 from pathlib import Path
 from typing import Tuple
 
@@ -39,9 +38,8 @@ from datacube.api.query import Query
 from datacube.index import Index
 from datacube.ui import click as ui
 from datacube.ui import task_app
-from datacube_apps.stacker import stacker
 from digitalearthau import __version__
-from digitalearthau import paths, serialise
+from digitalearthau import estimate, paths, serialise
 # pylint: disable=invalid-name
 from digitalearthau.qsub import with_qsub_runner, TaskRunner
 from digitalearthau.runners.model import TaskDescription
@@ -129,6 +127,8 @@ def make_tag(task_desc: TaskDescription):
 def generate(index: Index,
              task_desc_file: str,
              no_qsub: bool):
+    from datacube_apps.stacker import stacker
+
     config, task_desc = _make_config_and_description(index, Path(task_desc_file))
 
     num_tasks_saved = task_app.save_tasks(
@@ -142,7 +142,7 @@ def generate(index: Index,
         _LOG.info("No tasks. Finishing.")
         return
 
-    nodes, walltime = estimate_job_size(num_tasks_saved)
+    nodes, walltime = estimate_job_size(num_tasks_saved, task_desc)
     _LOG.info('Will request %d nodes and %s time', nodes, walltime)
 
     if no_qsub:
@@ -170,6 +170,8 @@ def generate(index: Index,
 
 
 def _make_config_and_description(index: Index, task_desc_path: Path) -> Tuple[dict, TaskDescription]:
+    from datacube_apps.stacker import stacker
+
     task_desc = serialise.load_structure(task_desc_path, TaskDescription)
 
     app_config = task_desc.runtime_state.config_path
@@ -185,22 +187,18 @@ def _make_config_and_description(index: Index, task_desc_path: Path) -> Tuple[di
     return config, task_desc
 
 
-def estimate_job_size(num_tasks):
+def estimate_job_size(num_tasks, task_desc: TaskDescription = None):
     """ Translate num_tasks to number of nodes and walltime
-    """
-    max_nodes = 5
-    cores_per_node = 16
-    task_time_mins = 10
 
-    if num_tasks < max_nodes * cores_per_node:
-        nodes = ceil(num_tasks / cores_per_node / 4)  # If fewer tasks than max cores, try to get 4 tasks to a core
+    Task runtimes are taken from earlier stacker runs of the same product, if any.
+    """
+    if task_desc is None:
+        model = estimate.TaskCostModel.default('stack')
     else:
-        nodes = max_nodes
-
-    tasks_per_cpu = ceil(num_tasks / (nodes * cores_per_node))
-    wall_time_mins = '{mins}m'.format(mins=(task_time_mins * tasks_per_cpu))
+        model = estimate.load_cost_model(task_desc.parameters.output_products[0], task_desc.type_)
 
-    return nodes, wall_time_mins
+    job = estimate.estimate_job(model, num_tasks)
+    return job.nodes, job.walltime
 
 
 @cli.command(help='Process all tasks in a task file')
@@ -219,6 +217,8 @@ def run(index,
         task_desc_file: str,
         runner: TaskRunner,
         qsub):
+    from datacube_apps.stacker import stacker
+
     _LOG.info('Starting DEA Stacker processing...')
 
     task_desc = serialise.load_structure(Path(task_desc_file), TaskDescription)
@@ -28,6 +28,7 @@ _LOG = structlog.get_logger()
 
 @click.command()
 @ui.global_cli_options
+@uiutil.profile_option
 @click.option('--cache-folder',
               type=click.Path(exists=True, readable=True, writable=True),
               # 'cache' folder in current directory.
@@ -1,11 +1,10 @@
-import dawg
 import logging
 import multiprocessing
 import time
 from functools import partial
 from itertools import chain
 from pathlib import Path
-from typing import Iterable, Any, Mapping, List, Set
+from typing import Iterable, Any, Mapping, List, Set, TYPE_CHECKING
 
 import structlog
 from boltons import fileutils
@@ -23,6 +22,9 @@ from digitalearthau.sync.differences import UnreadableDataset, InvalidDataset
 from .differences import ArchivedDatasetOnDisk, Mismatch, LocationMissingOnDisk, LocationNotIndexed, \
     DatasetNotIndexed
 
+if TYPE_CHECKING:
+    import dawg
+
 _LOG = structlog.get_logger()
 
 # 23 hours (roughly the same day)
@@ -40,12 +42,14 @@ def cache_is_too_old(path):
 def build_pathset(
         collection: Collection,
         cache_path: Path = None,
-        log=_LOG) -> dawg.CompletionDAWG:
+        log=_LOG) -> 'dawg.CompletionDAWG':
     """
     Build a combined set (in dawg form) of all dataset paths in the given index and filesystem.
 
     Optionally use the given cache directory to cache repeated builds.
     """
+    import dawg
+
     locations_cache = cache_path.joinpath(query_name(collection.query), 'locations.dawg') if cache_path else None
     if locations_cache:
         fileutils.mkdir_p(str(locations_cache.parent))
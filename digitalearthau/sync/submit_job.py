@@ -1,13 +1,14 @@
 #!/usr/bin/env python
 
 import datetime
+import heapq
 import logging
 import os
+import re
 import shlex
-import time
+import statistics
 from collections import defaultdict
 from pathlib import Path
-from subprocess import check_output
 from typing import List, Optional, Tuple, Iterable, Dict, Set
 
 import click
@@ -18,15 +19,20 @@ from boltons import fileutils
 from click import style
 
 from datacube.index import index_connect
-from digitalearthau import collections
+from digitalearthau import collections, estimate
 from digitalearthau.collections import Trust
 from digitalearthau.paths import get_dataset_paths
+from digitalearthau.qsub import QSubSubmission, SubmissionEngine, SubmissionRecord
 from digitalearthau.sync import scan
 
-SUBMIT_THROTTLE_SECS = 1
-
 FILES_PER_JOB_CUTOFF = 15000
 
+# Used when we have no measured runtimes for a collection.
+DEFAULT_WALLTIME = '20:00:00'
+
+# Printed by PBS at the end of a job's output log.
+PBS_WALLTIME_USED = re.compile(r'Walltime Used:\s*(\d+):(\d+):(\d+)')
+
 _LOG = logging.getLogger(__name__)
 
 
@@ -79,13 +85,16 @@ class SyncSubmission(object):
                  queue='normal',
                  dry_run=False,
                  verbose=True,
-                 workers=4) -> None:
+                 workers=4,
+                 dataset_costs: Dict[str, float] = None) -> None:
         self.project = project
         self.queue = queue
         self.dry_run = dry_run
         self.verbose = verbose
         self.workers = workers
         self.cache_folder = cache_folder
+        # Measured seconds per dataset of each collection, if known (see load_dataset_costs())
+        self.dataset_costs = dataset_costs or {}
 
     def warm_cache(self, tasks: Iterable[Task]):
         # Update the cached path list ahead of time, so PBS jobs don't waste time doing it themselves.
@@ -101,19 +110,33 @@ class SyncSubmission(object):
 
             done_collections.add(task.collection)
 
-    def submit(self,
-               task: Task,
-               output_file: Path,
-               error_file: Path,
-               job_name: str,
-               require_job_id: Optional[str]) -> Tuple[str, List]:
+    def walltime(self, task: Task) -> str:
+        """
+        Enough walltime for the task's datasets at its collection's measured speed.
+        """
+        cost = self.dataset_costs.get(task.collection.name)
+        return estimate.suggest_walltime(
+            cost * task.dataset_count if cost is not None else None,
+            default=DEFAULT_WALLTIME
+        )
 
+    def submission(self,
+                   task: Task,
+                   output_file: Path,
+                   error_file: Path,
+                   job_name: str,
+                   depends_on: Optional[str],
+                   run_path: Optional[Path] = None) -> QSubSubmission:
+        """
+        The qsub job for a task.
+
+        :param depends_on: key of an earlier submission that must finish first
+        :param run_path: the job's folder, remembered in the submission record
+        """
         # Output files readable by others.
         attributes = ['umask=33']
 
         sync_opts = []
-        if require_job_id:
-            attributes.extend(['depend=afterany:{}'.format(str(require_job_id).strip())])
         if self.verbose:
             sync_opts.append('-v')
         if not self.dry_run:
@@ -154,11 +177,11 @@ class SyncSubmission(object):
                 '-M', 'nci.monitor@dea.ga.gov.au'
             ])
 
-        command = [
-            'qsub', '-V',
+        qsub_args = [
+            '-V',
             '-P', self.project,
             '-q', self.queue,
-            '-l', 'walltime=20:00:00,mem=1GB,ncpus=4,jobfs=256MB',
+            '-l', 'walltime={},mem=1GB,ncpus=4,jobfs=256MB'.format(self.walltime(task)),
             '-l', 'storage=gdata/rs0+gdata/v10+gdata/fk4+gdata/if87',
             '-l', 'wd',
             '-N', 'sync-{}'.format(job_name),
@@ -171,10 +194,9 @@ class SyncSubmission(object):
             *sync_command
         ]
 
-        click.echo(' '.join(shlex.quote(arg) for arg in command))
-        output = check_output(command)
-        job_id = output.decode('utf-8').strip(' \n')
-        return job_id, command
+        # The job name and inputs identify it across reruns (the run folders are timestamped).
+        key = '{}:{}'.format(job_name, ','.join(map(str, task.input_paths)))
+        return QSubSubmission(key, qsub_args, depends_on=depends_on, run_path=run_path)
 
 
 @click.command()
@@ -206,6 +228,19 @@ class SyncSubmission(object):
               type=int,
               default=None,
               help="Stop submitting after this many jobs. Useful for testing.")
+@click.option('--cost-history',
+              type=click.Path(exists=True, file_okay=False),
+              multiple=True,
+              help="Earlier sync work folders: their job runtimes weight the grouping of paths into jobs, "
+                   "and set the walltime requested.")
+@click.option('--submit-workers',
+              type=int,
+              default=4,
+              help="Number of qsub submissions to run at once.")
+@click.option('--submission-record',
+              type=click.Path(dir_okay=False, writable=True),
+              default=None,
+              help="File of jobs already submitted. Rerunning with the same file won't resubmit them.")
 def main(folders: Iterable[str],
          dry_run: bool,
          queue: str,
@@ -214,7 +249,10 @@ def main(folders: Iterable[str],
          cache_folder: str,
          max_jobs: int,
          concurrent_jobs: int,
-         submit_limit: int):
+         submit_limit: int,
+         cost_history: Iterable[str],
+         submit_workers: int,
+         submission_record: str):
     """
     Submit PBS jobs to run dea-sync
 
@@ -232,7 +270,6 @@ def main(folders: Iterable[str],
 
     with index_connect(application_name='sync-submit') as index:
         collections.init_nci_collections(index)
-        submitter = SyncSubmission(cache_folder, project, queue, dry_run, verbose=True, workers=4)
         click.echo(
             "{} input path(s)".format(len(input_paths))
         )
@@ -248,7 +285,14 @@ def main(folders: Iterable[str],
             click.echo(
                 "Grouping (max_jobs={})".format(max_jobs)
             )
-        tasks = group_tasks(tasks, maximum=max_jobs)
+        dataset_costs = load_dataset_costs(Path(p) for p in cost_history) if cost_history else None
+        if dataset_costs:
+            click.echo("Measured seconds per dataset: {}".format(
+                ', '.join('{}={:.2f}'.format(name, c) for name, c in sorted(dataset_costs.items()))
+            ))
+        tasks = group_tasks(tasks, maximum=max_jobs, dataset_costs=dataset_costs)
+        submitter = SyncSubmission(cache_folder, project, queue, dry_run, verbose=True, workers=4,
+                                   dataset_costs=dataset_costs)
 
         total_datasets = sum(t.dataset_count for t in tasks)
         click.secho(
@@ -260,7 +304,11 @@ def main(folders: Iterable[str],
             bold=True
         )
 
-        _find_and_submit(tasks, work_folder, concurrent_jobs, submit_limit, submitter)
+        engine = SubmissionEngine(
+            record=SubmissionRecord(Path(submission_record) if submission_record else None),
+            concurrency=submit_workers,
+        )
+        _find_and_submit(tasks, work_folder, concurrent_jobs, submit_limit, submitter, engine)
 
 
 def _paths_to_tasks(input_paths: List[Path]) -> List[Task]:
@@ -291,32 +339,135 @@ def _paths_to_tasks(input_paths: List[Path]) -> List[Task]:
     return [Task([p], c) for p, c in parent_folder_counts]
 
 
-def group_tasks(tasks: List[Task], maximum) -> List[Task]:
+def group_tasks(tasks: List[Task], maximum, dataset_costs: Dict[str, float] = None) -> List[Task]:
     """
+    Group tasks into at most `maximum` jobs of about equal cost, most expensive first.
+
+    A task's cost is its dataset count, weighted by its collection's measured cost per dataset if known
+    (see load_dataset_costs()). Jobs are shared between collections by cost, and each collection's
+    tasks are packed into its jobs longest-first, each going to the cheapest job so far.
+
     >>> collections._add(collections.Collection('test', {}, ['/test/*'], ()))
     >>> two = [Task(['/test/a', '/test/b'], 3), Task(['/test/c'], 2)]
     >>> group_tasks(two, maximum=2)
     [Task(['/test/a', '/test/b'], 3), Task(['/test/c'], 2)]
     >>> group_tasks(two, maximum=1)
     [Task(['/test/a', '/test/b', '/test/c'], 5)]
+    >>> skewed = [Task(['/test/' + name], count) for name, count in zip('abcdef', [8, 1, 1, 5, 2, 3])]
+    >>> group_tasks(skewed, maximum=2)
+    [Task(['/test/a', '/test/e'], 10), Task(['/test/b', '/test/c', '/test/d', '/test/f'], 10)]
     """
-    # Combine the two smallest repeatedly until under the limit.
-    while len(tasks) > maximum:
-        # Ordered: most datasets to least
-        tasks.sort(key=lambda s: s.dataset_count, reverse=True)
-
-        max_count = tasks[-1].dataset_count
-        if max_count > FILES_PER_JOB_CUTOFF:
-            _LOG.warning('Unusually large number of datasets in a single folder: %s', max_count)
-
-        a = tasks.pop()
-        b = tasks.pop()
-        tasks.append(
-            Task(input_paths=sorted(a.input_paths + b.input_paths),
-                 dataset_count=a.dataset_count + b.dataset_count)
-        )
+    if len(tasks) <= maximum:
+        return tasks
+
+    for task in tasks:
+        if task.dataset_count > FILES_PER_JOB_CUTOFF:
+            _LOG.warning('Unusually large number of datasets in a single folder: %s', task.dataset_count)
+
+    def cost(task: Task) -> float:
+        return task.dataset_count * _dataset_cost(task.collection.name, dataset_costs)
+
+    by_collection = defaultdict(list)  # type: Dict[str, List[Task]]
+    for task in tasks:
+        by_collection[task.collection.name].append(task)
+
+    job_counts = _share_jobs(
+        {name: (sum(cost(t) for t in ts), len(ts)) for name, ts in by_collection.items()},
+        maximum
+    )
 
-    return tasks
+    jobs = []  # type: List[Tuple[float, Task]]
+    for name, collection_tasks in by_collection.items():
+        for job_cost, job_tasks in _pack(collection_tasks, job_counts[name], cost):
+            jobs.append((
+                job_cost,
+                Task(input_paths=sorted(p for t in job_tasks for p in t.input_paths),
+                     dataset_count=sum(t.dataset_count for t in job_tasks))
+            ))
+
+    jobs.sort(key=lambda job: job[0], reverse=True)
+    return [task for _, task in jobs]
+
+
+def _dataset_cost(collection_name: str, dataset_costs: Optional[Dict[str, float]]) -> float:
+    """
+    The relative cost of a dataset in the collection. Unmeasured collections get the average.
+    """
+    if not dataset_costs:
+        return 1.0
+    if collection_name in dataset_costs:
+        return dataset_costs[collection_name]
+    return sum(dataset_costs.values()) / len(dataset_costs)
+
+
+def _share_jobs(collection_costs: Dict[str, Tuple[float, int]], maximum: int) -> Dict[str, int]:
+    """
+    Share the jobs between collections in proportion to their (total cost, task count).
+
+    Each collection needs at least one job (a job can only cover one collection), and at most one per task.
+
+    >>> sorted(_share_jobs({'a': (90.0, 10), 'b': (30.0, 10), 'c': (10.0, 1)}, 6).items())
+    [('a', 4), ('b', 1), ('c', 1)]
+    """
+    if len(collection_costs) > maximum:
+        _LOG.warning('More collections (%s) than the maximum jobs (%s): using one job each',
+                     len(collection_costs), maximum)
+
+    job_counts = {name: 1 for name in collection_costs}
+    # The collection with the most cost per job gets the next job.
+    heap = [(-total_cost, name) for name, (total_cost, task_count) in collection_costs.items() if task_count > 1]
+    heapq.heapify(heap)
+
+    spare = maximum - len(job_counts)
+    while spare > 0 and heap:
+        _, name = heapq.heappop(heap)
+        job_counts[name] += 1
+        spare -= 1
+
+        total_cost, task_count = collection_costs[name]
+        if job_counts[name] < task_count:
+            heapq.heappush(heap, (-total_cost / job_counts[name], name))
+
+    return job_counts
+
+
+def _pack(tasks: List[Task], job_count: int, cost) -> List[Tuple[float, List[Task]]]:
+    """
+    Longest-processing-time-first packing of tasks into the given number of jobs.
+    """
+    # (cost, job number, tasks)
+    jobs = [(0.0, i, []) for i in range(job_count)]  # type: List[Tuple[float, int, List[Task]]]
+    for task in sorted(tasks, key=cost, reverse=True):
+        job_cost, i, job_tasks = heapq.heappop(jobs)
+        job_tasks.append(task)
+        heapq.heappush(jobs, (job_cost + cost(task), i, job_tasks))
+
+    return [(job_cost, job_tasks) for job_cost, _, job_tasks in sorted(jobs) if job_tasks]
+
+
+def load_dataset_costs(folders: Iterable[Path]) -> Dict[str, float]:
+    """
+    Measure the seconds per dataset of each collection from earlier sync runs.
+
+    Each run folder has the submission-info.yaml we wrote, and the PBS output log with its resource usage.
+    The median of each collection's runs is used.
+    """
+    costs = defaultdict(list)  # type: Dict[str, List[float]]
+    for folder in folders:
+        for info_path in Path(folder).rglob('submission-info.yaml'):
+            info = yaml.safe_load(info_path.read_text())
+            out_path = info_path.parent.joinpath('out.log')
+            if not info or not info.get('file_dataset_count') or not out_path.exists():
+                continue
+
+            walltime = PBS_WALLTIME_USED.search(out_path.read_text(errors='replace'))
+            if not walltime:
+                continue
+            hours, minutes, seconds = map(int, walltime.groups())
+            total_seconds = hours * 3600 + minutes * 60 + seconds
+            costs[info['collection_name']].append(total_seconds / info['file_dataset_count'])
+
+    return {name: statistics.median(values) for name, values in costs.items()}
 
 
 T = typing.TypeVar('T')
@@ -343,42 +494,55 @@ def _find_and_submit(tasks: List[Task],
                      work_folder: str,
                      concurrent_jobs: int,
                      submit_limit: int,
-                     submitter: SyncSubmission):
+                     submitter: SyncSubmission,
+                     engine: SubmissionEngine):
     submitter.warm_cache(tasks)
 
-    submitted = 0
-    # To maintain concurrent_jobs limit, we set a pbs dependency on previous jobs.
-    # mapping of concurrent slot number to the last job id to be submitted in it.
-    last_job_slots = {}  # type: Dict[int, str]
+    if submit_limit is not None and len(tasks) > submit_limit:
+        click.echo("Submit limit ({}) reached, done.".format(submit_limit))
+        tasks = tasks[:submit_limit]
 
-    for task in tasks:
-        if submitted == submit_limit:
-            click.echo("Submit limit ({}) reached, done.".format(submit_limit))
-            break
+    # To maintain concurrent_jobs limit, we set a pbs dependency on previous jobs.
+    # Each job depends on the one submitted concurrent_jobs before it (the last in its "slot").
+    submissions = []
+    for number, task in enumerate(tasks):
+        run_path = task.resolve_path(work_folder).joinpath('{:03d}'.format(number))
+        submission = submitter.submission(
+            task=task,
+            output_file=(run_path.joinpath('out.log')),
+            error_file=run_path.joinpath('err.log'),
+            job_name='{}-{:02}'.format(task.collection.name, number),
+            depends_on=submissions[number - concurrent_jobs].key if number >= concurrent_jobs else None,
+            run_path=run_path,
+        )
+        submissions.append(submission)
 
-        require_job_id = last_job_slots.get(submitted % concurrent_jobs)
+        # Jobs from an earlier run keep their own folder.
+        if engine.record.get(submission.key) is not None:
+            continue
 
-        run_path = task.resolve_path(work_folder).joinpath('{:03d}'.format(submitted))
         if not run_path.exists():
             fileutils.mkdir_p(run_path)
         else:
             _LOG.warning("Calculated job folder should be unique? Got %r", run_path)
-
-        job_id, command = submitter.submit(
-            task=task,
-            output_file=(run_path.joinpath('out.log')),
-            error_file=run_path.joinpath('err.log'),
-            job_name='{}-{:02}'.format(task.collection.name, submitted),
-            require_job_id=require_job_id,
-        )
-
-        if job_id:
+        click.echo(' '.join(shlex.quote(arg) for arg in ['qsub', *submission.args]))
+
+    submitted = failed = 0
+    for task, result in zip(tasks, engine.submit_all(submissions)):
+        prefix = style("[{:02d} {}]".format(submitted + failed + 1, task.collection.name), fg='blue', bold=True)
+        if not result.job_id:
+            failed += 1
+            click.echo("{prefix}: {error}".format(prefix=prefix, error=style(str(result.error), fg='red')))
+            continue
+
+        submitted += 1
+        if not result.recorded:
             # Not used by the job, but useful for our reference, and potentially by future monitoring.
-            run_path.joinpath('submission-info.yaml').write_text(
+            result.run_path.joinpath('submission-info.yaml').write_text(
                 yaml.safe_dump(
                     {
-                        'pbs_command': ' '.join(shlex.quote(arg) for arg in command),
-                        'pbs_job_id': job_id,
+                        'pbs_command': ' '.join(shlex.quote(arg) for arg in ['qsub', *result.args]),
+                        'pbs_job_id': result.job_id,
                         'input_paths': [str(p) for p in task.input_paths],
                         'file_dataset_count': task.dataset_count,
                         'collection_name': task.collection.name
@@ -388,22 +552,19 @@ def _find_and_submit(tasks: List[Task],
                 )
             )
 
-            last_job_slots[submitted % concurrent_jobs] = job_id
-            submitted += 1
-
-            click.echo(
-                "{prefix}: submitted {job_id} with {dataset_count} datasets using directory {run_path}".format(
-                    prefix=style(
-                        "[{:02d} {}]".format(submitted, task.collection.name),
-                        fg='blue', bold=True
-                    ),
-                    job_id=style(job_id, bold=True),
-                    dataset_count=style(str(task.dataset_count), bold=True),
-                    run_path=style(str(run_path), bold=True)
-                )
+        click.echo(
+            "{prefix}: {action} {job_id} with {dataset_count} datasets using directory {run_path}".format(
+                prefix=prefix,
+                action='previously submitted' if result.recorded else 'submitted',
+                job_id=style(result.job_id, bold=True),
+                dataset_count=style(str(task.dataset_count), bold=True),
+                # Records from before run paths were kept don't have one.
+                run_path=style(str(result.run_path or 'unknown'), bold=True)
             )
+        )
 
-        time.sleep(SUBMIT_THROTTLE_SECS)
+    if failed:
+        raise click.ClickException("{} of {} jobs failed to submit".format(failed, len(tasks)))
 
 
 def get_collection(tile_path: Path) -> collections.Collection:
@@ -0,0 +1,92 @@
+from pathlib import Path
+
+from digitalearthau import collections
+from digitalearthau.paths import write_files
+from digitalearthau.qsub import SubmissionEngine, SubmissionRecord
+from digitalearthau.sync.submit_job import SyncSubmission, Task, _find_and_submit, group_tasks, load_dataset_costs
+
+_PBS_USAGE = """
+======================================================================================
+                  Resource Usage on 2020-03-18 10:23:32:
+   Job Id:             1234.gadi-pbs
+   NCPUs Requested:    4                      NCPUs Used: 4
+   Walltime requested: 20:00:00            Walltime Used: {walltime}
+======================================================================================
+"""
+
+
+def _run_folder(collection_name, dataset_count, walltime):
+    return {
+        'submission-info.yaml': f"collection_name: {collection_name}\nfile_dataset_count: {dataset_count}\n",
+        'out.log': 'Syncing...\n' + _PBS_USAGE.format(walltime=walltime),
+    }
+
+
+def test_load_dataset_costs():
+    root = write_files({
+        'run-1': {
+            '000': _run_folder('slow', 100, '00:10:00'),
+            '001': _run_folder('slow', 100, '00:20:00'),
+            '002': _run_folder('slow', 100, '01:00:00'),
+            '003': _run_folder('fast', 600, '00:01:00'),
+        },
+        # Still running: no resource usage yet
+        'run-2': {
+            '000': {'submission-info.yaml': "collection_name: fast\nfile_dataset_count: 10\n", 'out.log': ''},
+        }
+    })
+    assert load_dataset_costs([root]) == {'slow': 12.0, 'fast': 0.1}
+
+
+def test_group_tasks_by_cost():
+    collections._add(
+        collections.Collection('slow', {}, ['/slow/*'], ()),
+        collections.Collection('fast', {}, ['/fast/*'], ()),
+    )
+    tasks = [Task([Path('/slow/a')], 10), Task([Path('/slow/b')], 10), Task([Path('/slow/c')], 10)]
+    tasks.extend(Task([Path('/fast/{}'.format(i))], 100) for i in range(6))
+
+    # By dataset count alone, the fast collection gets most of the jobs.
+    jobs = group_tasks(list(tasks), maximum=4)
+    assert sorted(j.dataset_count for j in jobs if j.collection.name == 'slow') == [30]
+
+    # Weighted by measured cost, the slow collection's datasets are spread out instead.
+    jobs = group_tasks(list(tasks), maximum=4, dataset_costs={'slow': 12.0, 'fast': 0.1})
+    assert len(jobs) == 4
+    assert sorted(j.dataset_count for j in jobs if j.collection.name == 'slow') == [10, 10, 10]
+    assert [j.dataset_count for j in jobs if j.collection.name == 'fast'] == [600]
+
+
+class _NoCacheSubmission(SyncSubmission):
+    def warm_cache(self, tasks):
+        pass
+
+
+def test_resubmission_keeps_original_run_folder(tmpdir, capsys):
+    collections._add(collections.Collection('resubmit', {}, ['/resubmit/*'], ()))
+    tasks = [Task([Path('/resubmit/a')], 10), Task([Path('/resubmit/b')], 10)]
+    root = Path(str(tmpdir))
+    record_path = root.joinpath('submitted.jsonl')
+    submitter = _NoCacheSubmission(str(root.joinpath('cache')), dry_run=True)
+    job_ids = iter(['{}.gadi-pbs'.format(i) for i in range(10)])
+
+    def run_qsub(args, script):
+        return next(job_ids)
+
+    # The first run only gets as far as the first job.
+    engine = SubmissionEngine(SubmissionRecord(record_path), qsub=run_qsub)
+    _find_and_submit(tasks, str(root.joinpath('run-1')), 1, 1, submitter, engine)
+
+    capsys.readouterr()
+
+    # The rerun reports the first job's original folder, and doesn't make it a new one.
+    engine = SubmissionEngine(SubmissionRecord(record_path), qsub=run_qsub)
+    _find_and_submit(tasks, str(root.joinpath('run-2')), 1, None, submitter, engine)
+    output = capsys.readouterr().out
+    assert 'previously submitted 0.gadi-pbs with 10 datasets using directory {}'.format(
+        root.joinpath('run-1', '000')) in output
+    assert 'submitted 1.gadi-pbs with 10 datasets using directory {}'.format(root.joinpath('run-2', '001')) in output
+
+    assert root.joinpath('run-1', '000', 'submission-info.yaml').exists()
+    assert not root.joinpath('run-2', '000').exists()
+    assert root.joinpath('run-2', '001', 'submission-info.yaml').exists()
@@ -1,19 +1,26 @@
+import functools
 import logging
 import os
 import tempfile
 from pathlib import Path
 
-from osgeo import gdal
-from compliance_checker.runner import ComplianceChecker, CheckSuite
-
 from digitalearthau import paths
 
 # prevent aux.xml write
 os.environ["GDAL_PAM_ENABLED"] = "NO"
 
-# The 'load' method actually loads it globally, not on the specific instance.
-CHECK_SUITE = CheckSuite()
-CHECK_SUITE.load_all_available_checkers()
+# GDAL and the compliance checker are slow to import, and only needed once a file is validated:
+# they're imported on first use, so that the sync commands start quickly.
+
+
+@functools.lru_cache(maxsize=None)
+def load_check_suite():
+    from compliance_checker.runner import CheckSuite
+
+    # The 'load' method actually loads it globally, not on the specific instance.
+    check_suite = CheckSuite()
+    check_suite.load_all_available_checkers()
+    return check_suite
 
 
 def validate_dataset(md_path: Path, log: logging.Logger):
@@ -27,6 +34,8 @@ def validate_dataset(md_path: Path, log: logging.Logger):
 
 
 def validate_image(file: Path, log: logging.Logger, compliance_check=False):
+    from osgeo import gdal
+
     try:
         storage_unit = gdal.Open(str(file), gdal.gdalconst.GA_ReadOnly)
 
@@ -61,6 +70,9 @@ def _compliance_check(nc_path: Path, results_path: Path = None):
     """
     Run cf and adcc checks with normal strictness, verbose text format to stdout
     """
+    from compliance_checker.runner import ComplianceChecker
+    load_check_suite()
+
     # Specify a tempfile as a sink, as otherwise it will spew results into stdout.
     out_file = str(results_path) if results_path else tempfile.mktemp(prefix='compliance-log-')
 
@@ -0,0 +1,81 @@
+import uuid
+from datetime import datetime
+
+import numpy
+import pytest
+from click.testing import CliRunner
+
+from digitalearthau import coherence, paths
+from digitalearthau.lineage import LineageGraph
+
+
+class _FakeDatacube:
+    index = None
+
+    def __init__(self, config=None, app=None) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+def _window_graph(index, expressions, id_range=None) -> LineageGraph:
+    # One dataset per window, without locations.
+    if id_range[0] == uuid.UUID(int=0) and expressions.get('fail'):
+        raise RuntimeError("Window failed")
+    return LineageGraph(
+        [id_range[0]],
+        in_scope=numpy.array([True]),
+        product=numpy.array([1]),
+        archived=numpy.array([False]),
+        indexed_time=[datetime(2017, 1, 1)],
+        location_count=numpy.array([0]),
+        edges=[],
+    )
+
+
+class _RecordingLog:
+    def __init__(self) -> None:
+        self.events = []
+
+    def _record(self, event, **kwargs):
+        self.events.append((event, kwargs))
+
+    info = warning = error = _record
+
+    def last(self, event):
+        return [kwargs for e, kwargs in self.events if e == event][-1]
+
+
+@pytest.fixture
+def log(monkeypatch, tmpdir):
+    monkeypatch.setattr(coherence, 'Datacube', _FakeDatacube)
+    monkeypatch.setattr(coherence.lineage, 'load_lineage', _window_graph)
+    monkeypatch.setattr(coherence.uiutil, 'init_logging', lambda: None)
+    monkeypatch.setattr(paths, 'NCI_WORK_ROOT', tmpdir.join('work'))
+
+    log = _RecordingLog()
+    monkeypatch.setattr(coherence, '_LOG', log)
+    return log
+
+
+def test_windows_run_on_task_runner(log, tmpdir):
+    result = CliRunner().invoke(coherence.main, ['--id-windows', '3', '--check-locationless'])
+    assert result.exit_code == 0, result.output
+
+    assert len([e for e, _ in log.events if e == 'window.finish']) == 3
+    assert log.last('coherence.finish')['locationless_count'] == 3
+    # The serial runner doesn't need a work directory.
+    assert not tmpdir.join('work').exists()
+
+
+def test_failed_windows_exit_with_error(log):
+    result = CliRunner().invoke(coherence.main, ['--id-windows', '3', '--check-locationless', 'fail=yes'])
+    assert result.exit_code == 1, result.output
+
+    failed = log.last('coherence.failed')
+    assert failed['failed_window_count'] == 1
+    assert failed['locationless_count'] == 2
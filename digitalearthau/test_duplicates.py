@@ -0,0 +1,46 @@
+import io
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+from psycopg2.extras import DateTimeRange
+
+from digitalearthau.duplicates import CsvDuplicateWriter, DuplicateGroup, ParquetDuplicateWriter
+
+_GROUP = DuplicateGroup(
+    'ls8_level1_scene',
+    (DateTimeRange(datetime(2016, 9, 26, 2, 16, 59), datetime(2016, 9, 26, 2, 17, 29)), 114, 80),
+    [uuid.UUID('86150afc-b7d5-4938-a75e-3445007256d3'), uuid.UUID('f882f9c0-a27f-11e7-a89f-185e0f80a5c0')]
+)
+
+
+def test_csv_writer():
+    out = io.StringIO()
+    with CsvDuplicateWriter(out) as writer:
+        writer.write_header(('time', 'sat_path', 'sat_row'))
+        writer.write(_GROUP)
+        # Only the first collection's header is written.
+        writer.write_header(('time', 'lat', 'lon'))
+
+    assert out.getvalue().splitlines() == [
+        'product,time,sat_path,sat_row,count,dataset_refs',
+        'ls8_level1_scene,2016-09-26T02:16:59+00:00,114,80,2,'
+        '86150afc-b7d5-4938-a75e-3445007256d3 f882f9c0-a27f-11e7-a89f-185e0f80a5c0',
+    ]
+
+
+def test_parquet_writer(tmpdir):
+    parquet = pytest.importorskip('pyarrow.parquet')
+
+    path = Path(str(tmpdir)).joinpath('duplicates.parquet')
+    with ParquetDuplicateWriter(path, batch_size=1) as writer:
+        writer.write_header(('time', 'sat_path', 'sat_row'))
+        writer.write(_GROUP)
+        writer.write(_GROUP._replace(product='ls7_level1_scene'))
+
+    rows = parquet.read_table(str(path)).to_pylist()
+    assert [r['product'] for r in rows] == ['ls8_level1_scene', 'ls7_level1_scene']
+    assert rows[0]['values'] == [('time', '2016-09-26T02:16:59+00:00'), ('sat_path', '114'), ('sat_row', '80')]
+    assert rows[0]['count'] == 2
+    assert rows[0]['dataset_refs'] == [str(id_) for id_ in _GROUP.dataset_ids]
@@ -0,0 +1,48 @@
+import json
+
+from digitalearthau import estimate, paths
+from digitalearthau.paths import write_files
+
+
+def _event(task_id, status, timestamp, name='stack'):
+    return json.dumps(dict(id=task_id, status=status, event='task.' + status, name=name, timestamp=timestamp))
+
+
+_EVENTS = '\n'.join([
+    _event('a', 'pending', '2017-10-05T22:00:00+00:00'),
+    _event('a', 'active', '2017-10-05T22:10:00+00:00'),
+    _event('b', 'active', '2017-10-05T22:10:00+00:00'),
+    _event('a', 'complete', '2017-10-05T22:15:00+00:00'),
+    _event('c', 'active', '2017-10-05T22:15:00+00:00'),
+    _event('b', 'failed', '2017-10-05T22:20:00+00:00'),
+    _event('c', 'complete', '2017-10-05T22:25:00+00:00'),
+    _event('d', 'active', '2017-10-05T22:00:00+00:00', name='fc'),
+    _event('d', 'complete', '2017-10-05T22:01:00+00:00', name='fc'),
+])
+
+
+def test_task_durations():
+    root = write_files({'events': {'1507241402-node1-collected-events.jsonl': _EVENTS}})
+    assert estimate.task_durations([root.joinpath('events')]) == {'stack': [300.0, 600.0], 'fc': [60.0]}
+
+
+def test_load_cost_model(monkeypatch):
+    root = write_files({
+        'ls8_nbar_albers': {
+            'stack': {
+                '2017-10': {
+                    '05-220000': {'events': {'1507241402-node1-collected-events.jsonl': _EVENTS}},
+                    # A run that hasn't recorded anything yet.
+                    '06-220000': {'events': {}},
+                }
+            }
+        }
+    })
+    monkeypatch.setattr(paths, 'NCI_WORK_ROOT', root)
+
+    model = estimate.load_cost_model('ls8_nbar_albers', 'stack')
+    assert model.sample_count == 2
+    assert model.median_seconds == 450.0
+
+    assert estimate.load_cost_model('ls8_nbar_albers', 'fc') == estimate.TaskCostModel.default('fc')
+    assert estimate.load_cost_model('ls7_nbar_albers', 'stack') == estimate.TaskCostModel.default('stack')
@@ -0,0 +1,142 @@
+import json
+
+from click.testing import CliRunner
+
+from digitalearthau import eventstore, qsub, serialise
+from digitalearthau.events import NodeMessage
+from digitalearthau.paths import write_files
+
+
+def _event(task_id, status, timestamp, hostname='node1', name='stack', message=None):
+    return json.dumps(dict(
+        id=task_id, status=status, event='task.' + status, name=name, timestamp=timestamp,
+        node=dict(hostname=hostname, pid=1234), message=message,
+        input_datasets=['60bc52f1-7a70-43f2-bc8d-2bd138eb2aba'],
+    )) + '\n'
+
+
+_NODE1_EVENTS = ''.join([
+    _event('a', 'pending', '2017-10-05T22:00:00+00:00'),
+    _event('a', 'active', '2017-10-05T22:10:00+00:00'),
+    _event('b', 'active', '2017-10-05T22:10:00+00:00'),
+    _event('a', 'complete', '2017-10-05T22:15:00+00:00'),
+    _event('b', 'failed', '2017-10-05T22:20:00+00:00', message='Traceback (most recent call last):\n ...'),
+])
+
+_NODE2_EVENTS = ''.join([
+    _event('c', 'active', '2017-10-05T22:15:00+00:00', hostname='node2'),
+    _event('c', 'complete', '2017-10-05T22:25:00+00:00', hostname='node2'),
+])
+
+
+def test_ingest_and_query():
+    root = write_files({'events': {
+        '1507241402-node1-collected-events.jsonl': _NODE1_EVENTS,
+        '1507241402-node2-collected-events.jsonl': _NODE2_EVENTS,
+    }})
+    events_path = root.joinpath('events')
+
+    with eventstore.EventStore.for_events_path(events_path) as store:
+        assert store.ingest(events_path) == 7
+        # Nothing new
+        assert store.ingest(events_path) == 0
+
+        assert store.status_counts() == {'complete': 2, 'failed': 1}
+
+        [failed] = store.tasks(status='failed')
+        assert failed.id == 'b'
+        assert failed.hostname == 'node1'
+        assert failed.duration_seconds == 600.0
+
+        assert store.durations(by='hostname') == [
+            eventstore.DurationSummary('node1', 1, 300.0, 300.0, 300.0),
+            eventstore.DurationSummary('node2', 1, 600.0, 600.0, 600.0),
+        ]
+        assert [t.id for t in store.slowest_tasks(limit=1)] == ['c']
+        assert [e['status'] for e in store.task_events('a')] == ['pending', 'active', 'complete']
+
+
+def test_ingest_is_incremental():
+    root = write_files({'events': {'1507241402-node1-collected-events.jsonl': _NODE1_EVENTS}})
+    events_path = root.joinpath('events')
+    jsonl_path = events_path.joinpath('1507241402-node1-collected-events.jsonl')
+
+    with eventstore.EventStore.for_events_path(events_path) as store:
+        store.ingest(events_path)
+
+        # A retried task completes, and another event is only half-written so far.
+        retried = _event('b', 'complete', '2017-10-05T22:40:00+00:00')
+        half_written = _event('d', 'active', '2017-10-05T22:45:00+00:00')
+        with jsonl_path.open('a') as f:
+            f.write(_event('b', 'active', '2017-10-05T22:30:00+00:00') + retried + half_written[:20])
+        assert store.ingest(events_path) == 2
+        assert store.status_counts() == {'complete': 2}
+
+        with jsonl_path.open('a') as f:
+            f.write(half_written[20:])
+        assert store.ingest(events_path) == 1
+        assert store.status_counts() == {'complete': 2, 'active': 1}
+
+        # Started at its first attempt.
+        [task_b] = [t for t in store.tasks() if t.id == 'b']
+        assert task_b.duration_seconds == 1800.0
+
+    # The file offsets are kept with the store.
+    with eventstore.EventStore.for_events_path(events_path) as store:
+        assert store.ingest(events_path) == 0
+
+
+def test_cli():
+    root = write_files({'events': {'1507241402-node1-collected-events.jsonl': _NODE1_EVENTS}})
+    events_path = str(root.joinpath('events'))
+
+    result = CliRunner().invoke(eventstore.cli, ['failed', events_path])
+    assert result.exit_code == 0, result.output
+    assert result.output.split('\t')[0] == 'b'
+    assert result.output.strip().endswith('Traceback (most recent call last):')
+
+    result = CliRunner().invoke(eventstore.cli, ['durations', '--by', 'name', '--no-update', events_path])
+    assert result.exit_code == 0, result.output
+    assert result.output.splitlines()[1:] == ['stack\t1\t300.0\t300.0\t300.0']
+
+
+def _measurement(description, hostname, started, seconds, peak_rss_bytes, failed=False):
+    return qsub.TaskMeasurement(
+        result=qsub.TaskFailure('ValueError()', 'Traceback...') if failed else None,
+        description=description,
+        node=NodeMessage(hostname=hostname, pid=1234),
+        started=started,
+        finished=started + seconds,
+        peak_rss_bytes=peak_rss_bytes,
+        read_bytes=1024 * 1024,
+        write_bytes=None,
+        submitted=started - 5,
+    )
+
+
+def test_ingest_measured_tasks():
+    root = write_files({'events': {'1507241402-node1-collected-events.jsonl': _NODE1_EVENTS}})
+    events_path = root.joinpath('events')
+    with serialise.JsonLinesWriter(events_path.joinpath('1507241402-node1-task-measurements.jsonl').open('w')) as f:
+        for m in [
+            _measurement('(-11, -28)', 'node1', 1507241400.0, 60.0, 2 * 1024 * 1024),
+            _measurement('(-12, -28)', 'node1', 1507241400.0, 30.0, 1024 * 1024, failed=True),
+            _measurement('(-13, -28)', 'node2', 1507241400.0, 90.0, None),
+        ]:
+            f.write_item(m.task_event())
+
+    with eventstore.EventStore.for_events_path(events_path) as store:
+        assert store.ingest(events_path) == 8
+        # They're counted apart from the runner's events for the same tasks.
+        assert store.status_counts() == {'complete': 1, 'failed': 1}
+
+        assert store.node_resources() == [
+            eventstore.NodeResources('node1', 2, 45.0, 5.0, 2 * 1024 * 1024, 2 * 1024 * 1024, None),
+            eventstore.NodeResources('node2', 1, 90.0, 5.0, None, 1024 * 1024, None),
+        ]
+        [slowest] = store.slowest_measured_tasks(limit=1)
+        assert (slowest.description, slowest.hostname, slowest.seconds) == ('(-13, -28)', 'node2', 90.0)
+
+    result = CliRunner().invoke(eventstore.cli, ['resources', '--slowest', '2', str(events_path)])
+    assert result.exit_code == 0, result.output
+    assert [line.split('\t')[-1] for line in result.output.splitlines()[1:]] == ['(-13, -28)', '(-11, -28)']
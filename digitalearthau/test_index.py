@@ -0,0 +1,99 @@
+import uuid
+from collections import namedtuple
+from datetime import datetime
+
+from dateutil import tz
+from psycopg2.extras import DateTimeRange, NumericRange
+
+from digitalearthau.index import ArchiveBatcher, ArchiveSummary, search_arrays, search_rows
+
+_IDS = [uuid.UUID(int=i) for i in range(5)]
+
+
+class _FakeDatasetResource:
+    def __init__(self, rows=()) -> None:
+        self.archive_calls = []
+        self.archived_locations = []
+        self.rows = rows
+        self.searches = []
+
+    def search_returning(self, field_names, **query):
+        self.searches.append((field_names, query))
+        result_type = namedtuple('search_result', field_names)
+        for row in self.rows:
+            yield result_type(*(row[name] for name in field_names))
+
+    def archive(self, ids):
+        self.archive_calls.append(list(ids))
+
+    def archive_location(self, id_, uri):
+        self.archived_locations.append((id_, uri))
+
+
+class _FakeIndex:
+    def __init__(self, rows=()) -> None:
+        self.datasets = _FakeDatasetResource(rows)
+
+
+def test_archive_batches():
+    index = _FakeIndex()
+    with ArchiveBatcher(index, chunk_size=2) as archiver:
+        archiver.archive(_IDS[:3])
+        # The same sibling found from the other side, as a string.
+        archiver.archive([str(_IDS[1])])
+        assert _IDS[1] in archiver
+        archiver.archive(_IDS[3:])
+        archiver.archive_location(_IDS[0], 'file:///tmp/a/ga-metadata.yaml')
+        archiver.archive_location(_IDS[0], 'file:///tmp/a/ga-metadata.yaml')
+
+    assert index.datasets.archive_calls == [_IDS[0:2], [_IDS[2]], _IDS[3:5]]
+    assert index.datasets.archived_locations == [(_IDS[0], 'file:///tmp/a/ga-metadata.yaml')]
+    assert archiver.summary() == ArchiveSummary(dataset_count=5, location_count=1, repeated_count=2, dry_run=False)
+
+
+def test_dry_run_changes_nothing():
+    index = _FakeIndex()
+    with ArchiveBatcher(index, chunk_size=2, dry_run=True) as archiver:
+        archiver.archive(_IDS)
+        archiver.archive_location(_IDS[0], 'file:///tmp/a/ga-metadata.yaml')
+
+    assert index.datasets.archive_calls == []
+    assert index.datasets.archived_locations == []
+    assert archiver.summary() == ArchiveSummary(dataset_count=5, location_count=1, repeated_count=0, dry_run=True)
+
+
+_ROWS = [
+    dict(
+        id=_IDS[i],
+        time=DateTimeRange(datetime(2016, 1, i + 1, tzinfo=tz.tzutc()), datetime(2016, 1, i + 1, 1, tzinfo=tz.tzutc())),
+        lat=NumericRange(-36.0 + i, -35.0 + i),
+        sat_path=90 + i,
+        uri='file:///tmp/{}/ga-metadata.yaml'.format(i),
+    )
+    for i in range(5)
+]
+
+
+def test_search_rows():
+    index = _FakeIndex(_ROWS)
+
+    rows = list(search_rows(index, ['id', 'sat_path'], product='ls8_level1_scene'))
+    assert [(r.id, r.sat_path) for r in rows] == [(_IDS[i], 90 + i) for i in range(5)]
+    assert index.datasets.searches == [(['id', 'sat_path'], dict(product='ls8_level1_scene'))]
+
+    batches = list(search_rows(index, ['sat_path'], batch_size=2))
+    assert [[r.sat_path for r in batch] for batch in batches] == [[90, 91], [92, 93], [94]]
+
+
+def test_search_arrays():
+    index = _FakeIndex(_ROWS)
+
+    [first, second] = search_arrays(index, [('time', 'datetime64[s]'), ('lat.end', 'f8'), ('sat_path', 'i4'),
+                                            ('uri', 'O')],
+                                    batch_size=3)
+    assert first.dtype.names == ('time', 'lat_end', 'sat_path', 'uri')
+    assert len(first) == 3 and len(second) == 2
+    assert str(second['time'][1]) == '2016-01-05T00:00:00'
+    assert second['lat_end'].tolist() == [-32.0, -31.0]
+    assert first['sat_path'].tolist() == [90, 91, 92]
+    assert second['uri'][0] == 'file:///tmp/3/ga-metadata.yaml'
@@ -0,0 +1,65 @@
+import uuid
+from datetime import datetime
+
+import numpy
+
+from digitalearthau.lineage import LineageGraph
+
+SCENE, ORTHO, NBAR = 1, 2, 3
+
+# name: (in scope, product, archived, location count)
+_NODES = {
+    'scene': (False, SCENE, False, 1),
+    'old_scene': (False, SCENE, True, 1),
+    'ortho': (True, ORTHO, False, 1),
+    'ortho_dupe': (False, ORTHO, False, 1),
+    'ortho_archived': (False, ORTHO, True, 1),
+    'nbar': (False, NBAR, False, 1),
+    'lost': (True, ORTHO, False, 0),
+}
+_NAMES = list(_NODES)
+
+
+def _graph() -> LineageGraph:
+    in_scope, product, archived, location_count = zip(*_NODES.values())
+    edges = [
+        ('ortho', 'scene', 'level1'),
+        ('ortho', 'old_scene', 'satellite_telemetry_data'),
+        ('ortho_dupe', 'scene', 'level1'),
+        ('ortho_archived', 'scene', 'level1'),
+        ('nbar', 'scene', 'level1'),
+    ]
+    return LineageGraph(
+        [uuid.uuid5(uuid.NAMESPACE_URL, name) for name in _NAMES],
+        in_scope=numpy.array(in_scope),
+        product=numpy.array(product),
+        archived=numpy.array(archived),
+        indexed_time=[datetime(2017, 1, day) for day in range(1, len(_NAMES) + 1)],
+        location_count=numpy.array(location_count),
+        edges=[(_NAMES.index(c), _NAMES.index(s), classifier) for c, s, classifier in edges],
+    )
+
+
+def test_adjacency():
+    graph = _graph()
+    scene, ortho = _NAMES.index('scene'), _NAMES.index('ortho')
+
+    assert sorted(_NAMES[i] for i in graph.sources_of(ortho)) == ['old_scene', 'scene']
+    assert sorted(_NAMES[i] for i in graph.derived_of(scene)) == ['nbar', 'ortho', 'ortho_archived', 'ortho_dupe']
+    assert list(graph.derived_of(ortho)) == []
+
+
+def test_checks():
+    graph = _graph()
+
+    assert [_NAMES[i] for i in graph.locationless()] == ['lost']
+    assert [(_NAMES[i], classifier, _NAMES[s]) for i, classifier, s in graph.archived_sources()] == [
+        ('ortho', 'satellite_telemetry_data', 'old_scene')
+    ]
+    assert [(_NAMES[i], _NAMES[s], [_NAMES[sib] for sib in siblings])
+            for i, s, siblings in graph.sibling_groups()] == [
+        ('ortho', 'scene', ['ortho_dupe'])
+    ]
+
+    graph.mark_archived([_NAMES.index('ortho_dupe')])
+    assert list(graph.sibling_groups()) == []
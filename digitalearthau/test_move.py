@@ -0,0 +1,238 @@
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import pytest
+import structlog
+
+from digitalearthau.move import MoveManifest, MoveStage, _verify_checksum, move_all
+from digitalearthau.paths import write_files, register_base_directory
+from digitalearthau.qsub import TaskRunner
+
+_TEST_UUID = 'a3bc7620-dd02-11e6-a5c0-185e0f80a5c0'
+
+
+class _FakeMover:
+    def __init__(self, input_path: Path) -> None:
+        self.input_path = input_path
+        self.dest_path = Path('/tmp/dest').joinpath(input_path.name)
+        self.dataset = _FakeDataset()
+
+
+class _FakeDataset:
+    id = uuid.UUID(_TEST_UUID)
+
+
+def test_manifest_resume(tmpdir):
+    manifest_path = Path(str(tmpdir)).joinpath('move-manifest.jsonl')
+    finished, half_done = Path('/tmp/LS7_FINISHED'), Path('/tmp/LS7_HALF_DONE')
+
+    with MoveManifest(manifest_path) as manifest:
+        for stage in (MoveStage.PLANNED, MoveStage.COPIED, MoveStage.VERIFIED, MoveStage.INDEXED):
+            manifest.record(_FakeMover(finished), stage)
+        manifest.record(_FakeMover(half_done), MoveStage.PLANNED)
+        manifest.record(_FakeMover(half_done), MoveStage.COPIED)
+
+    assert MoveManifest.read_stages(manifest_path) == {
+        str(finished): MoveStage.INDEXED,
+        str(half_done): MoveStage.COPIED,
+    }
+
+    # A resumed run appends to the same manifest.
+    with MoveManifest(manifest_path, resume=True) as manifest:
+        assert manifest.completed_stage(finished) is MoveStage.INDEXED
+        assert manifest.completed_stage(half_done) is MoveStage.COPIED
+        assert manifest.completed_stage(Path('/tmp/LS7_UNSEEN')) is None
+
+        manifest.record(_FakeMover(half_done), MoveStage.VERIFIED)
+
+    assert MoveManifest.read_stages(manifest_path)[str(half_done)] == MoveStage.VERIFIED
+
+    # A failure replaces the stages before it.
+    with MoveManifest(manifest_path, resume=True) as manifest:
+        manifest.record(_FakeMover(half_done), MoveStage.FAILED)
+    assert MoveManifest.read_stages(manifest_path)[str(half_done)] == MoveStage.FAILED
+
+
+def test_dry_run_manifest_records_nothing(tmpdir):
+    manifest_path = Path(str(tmpdir)).joinpath('move-manifest.jsonl')
+    with MoveManifest(manifest_path, dry_run=True) as manifest:
+        manifest.record(_FakeMover(Path('/tmp/LS7_TEST')), MoveStage.PLANNED)
+
+    assert not manifest_path.exists()
+
+
+def test_verify_copied_dataset(tmpdir):
+    source = write_files({
+        'LS7_TEST': {
+            'ga-metadata.yaml': 'id: %s\n' % _TEST_UUID,
+            'product': {
+                'SOME_DATA.tif': ''
+            },
+            'package.sha1':
+                'da39a3ee5e6b4b0d3255bfef95601890afd80709\tproduct/SOME_DATA.tif\n'
+                'a2662e1cd831ad4ef316f4a8dfb9c45067821146\tga-metadata.yaml\n'
+        }
+    }).joinpath('LS7_TEST')
+    copy = Path(str(tmpdir)).joinpath('LS7_TEST')
+    shutil.copytree(str(source), str(copy))
+
+    log = structlog.get_logger()
+    metadata_path = source.joinpath('ga-metadata.yaml')
+
+    assert _verify_checksum(log, metadata_path, dry_run=False, copied_to=copy) is True
+
+    # Corrupt the copy: the original is still fine.
+    copy.joinpath('product', 'SOME_DATA.tif').write_text('corrupt')
+    assert _verify_checksum(log, metadata_path, dry_run=False, copied_to=copy) is False
+    assert _verify_checksum(log, metadata_path, dry_run=False) is True
+
+
+class _FakeDatasetResource:
+    def __init__(self) -> None:
+        self.added_locations = []
+        self.archived_locations = []
+        self.transaction_count = 0
+        # Index writes wait until this returns True.
+        self.writes_allowed = None
+        self._db = self
+
+    def get(self, id_):
+        return _FakeDataset() if id_ == _FakeDataset.id else None
+
+    @contextmanager
+    def begin(self):
+        if self.writes_allowed is not None:
+            deadline = time.monotonic() + 10
+            while not self.writes_allowed():
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+        self.transaction_count += 1
+        yield self
+
+    def insert_dataset_location(self, id_, uri):
+        self.added_locations.append((id_, uri))
+
+    def archive_location(self, id_, uri):
+        self.archived_locations.append((id_, uri))
+
+
+class _FakeIndex:
+    def __init__(self) -> None:
+        self.datasets = _FakeDatasetResource()
+
+
+def _write_source(base: Path, data_checksum='da39a3ee5e6b4b0d3255bfef95601890afd80709', names=('LS7_TEST',)):
+    source_base, dest_base = base.joinpath('source'), base.joinpath('dest')
+    source_base.mkdir()
+    dest_base.mkdir()
+    register_base_directory(source_base)
+    register_base_directory(dest_base)
+
+    write_files({
+        name: {
+            'ga-metadata.yaml': 'id: %s\n' % _TEST_UUID,
+            'product': {
+                'SOME_DATA.tif': ''
+            },
+            'package.sha1':
+                data_checksum + '\tproduct/SOME_DATA.tif\n'
+                'a2662e1cd831ad4ef316f4a8dfb9c45067821146\tga-metadata.yaml\n'
+        }
+        for name in names
+    }, containing_dir=source_base)
+    return source_base.joinpath(names[0], 'ga-metadata.yaml'), dest_base
+
+
+@pytest.mark.parametrize('runner', [
+    TaskRunner(),
+    TaskRunner('multiproc', 2),
+])
+def test_move_all(tmpdir, runner: TaskRunner):
+    base = Path(str(tmpdir))
+    metadata_path, dest_base = _write_source(base)
+
+    index = _FakeIndex()
+    manifest_path = base.joinpath('move-manifest.jsonl')
+    with MoveManifest(manifest_path) as manifest:
+        try:
+            move_all(index, iter([metadata_path]), dest_base, manifest=manifest, runner=runner)
+        finally:
+            runner.stop()
+
+    assert dest_base.joinpath('LS7_TEST', 'product', 'SOME_DATA.tif').exists()
+    # Index updates happen in this process, whichever runner copied the data.
+    assert index.datasets.added_locations == [
+        (_FakeDataset.id, dest_base.joinpath('LS7_TEST', 'ga-metadata.yaml').as_uri())
+    ]
+    assert index.datasets.archived_locations == [(_FakeDataset.id, metadata_path.as_uri())]
+    assert MoveManifest.read_stages(manifest_path) == {str(metadata_path): MoveStage.INDEXED}
+
+
+def test_move_all_indexes_in_batches(tmpdir):
+    base = Path(str(tmpdir))
+    names = ['LS7_TEST_{}'.format(i) for i in range(6)]
+    metadata_path, dest_base = _write_source(base, names=names)
+    metadata_paths = [metadata_path.parent.parent.joinpath(name, 'ga-metadata.yaml') for name in names]
+
+    runner = TaskRunner()
+    runner.set_result_workers(2)
+    runner.set_result_batch_size(10)
+
+    # The first write waits for every copy, so that the other results are queued together.
+    index = _FakeIndex()
+    index.datasets.writes_allowed = lambda: all(dest_base.joinpath(name).exists() for name in names)
+
+    manifest_path = base.joinpath('move-manifest.jsonl')
+    with MoveManifest(manifest_path) as manifest:
+        try:
+            move_all(index, iter(metadata_paths), dest_base, manifest=manifest, runner=runner)
+        finally:
+            runner.stop()
+
+    assert sorted(uri for _, uri in index.datasets.archived_locations) == sorted(p.as_uri() for p in metadata_paths)
+    # Each batch of results is indexed together.
+    assert 1 < index.datasets.transaction_count < len(names)
+    assert MoveManifest.read_stages(manifest_path) == {str(p): MoveStage.INDEXED for p in metadata_paths}
+
+
+def test_resume_after_unrecorded_copy(tmpdir):
+    base = Path(str(tmpdir))
+    metadata_path, dest_base = _write_source(base)
+    manifest_path = base.joinpath('move-manifest.jsonl')
+
+    # The previous run was killed after renaming its copy into place, but before recording it.
+    shutil.copytree(str(metadata_path.parent), str(dest_base.joinpath('LS7_TEST')))
+    with MoveManifest(manifest_path) as manifest:
+        manifest.record(_FakeMover(metadata_path), MoveStage.PLANNED)
+
+    index = _FakeIndex()
+    with MoveManifest(manifest_path, resume=True) as manifest:
+        move_all(index, iter([metadata_path]), dest_base, manifest=manifest)
+
+    assert index.datasets.added_locations == [
+        (_FakeDataset.id, dest_base.joinpath('LS7_TEST', 'ga-metadata.yaml').as_uri())
+    ]
+    assert MoveManifest.read_stages(manifest_path) == {str(metadata_path): MoveStage.INDEXED}
+
+
+def test_failed_checksum_is_recorded(tmpdir):
+    base = Path(str(tmpdir))
+    metadata_path, dest_base = _write_source(base, data_checksum='0' * 40)
+    manifest_path = base.joinpath('move-manifest.jsonl')
+
+    index = _FakeIndex()
+    with MoveManifest(manifest_path) as manifest:
+        move_all(index, iter([metadata_path]), dest_base, manifest=manifest)
+
+    assert not dest_base.joinpath('LS7_TEST').exists()
+    assert index.datasets.added_locations == []
+    assert MoveManifest.read_stages(manifest_path) == {str(metadata_path): MoveStage.FAILED}
+
+    # A resumed run tries the copy again.
+    with MoveManifest(manifest_path, resume=True) as manifest:
+        move_all(index, iter([metadata_path]), dest_base, manifest=manifest, checksum=False)
+
+    assert MoveManifest.read_stages(manifest_path) == {str(metadata_path): MoveStage.INDEXED}
@@ -36,3 +36,19 @@ pwd
 
     proc = pbs.pbsdsh(0, 'exit 10', test_mode=True)
     assert proc.wait() == 10
+
+
+def test_emulated_pbs(tmpdir):
+    from pathlib import Path
+
+    with pbs.emulated_pbs(Path(str(tmpdir)), node_count=3, cores_per_node=4) as nodes:
+        assert pbs.is_under_pbs()
+        assert [n.is_main for n in nodes] == [True, False, False]
+        assert pbs.total_cores() == 12
+
+        # Nodes are run locally, without pbsdsh.
+        proc = pbs.pbsdsh(nodes[1].offset, 'exit 3')
+        assert proc.wait() == 3
+
+    assert pbs.is_under_pbs() is False
+    assert pbs.is_emulated() is False
@@ -1,8 +1,11 @@
+import functools
 import json
 from io import StringIO
 from uuid import UUID
 
 import os
+import pickle
+from pathlib import Path
 
 import pytest
 from boltons.jsonutils import JSONLIterator
@@ -14,7 +17,8 @@ from typing import List
 
 from digitalearthau.events import TaskEvent, NodeMessage, Status
 from digitalearthau.runners import model
-from digitalearthau.runners.celery_environment import _celery_event_to_task
+from digitalearthau.runners.celery_environment import (_celery_event_to_task, _input_datasets_header,
+                                                       _TaskEventRecorder, task_input_dataset_ids)
 from . import qsub
 
 import celery.events.state as celery_state
@@ -70,16 +74,305 @@ def test_remove_args():
     assert qsub.remove_args('--removed', args3, 0) == ['--foo', 'bar']
 
 
+class _FakeQSub:
+    """Returns job ids in order, after failing the given number of times for each job name."""
+
+    def __init__(self, failures=None) -> None:
+        self.failures = dict(failures or {})
+        self.calls = []
+
+    def __call__(self, args, script):
+        self.calls.append(args)
+        name = args[args.index('-N') + 1]
+        error = self.failures.get(name)
+        if error:
+            self.failures[name] = error[1:]
+            raise qsub.JobSubmissionError("Error submitting qsub job", '', error[0])
+        return '{}.gadi-pbs'.format(len(self.calls))
+
+
+def _submissions(count, concurrent_jobs=1):
+    keys = ['job-{}'.format(i) for i in range(count)]
+    return [
+        qsub.QSubSubmission(key, ['-N', key, '-W', 'umask=33', '--', 'echo'],
+                            depends_on=keys[i - concurrent_jobs] if i >= concurrent_jobs else None)
+        for i, key in enumerate(keys)
+    ]
+
+
+def test_submission_retries_transient_errors():
+    fake = _FakeQSub(failures={'job-1': ['qsub: Server busy, try again']})
+    engine = qsub.SubmissionEngine(qsub=fake, backoff_secs=0, max_backoff_secs=0)
+
+    results = list(engine.submit_all(_submissions(3)))
+    assert [r.attempts for r in results] == [1, 2, 1]
+    assert all(r.job_id for r in results)
+    # Each job waits for the one before it.
+    assert results[0].args == ['-N', 'job-0', '-W', 'umask=33', '--', 'echo']
+    assert results[1].args == ['-N', 'job-1', '-W', 'umask=33,depend=afterany:' + results[0].job_id, '--', 'echo']
+    assert results[2].args == ['-N', 'job-2', '-W', 'umask=33,depend=afterany:' + results[1].job_id, '--', 'echo']
+
+
+def test_ambiguous_submission_errors():
+    # The server may have accepted the job before the connection dropped.
+    fake = _FakeQSub(failures={'job-0': ['qsub: End of File'], 'job-1': ['qsub: End of File']})
+    found = {'job-0': ['1234.gadi-pbs']}
+    engine = qsub.SubmissionEngine(qsub=fake, find_jobs=lambda name: found.get(name, []),
+                                   backoff_secs=0, max_backoff_secs=0)
+
+    results = list(engine.submit_all(_submissions(2, concurrent_jobs=2)))
+    # One was found, so it isn't submitted again: the other wasn't, so it's retried.
+    assert isinstance(results[0].error, qsub.PossiblySubmittedError)
+    assert '1234.gadi-pbs' in str(results[0].error)
+    assert [r.attempts for r in results] == [1, 2]
+    assert results[1].job_id
+
+    # Unnamed jobs can't be checked.
+    engine = qsub.SubmissionEngine(qsub=_always_fails('qsub: Timed out'), find_jobs=lambda name: [],
+                                   backoff_secs=0, max_backoff_secs=0)
+    with pytest.raises(qsub.PossiblySubmittedError):
+        engine.submit(qsub.QSubSubmission(None, ['--', 'echo']))
+
+
+def _always_fails(message):
+    def run_qsub(args, script):
+        raise qsub.JobSubmissionError("Error submitting qsub job", '', message)
+    return run_qsub
+
+
+def test_submission_failure_skips_dependents():
+    fake = _FakeQSub(failures={'job-0': ['qsub: Unknown queue']})
+    engine = qsub.SubmissionEngine(qsub=fake, backoff_secs=0, max_backoff_secs=0)
+
+    results = list(engine.submit_all(_submissions(3, concurrent_jobs=2)))
+    assert [bool(r.job_id) for r in results] == [False, True, False]
+    assert results[0].attempts == 1
+    assert len(fake.calls) == 2
+
+
+def test_submission_record_makes_reruns_idempotent(tmpdir):
+    record_path = Path(str(tmpdir)).joinpath('submitted.jsonl')
+    # The first run is interrupted by a persistent error.
+    fake = _FakeQSub(failures={'job-2': ['qsub: Server busy'] * 2})
+    engine = qsub.SubmissionEngine(qsub.SubmissionRecord(record_path), qsub=fake, max_attempts=2,
+                                   backoff_secs=0, max_backoff_secs=0)
+    first_run = list(engine.submit_all(_submissions(3)))
+    assert [bool(r.job_id) for r in first_run] == [True, True, False]
+
+    fake = _FakeQSub()
+    engine = qsub.SubmissionEngine(qsub.SubmissionRecord(record_path), qsub=fake)
+    second_run = list(engine.submit_all(_submissions(3)))
+    assert [r.recorded for r in second_run] == [True, True, False]
+    assert [r.job_id for r in second_run[:2]] == [r.job_id for r in first_run[:2]]
+    # Only the missing job was submitted, still depending on the recorded one.
+    assert fake.calls == [second_run[2].args]
+    assert 'umask=33,depend=afterany:{}'.format(first_run[1].job_id) in second_run[2].args
+
+
+def test_adaptive_queue_size():
+    window = qsub.AdaptiveQueueSize(4, maximum=6, max_rss_mb=1000)
+
+    # Results come back quickly: grow to the maximum
+    for i in range(4):
+        window.task_completed(latency_secs=1.0, now=i, rss_mb=100)
+    assert window.size == 6
+    assert window.metrics(in_flight=6) == qsub.QueueMetrics(
+        window=6, in_flight=6, completed=4, completion_rate=1.0, latency_secs=1.0, rss_mb=100
+    )
+
+    # Tasks start queueing: their latency climbs
+    for i in range(4, 10):
+        window.task_completed(latency_secs=10.0, now=i, rss_mb=100)
+    assert window.size < 6
+
+    # Memory pressure shrinks it even when latency is fine.
+    window = qsub.AdaptiveQueueSize(8, max_rss_mb=1000)
+    window.task_completed(latency_secs=1.0, now=0, rss_mb=2000)
+    assert window.size == 6
+
+
+def test_adaptive_queue_follows_slower_tasks():
+    window = qsub.AdaptiveQueueSize(8, maximum=32)
+    now = 0
+    for _ in range(50):
+        now += 1
+        window.task_completed(latency_secs=5.0, now=now, rss_mb=100, in_flight=window.size - 1)
+    assert window.size == 32
+
+    # The tasks themselves get slower: one shrink doesn't help, so the window recovers rather than collapsing.
+    sizes = []
+    for _ in range(100):
+        now += 1
+        sizes.append(window.task_completed(latency_secs=60.0, now=now, rss_mb=100, in_flight=window.size - 1))
+    assert min(sizes) == 24
+    assert window.size == 32
+
+
+def test_adaptive_queue_shrinks_while_queueing():
+    # Four workers taking 5 seconds a task: anything more than four in flight just waits.
+    window = qsub.AdaptiveQueueSize(4, maximum=100, workers=4)
+    for now in range(300):
+        latency = max(5.0, window.size * 5 / 4)
+        window.task_completed(latency_secs=latency, now=now, rss_mb=100, in_flight=window.size - 1)
+        assert window.size >= 4
+    assert window.size < 16
+
+
+def test_adaptive_queue_grows_while_workers_idle():
+    window = qsub.AdaptiveQueueSize(2, workers=16, maximum=64)
+    assert window.task_completed(latency_secs=1.0, now=0, rss_mb=100, in_flight=1) == 16
+    # Latency is climbing, but workers are still waiting for tasks.
+    assert window.task_completed(latency_secs=10.0, now=1, rss_mb=100, in_flight=1) == 17
+
+
+def test_run_tasks_with_adaptive_queue():
+    from datacube.executor import SerialExecutor
+
+    window = qsub.AdaptiveQueueSize(2, maximum=5)
+    results = []
+    successful, failed = qsub.run_tasks(iter(range(20)), SerialExecutor(), lambda task: task * 2,
+                                        process_result=results.append, queue_size=window)
+    assert (successful, failed) == (20, 0)
+    assert sorted(results) == [i * 2 for i in range(20)]
+    assert window.completed == 20
+
+
+def test_runner_options():
+    import click
+    from click.testing import CliRunner
+
+    @click.command()
+    @qsub.with_qsub_runner()
+    def command(runner, **options):
+        click.echo('warm={}'.format(runner._warm_workers))  # pylint: disable=protected-access
+
+    assert CliRunner().invoke(command, []).output == 'warm=False\n'
+    assert CliRunner().invoke(command, ['--warm-workers']).output == 'warm=True\n'
+
+
+def test_runner_queue_is_adaptive_on_request():
+    runner = qsub.TaskRunner()
+    runner.start()
+    assert runner.queue_metrics() is None
+
+    runner = qsub.TaskRunner()
+    runner.set_adaptive_queue(True)
+    runner.start()
+    assert runner.queue_metrics().window == 10
+    assert runner.queue_metrics().in_flight == 0
+
+    # An explicit size is always fixed.
+    runner = qsub.TaskRunner()
+    runner.set_adaptive_queue(True)
+    runner.set_qsize(3)
+    runner.start()
+    assert runner.queue_metrics() is None
+
+
+def _double_odd(multiplier, task):
+    if task % 2 == 0:
+        raise ValueError("Even task {}".format(task))
+    return task * multiplier
+
+
+def test_run_tasks_in_batches(tmpdir):
+    from datacube.executor import SerialExecutor
+
+    class CountingExecutor(SerialExecutor):
+        submissions = []
+
+        def submit(self, func, *args, **kwargs):
+            self.submissions.append(kwargs)
+            return super().submit(func, *args, **kwargs)
+
+    executor = CountingExecutor()
+    results = []
+    successful, failed = qsub.run_tasks(iter(range(10)), executor, functools.partial(_double_odd, 3),
+                                        process_result=results.append, queue_size=4,
+                                        batch_size=3, shared_dir=str(tmpdir))
+    assert (successful, failed) == (5, 5)
+    assert sorted(results) == [3, 9, 15, 21, 27]
+    assert [len(s['tasks']) for s in executor.submissions] == [3, 3, 3, 1]
+    # The function is written once, and only its path is sent.
+    [shared] = Path(str(tmpdir)).glob('run-task-*.pickle')
+    assert {s['function_path'] for s in executor.submissions} == {str(shared)}
+
+
+def test_failed_tasks_raise_in_worker(tmpdir):
+    # So that executors such as celery record the task as failed, rather than successful.
+    function_path = str(qsub.SharedTaskFunction(functools.partial(_double_odd, 3), Path(str(tmpdir))).path)
+    assert qsub.run_task_batch(function_path, [1, 3]) == [3, 9]
+    with pytest.raises(qsub.TaskFailedError) as e:
+        qsub.run_task_batch(function_path, [1, 2])
+    done, failure = e.value.result
+    assert done == 3
+    assert 'Even task 2' in failure.error
+
+    measured = qsub.MeasuredTask(functools.partial(_double_odd, 3))
+    assert measured(task=1).result == 3
+    with pytest.raises(qsub.TaskFailedError) as e:
+        measured(task=2)
+    # The failure survives being sent back from a worker.
+    measurement = pickle.loads(pickle.dumps(e.value)).result
+    assert measurement.description == '2'
+    assert 'Even task 2' in measurement.result.error
+
+
+def test_runner_needs_work_directory():
+    assert not qsub.TaskRunner().needs_work_directory()
+    assert not qsub.TaskRunner('multiproc', 4).needs_work_directory()
+    assert qsub.TaskRunner('pbs_celery').needs_work_directory()
+
+    runner = qsub.TaskRunner()
+    runner.set_measure_tasks(True)
+    assert runner.needs_work_directory()
+
+    # Batched task functions are shared with remote workers through it.
+    runner = qsub.TaskRunner('celery', ('localhost', 6379))
+    runner.set_batch_size(10)
+    assert runner.needs_work_directory()
+
+
 #################################################
 # Tests of Celery Executor Related Functionality
 #################################################
 
 # Three events: received, started, success
-_SUCCESS_CELERY_EVENTS = r"""
-{"hostname": "celery@kveikur", "utcoffset": -11, "pid": 29517, "clock": 3, "uuid": "13d1e3c4-cecd-4306-903f-97ed1ec2d73d", "name": "datacube._celery_runner.run_cloud_pickled_function", "args": "(functools.partial(<function do_fc_task at 0x7fb79d1332f0>, {'source_type': 'ls8_nbar_albers', 'output_type': 'ls8_fc_albers', 'version': '${version}', 'description': 'Landsat 8 Fractional Cover 25 metre, 100km tile, Australian Albers Equal Area projection (EPSG:3577)', 'product_type': 'fractional_cover', 'location': '/g/data/fk4/datacube/002/', 'file_path_template': 'LS8_OLI_FC/{tile_index[0]}_{tile_index[1]}/LS8_OLI_FC_3577_{tile_index[0]}_{tile_index[1]}_{start_time}_v{version}.nc', 'partial_ncml_path_template': 'LS8_OLI_FC/{tile_index[0]}_{tile_index[1]}/LS8_OLI_FC_3577_{tile_index[0]}_{tile_index[1]}_{start_time}.ncml', 'ncml_path_template': 'LS8_OLI_FC/LS8_OLI_FC_3577_{tile_index[0]}_{tile_index[1]}.ncml', 'sensor_regression_coefficients': {'blue': [0.00041, 0.9747], 'green': [0.00289, 0.99779], 'red': [0.00274, 1.00446], 'nir': [4e-05, 0.98906], 'swir1': [0.00256, 0.99467], 'swir2': [-0.00327, 1.02551]}, 'global_attributes': {'title': 'Fractional Cover 25 v2', 'summary': \"The Fractional Cover (FC)...,)", "kwargs": "{'task': {'nbar': Tile<sources=<xarray.DataArray (time: 1)>\narray([ (Dataset <id=60bc52f1-7a70-43f2-bc8d-2bd138eb2aba type=ls8_nbar_albers location=/g/data/rs0/datacube/002/LS8_OLI_NBAR/-11_-28/LS8_OLI_NBAR_3577_-11_-28_2015_v1496400956.nc>,)], dtype=object)\nCoordinates:\n  * time     (time) datetime64[ns] 2015-03-04T01:51:14.500000,\n\tgeobox=GeoBox(4000, 4000, Affine(25.0, 0.0, -1100000.0,\n       0.0, -25.0, -2700000.0), EPSG:3577)>, 'tile_index': (-11, -28, numpy.datetime64('2015-03-04T01:51:14.500000000')), 'filename': '/g/data/fk4/datacube/002/LS8_OLI_FC/-11_-28/LS8_OLI_FC_3577_-11_-28_20150304015114500000_v1507241388.nc'}}", "root_id": "13d1e3c4-cecd-4306-903f-97ed1ec2d73d", "parent_id": null, "retries": 0, "eta": null, "expires": null, "timestamp": 1507241402.9484067, "type": "task-received", "local_received": 1507241402.9497962, "state": "RECEIVED"}
-{"hostname": "celery@kveikur", "utcoffset": -11, "pid": 29517, "clock": 99, "uuid": "13d1e3c4-cecd-4306-903f-97ed1ec2d73d", "timestamp": 1507241505.7179525, "type": "task-started", "local_received": 1507241505.7221746, "state": "STARTED"}
-{"hostname": "celery@kveikur", "utcoffset": -11, "pid": 29517, "clock": 171, "uuid": "13d1e3c4-cecd-4306-903f-97ed1ec2d73d", "result": "<xarray.DataArray (time: 1)>\narray([ Dataset <id=437d96cb-b65d-4186-8501-18b40658bac6 type=ls8_fc_albers location=/g/data/fk4/datacube/002/LS8_OLI_FC/-11_-28/LS8_OLI_FC_3577_-11_-28_20150304015114500000_v1507241388.nc>], dtype=object)\nCoordinates:\n  * time     (time) datetime64[ns] 2015-03-04T01:51:14.500000", "runtime": 70.13666241300234, "timestamp": 1507241575.8904157, "type": "task-succeeded", "local_received": 1507241575.891886, "state": "SUCCESS"}
-"""
+_SUCCESS_CELERY_EVENTS = '\n'.join([
+    '',
+    r"""{"hostname": "celery@kveikur", "utcoffset": -11, "pid": 29517, "clock": 3, "uuid": "13d1e3c4-cecd-43"""
+    r"""06-903f-97ed1ec2d73d", "name": "datacube._celery_runner.run_cloud_pickled_function", "args": "(funct"""
+    r"""ools.partial(<function do_fc_task at 0x7fb79d1332f0>, {'source_type': 'ls8_nbar_albers', 'output_typ"""
+    r"""e': 'ls8_fc_albers', 'version': '${version}', 'description': 'Landsat 8 Fractional Cover 25 metre, 1"""
+    r"""00km tile, Australian Albers Equal Area projection (EPSG:3577)', 'product_type': 'fractional_cover',"""
+    r""" 'location': '/g/data/fk4/datacube/002/', 'file_path_template': 'LS8_OLI_FC/{tile_index[0]}_{tile_in"""
+    r"""dex[1]}/LS8_OLI_FC_3577_{tile_index[0]}_{tile_index[1]}_{start_time}_v{version}.nc', 'partial_ncml_p"""
+    r"""ath_template': 'LS8_OLI_FC/{tile_index[0]}_{tile_index[1]}/LS8_OLI_FC_3577_{tile_index[0]}_{tile_ind"""
+    r"""ex[1]}_{start_time}.ncml', 'ncml_path_template': 'LS8_OLI_FC/LS8_OLI_FC_3577_{tile_index[0]}_{tile_i"""
+    r"""ndex[1]}.ncml', 'sensor_regression_coefficients': {'blue': [0.00041, 0.9747], 'green': [0.00289, 0.9"""
+    r"""9779], 'red': [0.00274, 1.00446], 'nir': [4e-05, 0.98906], 'swir1': [0.00256, 0.99467], 'swir2': [-0"""
+    r""".00327, 1.02551]}, 'global_attributes': {'title': 'Fractional Cover 25 v2', 'summary': \"The Fractio"""
+    r"""nal Cover (FC)...,)", "kwargs": "{'task': {'nbar': Tile<sources=<xarray.DataArray (time: 1)>\narray("""
+    r"""[ (Dataset <id=60bc52f1-7a70-43f2-bc8d-2bd138eb2aba type=ls8_nbar_albers location=/g/data/rs0/datacu"""
+    r"""be/002/LS8_OLI_NBAR/-11_-28/LS8_OLI_NBAR_3577_-11_-28_2015_v1496400956.nc>,)], dtype=object)\nCoordi"""
+    r"""nates:\n  * time     (time) datetime64[ns] 2015-03-04T01:51:14.500000,\n\tgeobox=GeoBox(4000, 4000, """
+    r"""Affine(25.0, 0.0, -1100000.0,\n       0.0, -25.0, -2700000.0), EPSG:3577)>, 'tile_index': (-11, -28,"""
+    r""" numpy.datetime64('2015-03-04T01:51:14.500000000')), 'filename': '/g/data/fk4/datacube/002/LS8_OLI_F"""
+    r"""C/-11_-28/LS8_OLI_FC_3577_-11_-28_20150304015114500000_v1507241388.nc'}}", "root_id": "13d1e3c4-cecd"""
+    r"""-4306-903f-97ed1ec2d73d", "parent_id": null, "retries": 0, "eta": null, "expires": null, "timestamp"""
+    r"""": 1507241402.9484067, "type": "task-received", "local_received": 1507241402.9497962, "state": "RECE"""
+    r"""IVED"}""",
+    r"""{"hostname": "celery@kveikur", "utcoffset": -11, "pid": 29517, "clock": 99, "uuid": "13d1e3c4-cecd-4"""
+    r"""306-903f-97ed1ec2d73d", "timestamp": 1507241505.7179525, "type": "task-started", "local_received": 1"""
+    r"""507241505.7221746, "state": "STARTED"}""",
+    r"""{"hostname": "celery@kveikur", "utcoffset": -11, "pid": 29517, "clock": 171, "uuid": "13d1e3c4-cecd-"""
+    r"""4306-903f-97ed1ec2d73d", "result": "<xarray.DataArray (time: 1)>\narray([ Dataset <id=437d96cb-b65d-"""
+    r"""4186-8501-18b40658bac6 type=ls8_fc_albers location=/g/data/fk4/datacube/002/LS8_OLI_FC/-11_-28/LS8_O"""
+    r"""LI_FC_3577_-11_-28_20150304015114500000_v1507241388.nc>], dtype=object)\nCoordinates:\n  * time     """
+    r"""(time) datetime64[ns] 2015-03-04T01:51:14.500000", "runtime": 70.13666241300234, "timestamp": 150724"""
+    r"""1575.8904157, "type": "task-succeeded", "local_received": 1507241575.891886, "state": "SUCCESS"}""",
+    '',
+])
 
 # Three events produced: pending, active, success
 _EXPECTED_SUCCESS = [
@@ -99,7 +392,7 @@ _EXPECTED_SUCCESS = [
         input_datasets=(UUID('60bc52f1-7a70-43f2-bc8d-2bd138eb2aba'),),
         output_datasets=None,
         job_parameters={},
-        # All parent_ids are calculated from the below "@mock.patch.dict(os.environ, {'PBS_JOBID': '87654321.gadi-pbs'})"
+        # All parent_ids are calculated from the PBS_JOBID of 87654321.gadi-pbs mocked below
         parent_id=UUID('6c5e209a-6d56-5460-9a30-20e264492d5c')),
     TaskEvent(
         timestamp=datetime(2017, 10, 5, 22, 11, 45, 717952, tzinfo=tz.tzutc()),
@@ -140,12 +433,47 @@ _EXPECTED_SUCCESS = [
 ]
 
 # JSONL format needs one per line
-# pylint: disable=line-too-long
-_FAIL_CELERY_EVENTS = r"""
-{"hostname": "celery@kveikur", "utcoffset": -11, "pid": 27204, "clock": 156, "uuid": "410e05e3-4058-4bfa-bbc2-5fc085464841", "name": "datacube._celery_runner.run_cloud_pickled_function", "args": "(functools.partial(<function do_fc_task at 0x7f4dd49ff2f0>, {'source_type': 'ls8_nbar_albers', 'output_type': 'ls8_fc_albers', 'version': '${version}', 'description': 'Landsat 8 Fractional Cover 25 metre, 100km tile, Australian Albers Equal Area projection (EPSG:3577)', 'product_type': 'fractional_cover', 'location': '/g/data/fk4/datacube/002/', 'file_path_template': 'LS8_OLI_FC/{tile_index[0]}_{tile_index[1]}/LS8_OLI_FC_3577_{tile_index[0]}_{tile_index[1]}_{start_time}_v{version}.nc', 'partial_ncml_path_template': 'LS8_OLI_FC/{tile_index[0]}_{tile_index[1]}/LS8_OLI_FC_3577_{tile_index[0]}_{tile_index[1]}_{start_time}.ncml', 'ncml_path_template': 'LS8_OLI_FC/LS8_OLI_FC_3577_{tile_index[0]}_{tile_index[1]}.ncml', 'sensor_regression_coefficients': {'blue': [0.00041, 0.9747], 'green': [0.00289, 0.99779], 'red': [0.00274, 1.00446], 'nir': [4e-05, 0.98906], 'swir1': [0.00256, 0.99467], 'swir2': [-0.00327, 1.02551]}, 'global_attributes': {'title': 'Fractional Cover 25 v2', 'summary': \"The Fractional Cover (FC)...,)", "kwargs": "{'task': {'nbar': Tile<sources=<xarray.DataArray (time: 1)>\narray([ (Dataset <id=591fce1d-5268-44e8-a8b0-e38e6cfbb749 type=ls8_nbar_albers location=/g/data/rs0/datacube/002/LS8_OLI_NBAR/-11_-28/LS8_OLI_NBAR_3577_-11_-28_2015_v1496400956.nc>,)], dtype=object)\nCoordinates:\n  * time     (time) datetime64[ns] 2015-10-07T01:45:20,\n\tgeobox=GeoBox(4000, 4000, Affine(25.0, 0.0, -1100000.0,\n       0.0, -25.0, -2700000.0), EPSG:3577)>, 'tile_index': (-11, -28, numpy.datetime64('2015-10-07T01:45:20.000000000')), 'filename': '/g/data/fk4/datacube/002/LS8_OLI_FC/-11_-28/LS8_OLI_FC_3577_-11_-28_20151007014520000000_v1507076205.nc'}}", "root_id": "410e05e3-4058-4bfa-bbc2-5fc085464841", "parent_id": null, "retries": 0, "eta": null, "expires": null, "timestamp": 1507182775.3364704, "type": "task-received", "local_received": 1507182775.337901, "state": "RECEIVED"}
-{"hostname": "celery@kveikur", "utcoffset": -11, "pid": 27204, "clock": 157, "uuid": "410e05e3-4058-4bfa-bbc2-5fc085464841", "timestamp": 1507182775.3381906, "type": "task-started", "local_received": 1507182775.3400292, "state": "STARTED"}
-{"hostname": "celery@kveikur", "utcoffset": -11, "pid": 27204, "clock": 158, "uuid": "410e05e3-4058-4bfa-bbc2-5fc085464841", "exception": "FileExistsError(17, 'Output file already exists')", "traceback": "Traceback (most recent call last):\n  File \"/g/data/v10/public/modules/agdc-py3-env/20170728/envs/agdc/lib/python3.6/site-packages/celery/app/trace.py\", line 374, in trace_task\n    R = retval = fun(*args, **kwargs)\n  File \"/g/data/v10/public/modules/agdc-py3-env/20170728/envs/agdc/lib/python3.6/site-packages/celery/app/trace.py\", line 629, in __protected_call__\n    return self.run(*args, **kwargs)\n  File \"/home/jez/prog/datacube/datacube/_celery_runner.py\", line 57, in run_cloud_pickled_function\n    return func(*args, **kwargs)\n  File \"/g/data/v10/public/modules/agdc-py3-env/20170728/envs/agdc/lib/python3.6/site-packages/fc/fc_app.py\", line 144, in do_fc_task\n    raise OSError(errno.EEXIST, 'Output file already exists', str(file_path))\nFileExistsError: [Errno 17] Output file already exists: '/g/data/fk4/datacube/002/LS8_OLI_FC/-11_-28/LS8_OLI_FC_3577_-11_-28_20151007014520000000_v1507076205.nc'\n", "timestamp": 1507182775.3487089, "type": "task-failed", "local_received": 1507182775.3507082, "state": "FAILURE"}
-"""
+_FAIL_CELERY_EVENTS = '\n'.join([
+    '',
+    r"""{"hostname": "celery@kveikur", "utcoffset": -11, "pid": 27204, "clock": 156, "uuid": "410e05e3-4058-"""
+    r"""4bfa-bbc2-5fc085464841", "name": "datacube._celery_runner.run_cloud_pickled_function", "args": "(fun"""
+    r"""ctools.partial(<function do_fc_task at 0x7f4dd49ff2f0>, {'source_type': 'ls8_nbar_albers', 'output_t"""
+    r"""ype': 'ls8_fc_albers', 'version': '${version}', 'description': 'Landsat 8 Fractional Cover 25 metre,"""
+    r""" 100km tile, Australian Albers Equal Area projection (EPSG:3577)', 'product_type': 'fractional_cover"""
+    r"""', 'location': '/g/data/fk4/datacube/002/', 'file_path_template': 'LS8_OLI_FC/{tile_index[0]}_{tile_"""
+    r"""index[1]}/LS8_OLI_FC_3577_{tile_index[0]}_{tile_index[1]}_{start_time}_v{version}.nc', 'partial_ncml"""
+    r"""_path_template': 'LS8_OLI_FC/{tile_index[0]}_{tile_index[1]}/LS8_OLI_FC_3577_{tile_index[0]}_{tile_i"""
+    r"""ndex[1]}_{start_time}.ncml', 'ncml_path_template': 'LS8_OLI_FC/LS8_OLI_FC_3577_{tile_index[0]}_{tile"""
+    r"""_index[1]}.ncml', 'sensor_regression_coefficients': {'blue': [0.00041, 0.9747], 'green': [0.00289, 0"""
+    r""".99779], 'red': [0.00274, 1.00446], 'nir': [4e-05, 0.98906], 'swir1': [0.00256, 0.99467], 'swir2': ["""
+    r"""-0.00327, 1.02551]}, 'global_attributes': {'title': 'Fractional Cover 25 v2', 'summary': \"The Fract"""
+    r"""ional Cover (FC)...,)", "kwargs": "{'task': {'nbar': Tile<sources=<xarray.DataArray (time: 1)>\narra"""
+    r"""y([ (Dataset <id=591fce1d-5268-44e8-a8b0-e38e6cfbb749 type=ls8_nbar_albers location=/g/data/rs0/data"""
+    r"""cube/002/LS8_OLI_NBAR/-11_-28/LS8_OLI_NBAR_3577_-11_-28_2015_v1496400956.nc>,)], dtype=object)\nCoor"""
+    r"""dinates:\n  * time     (time) datetime64[ns] 2015-10-07T01:45:20,\n\tgeobox=GeoBox(4000, 4000, Affin"""
+    r"""e(25.0, 0.0, -1100000.0,\n       0.0, -25.0, -2700000.0), EPSG:3577)>, 'tile_index': (-11, -28, nump"""
+    r"""y.datetime64('2015-10-07T01:45:20.000000000')), 'filename': '/g/data/fk4/datacube/002/LS8_OLI_FC/-11"""
+    r"""_-28/LS8_OLI_FC_3577_-11_-28_20151007014520000000_v1507076205.nc'}}", "root_id": "410e05e3-4058-4bfa"""
+    r"""-bbc2-5fc085464841", "parent_id": null, "retries": 0, "eta": null, "expires": null, "timestamp": 150"""
+    r"""7182775.3364704, "type": "task-received", "local_received": 1507182775.337901, "state": "RECEIVED"}""",
+    r"""{"hostname": "celery@kveikur", "utcoffset": -11, "pid": 27204, "clock": 157, "uuid": "410e05e3-4058-"""
+    r"""4bfa-bbc2-5fc085464841", "timestamp": 1507182775.3381906, "type": "task-started", "local_received": """
+    r"""1507182775.3400292, "state": "STARTED"}""",
+    r"""{"hostname": "celery@kveikur", "utcoffset": -11, "pid": 27204, "clock": 158, "uuid": "410e05e3-4058-"""
+    r"""4bfa-bbc2-5fc085464841", "exception": "FileExistsError(17, 'Output file already exists')", "tracebac"""
+    r"""k": "Traceback (most recent call last):\n  File \"/g/data/v10/public/modules/agdc-py3-env/20170728/e"""
+    r"""nvs/agdc/lib/python3.6/site-packages/celery/app/trace.py\", line 374, in trace_task\n    R = retval """
+    r"""= fun(*args, **kwargs)\n  File \"/g/data/v10/public/modules/agdc-py3-env/20170728/envs/agdc/lib/pyth"""
+    r"""on3.6/site-packages/celery/app/trace.py\", line 629, in __protected_call__\n    return self.run(*arg"""
+    r"""s, **kwargs)\n  File \"/home/jez/prog/datacube/datacube/_celery_runner.py\", line 57, in run_cloud_p"""
+    r"""ickled_function\n    return func(*args, **kwargs)\n  File \"/g/data/v10/public/modules/agdc-py3-env/"""
+    r"""20170728/envs/agdc/lib/python3.6/site-packages/fc/fc_app.py\", line 144, in do_fc_task\n    raise OS"""
+    r"""Error(errno.EEXIST, 'Output file already exists', str(file_path))\nFileExistsError: [Errno 17] Outpu"""
+    r"""t file already exists: '/g/data/fk4/datacube/002/LS8_OLI_FC/-11_-28/LS8_OLI_FC_3577_-11_-28_20151007"""
+    r"""014520000000_v1507076205.nc'\n", "timestamp": 1507182775.3487089, "type": "task-failed", "local_rece"""
+    r"""ived": 1507182775.3507082, "state": "FAILURE"}""",
+    '',
+])
 # Three events produced: pending, active, success
 _EXPECTED_FAILURE = [
     TaskEvent(
@@ -256,3 +584,183 @@ def test_celery_success_to_task(input_json: str, expected_events: List[TaskEvent
     assert len(events) == len(expected_events)
     for i, event in enumerate(events):
         assert event == expected_events[i]
+
+
+@mock.patch.dict(os.environ, {'PBS_JOBID': '87654321.gadi-pbs'})
+def test_task_event_recorder_evicts_finished_tasks():
+    state: celery_state.State = cr.app.events.State()
+    task_description = model.TaskDescription(
+        type_="fc.test",
+        task_dt=None,
+        events_path=None,
+        logs_path=None,
+        parameters={},
+        runtime_state=model.TaskAppState(
+            config_path=None,
+            task_serialisation_path=None,
+        )
+    )
+    written = []
+    recorder = _TaskEventRecorder(state, task_description, written.append)
+
+    success_events = list(JSONLIterator(StringIO(_SUCCESS_CELERY_EVENTS)))
+    fail_events = list(JSONLIterator(StringIO(_FAIL_CELERY_EVENTS)))
+
+    # Interleave the two tasks, checking the counts while both are in flight.
+    recorder.handle_event(success_events[0])
+    recorder.handle_event(fail_events[0])
+    recorder.handle_event(fail_events[1])
+    assert dict(recorder.counts) == {'RECEIVED': 1, 'STARTED': 1}
+
+    for event in success_events[1:] + fail_events[2:]:
+        recorder.handle_event(event)
+
+    assert [e.status for e in written] == [Status.PENDING, Status.PENDING, Status.ACTIVE,
+                                           Status.ACTIVE, Status.COMPLETE, Status.FAILED]
+    assert dict(recorder.counts) == {'SUCCESS': 1, 'FAILURE': 1}
+    # Finished tasks are no longer held by celery's state...
+    assert len(state.tasks) == 0
+
+    # ... and a late event for one isn't recorded again.
+    recorder.handle_event(success_events[1])
+    assert len(written) == 6
+    assert len(state.tasks) == 0
+
+
+def test_task_input_dataset_ids():
+    import numpy
+    import xarray
+    from datacube.api.grid_workflow import Tile
+    from datacube.model import Dataset
+
+    def dataset(id_):
+        d = mock.Mock(spec=Dataset)
+        d.id = UUID(id_)
+        return d
+
+    first, second = dataset('60bc52f1-7a70-43f2-bc8d-2bd138eb2aba'), dataset('591fce1d-5268-44e8-a8b0-e38e6cfbb749')
+    sources = numpy.empty(2, dtype=object)
+    sources[:] = [(first,), (second, first)]
+    task = {
+        'nbar': Tile(xarray.DataArray(sources, dims=['time']), geobox=None),
+        'tile_index': (-11, -28),
+        'filename': '/g/data/fk4/datacube/002/LS8_OLI_FC/-11_-28/LS8_OLI_FC_3577_-11_-28_2015_v1.nc',
+    }
+    assert task_input_dataset_ids(task) == (first.id, second.id)
+    assert task_input_dataset_ids({'datasets': [second]}) == (second.id,)
+
+
+@mock.patch.dict(os.environ, {'PBS_JOBID': '87654321.gadi-pbs'})
+def test_celery_task_with_input_datasets_header():
+    state: celery_state.State = cr.app.events.State()
+    task_description = model.TaskDescription(
+        type_="fc.test",
+        task_dt=None,
+        events_path=None,
+        logs_path=None,
+        parameters={},
+        runtime_state=model.TaskAppState(
+            config_path=None,
+            task_serialisation_path=None,
+        )
+    )
+    dataset_ids = (UUID('60bc52f1-7a70-43f2-bc8d-2bd138eb2aba'), UUID('591fce1d-5268-44e8-a8b0-e38e6cfbb749'))
+
+    events = []
+    for j in JSONLIterator(StringIO(_SUCCESS_CELERY_EVENTS)):
+        if j['type'] == 'task-received':
+            j['kwargs'] = _input_datasets_header(dataset_ids)
+        state.event(j)
+        events.append(_celery_event_to_task(task_description, state.tasks[j['uuid']], user='testuser'))
+
+    assert [e.input_datasets for e in events] == [dataset_ids] * 3
+    assert events == [e._replace(input_datasets=dataset_ids) for e in _EXPECTED_SUCCESS]
+
+
+def test_run_tasks_with_result_processor():
+    import threading
+    from datacube.executor import SerialExecutor
+
+    all_submitted = threading.Event()
+
+    class GatedExecutor(SerialExecutor):
+        submitted = 0
+
+        def submit(self, func, *args, **kwargs):
+            self.submitted += 1
+            if self.submitted == 20:
+                all_submitted.set()
+            return super().submit(func, *args, **kwargs)
+
+    batches = []
+
+    def slow_index_writes(results):
+        # Results are held up until every task is submitted: they mustn't hold up submission.
+        assert all_submitted.wait(timeout=10)
+        if 13 in results:
+            raise RuntimeError("Write failed")
+        batches.append(results)
+
+    processor = qsub.ResultProcessor(process_batch=slow_index_writes, batch_size=5)
+    successful, failed = qsub.run_tasks(iter(range(20)), GatedExecutor(), lambda task: task,
+                                        queue_size=4, result_processor=processor)
+
+    assert all(len(batch) <= 5 for batch in batches)
+    processed = sorted(r for batch in batches for r in batch)
+    assert successful == len(processed)
+    assert 13 not in processed
+    assert successful + failed == 20
+    assert failed >= 1
+
+
+def test_result_processor_runs_one_handler_at_a_time():
+    import threading
+    import time
+    running = []
+    overlapped = []
+
+    def index_writes(results):
+        running.append(results)
+        if len(running) > 1:
+            overlapped.append(results)
+        time.sleep(0.01)
+        running.remove(results)
+        if 3 in results:
+            raise qsub.BatchProcessingError("One write failed", failed_count=1)
+
+    processor = qsub.ResultProcessor(process_batch=index_writes, workers=4, batch_size=3)
+    for result in range(20):
+        processor.submit(result)
+    assert processor.close() == (19, 1)
+    assert not overlapped
+    assert all(not t.name.startswith('result-processor') for t in threading.enumerate())
+
+
+@pytest.mark.parametrize('batch_size', [None, 2])
+def test_run_tasks_measures_tasks(batch_size, tmpdir):
+    from datacube.executor import SerialExecutor
+
+    def run_task(task):
+        if task['tile_index'] == (1, 1):
+            raise ValueError("Bad tile")
+        return bytearray(1024 * 1024)
+
+    measurements = []
+    tasks = [dict(tile_index=(x, x)) for x in range(5)]
+    successful, failed = qsub.run_tasks(tasks, SerialExecutor(), run_task, queue_size=2,
+                                        batch_size=batch_size, shared_dir=str(tmpdir),
+                                        on_task_measured=measurements.append)
+    assert (successful, failed) == (4, 1)
+
+    assert [m.description for m in measurements] == ['(0, 0)', '(1, 1)', '(2, 2)', '(3, 3)', '(4, 4)']
+    for m in measurements:
+        assert m.submitted <= m.started <= m.finished
+        assert m.node.pid == os.getpid()
+
+    event = measurements[1].task_event()
+    assert event.status == Status.FAILED
+    assert event.message.startswith('(1, 1)\n')
+    assert 'Bad tile' in event.message
+    assert event.resources.submitted <= event.resources.started <= event.resources.finished
+
+    assert measurements[0].task_event().status == Status.COMPLETE
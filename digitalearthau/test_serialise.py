@@ -1,11 +1,18 @@
+import io
+import json
+import os
 import pathlib
+import signal
+import typing
+import uuid
 
 import datetime
 import pytest
-from typing import NamedTuple, List
+from dateutil import tz
+from typing import Dict, NamedTuple, List, Optional, Tuple
 
 from digitalearthau import serialise
-from digitalearthau.events import Status
+from digitalearthau.events import NodeMessage, Status, TaskEvent
 from digitalearthau.runners.model import TaskDescription, DefaultJobParameters, TaskAppState
 from pathlib import Path
 
@@ -69,3 +76,150 @@ def test_dump_load_task_structure(tmpdir):
     result = serialise.load_structure(serialised_file, expected_type=TaskDescription)
 
     assert result == task_description
+
+
+class _Event(NamedTuple):
+    id: int
+    status: Status
+    path: pathlib.Path
+
+
+def test_buffered_json_lines(tmpdir):
+    path = Path(str(tmpdir)).joinpath('events.jsonl')
+    events = [_Event(i, Status.ACTIVE, Path('/tmp/{}'.format(i))) for i in range(22)]
+
+    with serialise.JsonLinesWriter(path.open('w'), buffer_size=200, fast_json=True) as writer:
+        writer.write_item(events[0])
+        # Held until the buffer is full.
+        assert path.read_text() == ''
+
+        for event in events[1:]:
+            writer.write_item(event)
+        written = path.read_text().splitlines()
+        assert 0 < len(written) < 22
+
+    lines = path.read_text().splitlines()
+    assert [json.loads(line) for line in lines] == [dict(id=e.id, status='active', path=str(e.path)) for e in events]
+    # The fast path keeps field order
+    assert lines[0] == '{"id":0, "status":"active", "path":"/tmp/0"}'
+
+
+def test_json_lines_sync_on_signal(tmpdir):
+    path = Path(str(tmpdir)).joinpath('events.jsonl')
+    previous_handler = signal.getsignal(signal.SIGUSR1)
+    try:
+        with serialise.JsonLinesWriter(path.open('w'), flush_interval=60) as writer:
+            writer.sync_on_signals(signal.SIGUSR1)
+            writer.write_item(_Event(1, Status.COMPLETE, Path('/tmp/1')))
+            assert path.read_text() == ''
+
+            os.kill(os.getpid(), signal.SIGUSR1)
+            assert path.read_text().splitlines() == ['{"id":1, "path":"/tmp/1", "status":"complete"}']
+    finally:
+        signal.signal(signal.SIGUSR1, previous_handler)
+
+
+class _SignallingFile(io.StringIO):
+    """Receives a signal in the middle of its first flush, and records any write that re-enters it."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.flushing = False
+        self.reentered = False
+        self.flush_count = 0
+
+    def write(self, s):
+        self.reentered = self.reentered or self.flushing
+        return super().write(s)
+
+    def flush(self):
+        self.reentered = self.reentered or self.flushing
+        self.flushing = True
+        try:
+            self.flush_count += 1
+            if self.flush_count == 1:
+                os.kill(os.getpid(), signal.SIGUSR1)
+        finally:
+            self.flushing = False
+
+
+def test_json_lines_signal_during_flush():
+    previous_handler = signal.getsignal(signal.SIGUSR1)
+    file_obj = _SignallingFile()
+    try:
+        writer = serialise.JsonLinesWriter(file_obj, flush_interval=60)
+        writer.sync_on_signals(signal.SIGUSR1)
+        writer.write_item(_Event(1, Status.COMPLETE, Path('/tmp/1')))
+        writer.flush()
+    finally:
+        signal.signal(signal.SIGUSR1, previous_handler)
+
+    assert not file_obj.reentered
+    # The requested sync flushed again after the interrupted flush finished.
+    assert file_obj.flush_count == 2
+    assert file_obj.getvalue() == '{"id":1, "path":"/tmp/1", "status":"complete"}\n'
+
+
+def test_roundtrip_nested_types():
+    class Inner(NamedTuple):
+        path: pathlib.Path
+        status: Status
+
+    class Outer(NamedTuple):
+        inners: List[Inner]
+        maybe_inner: Optional[Inner]
+        ids: Optional[Tuple[uuid.UUID, ...]]
+        by_name: Dict[str, Inner]
+
+    m = Outer(
+        inners=[Inner(Path('/tmp/a'), Status.ACTIVE), Inner(Path('/tmp/b'), Status.FAILED)],
+        maybe_inner=None,
+        ids=(uuid.UUID('47d97d2d-9aeb-5e07-8072-ebcf9424fc97'),),
+        by_name={'c': Inner(Path('/tmp/c'), Status.COMPLETE)},
+    )
+    d = serialise.type_to_dict(m)
+    # Plain types all the way down.
+    assert d['inners'][1] == {'path': '/tmp/b', 'status': 'failed'}
+    assert d['ids'] == ['47d97d2d-9aeb-5e07-8072-ebcf9424fc97']
+
+    assert serialise.dict_to_type(json.loads(json.dumps(d)), Outer) == m
+
+
+def test_event_roundtrip():
+    event = TaskEvent(
+        timestamp=datetime.datetime(2017, 10, 5, 22, 11, 45, 717952, tzinfo=tz.tzutc()),
+        event='task.complete',
+        name='fc',
+        user='dra547',
+        status=Status.COMPLETE,
+        id=uuid.UUID('9b1ad3d5-8ab4-4b91-a5b3-5d7e3f0bfa4c'),
+        parent_id=None,
+        message=None,
+        input_datasets=[uuid.UUID('d514c26a-d98f-47f1-b0de-15f7fe78c209')],
+        node=NodeMessage(hostname='r2043.gadi.nci.org.au', pid=4521),
+    )
+    line = serialise.to_lenient_json(serialise.type_to_dict(event), compact=True)
+    assert serialise.dict_to_type(json.loads(line), TaskEvent) == event
+
+    with pytest.raises(serialise.SerialisationError):
+        serialise.dict_to_type(dict(hostname='r2043', pid=1, colour='blue'), NodeMessage)
+
+
+class _Py36List:
+    """How Python 3.6's typing describes List[UUID]: the typing class is the origin, the runtime class the extra."""
+    __origin__ = typing.List
+    __extra__ = list
+    __args__ = (uuid.UUID,)
+
+
+def test_decode_py36_generics():
+    assert serialise.dict_to_type(['47d97d2d-9aeb-5e07-8072-ebcf9424fc97'], _Py36List) == [
+        uuid.UUID('47d97d2d-9aeb-5e07-8072-ebcf9424fc97')
+    ]
+
+
+def test_decode_datetime():
+    assert serialise.dict_to_type('2017-10-05T22:11:45.717952+00:00', datetime.datetime) == \
+        datetime.datetime(2017, 10, 5, 22, 11, 45, 717952, tzinfo=tz.tzutc())
+    # Not isoformat()
+    assert serialise.dict_to_type('5 Oct 2017 22:11', datetime.datetime) == datetime.datetime(2017, 10, 5, 22, 11)
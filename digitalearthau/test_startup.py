@@ -0,0 +1,58 @@
+"""
+Check that the command-line tools start quickly: importing an entry point mustn't import the slow,
+rarely-needed packages. They should only be imported by the code that uses them.
+"""
+import json
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+SETUP_PY = Path(__file__).parent.parent.joinpath('setup.py')
+
+# Top-level packages that no entry point should import on startup.
+SLOW_PACKAGES = {'osgeo', 'compliance_checker', 'celery', 'redis', 'eodatasets3', 'dawg', 'datacube_apps'}
+
+# Packages that aren't installed by setup.py, so a tool may not be importable without them.
+# (Slow ones, such as compliance_checker, mustn't be imported on startup at all.)
+OPTIONAL_PACKAGES = {'pyarrow'}
+
+# Generous: a cold import of datacube itself takes a few seconds. This catches gross regressions,
+# the package check above catches the likely ones.
+STARTUP_BUDGET_SECONDS = 15
+
+
+def _entry_points():
+    return re.findall(r"'(dea-[\w-]+) = ([\w.]+):\w+'", SETUP_PY.read_text())
+
+
+# Prints the import's wall time, and every top-level package imported along the way.
+_IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps(dict(seconds=time.perf_counter() - start,
+                      packages=sorted({{name.split('.')[0] for name in sys.modules}}))))
+"""
+
+
+@pytest.mark.parametrize('name,module', _entry_points())
+def test_entry_point_startup(name, module):
+    process = subprocess.run(
+        [sys.executable, '-c', _IMPORT_SCRIPT.format(module=module)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if process.returncode != 0:
+        error = process.stderr.strip().splitlines()[-1]
+        missing = re.match(r"ModuleNotFoundError: No module named '([\w.]+)'", error)
+        if missing and missing.group(1).split('.')[0] in OPTIONAL_PACKAGES:
+            pytest.skip('{} needs an optional package: {}'.format(name, error))
+        pytest.fail('{} fails to import:\n{}'.format(name, process.stderr))
+
+    startup = json.loads(process.stdout.strip().splitlines()[-1])
+    assert not set(startup['packages']) & SLOW_PACKAGES, '{} imports slow packages on startup'.format(name)
+    assert startup['seconds'] < STARTUP_BUDGET_SECONDS
@@ -0,0 +1,50 @@
+import multiprocessing
+import pstats
+
+import click
+from click.testing import CliRunner
+
+from digitalearthau import paths, uiutil
+
+
+def _square(x):
+    return sum(i * i for i in range(x))
+
+
+@click.command('pool-command')
+@uiutil.profile_option
+@click.argument('jobs', type=int)
+def _pool_command(jobs):
+    with multiprocessing.get_context('fork').Pool(processes=jobs) as pool:
+        pool.map(_square, [10000] * 20)
+        pool.close()
+        pool.join()
+
+
+def test_profile_option(tmp_path, monkeypatch):
+    monkeypatch.setattr(paths, 'NCI_WORK_ROOT', tmp_path)
+    monkeypatch.delenv(uiutil.PROFILE_ENV, raising=False)
+
+    result = CliRunner().invoke(_pool_command, ['--profile', '2'])
+    assert result.exit_code == 0, result.output
+
+    [profile_path] = tmp_path.glob('all/profile/*/*')
+    assert len(list(profile_path.glob('pool-command-[0-9]*.prof'))) == 1
+    assert len(list(profile_path.glob('pool-command-worker-*.prof'))) == 2
+
+    for prof in profile_path.glob('*.prof'):
+        pstats.Stats(str(prof))
+    for collapsed in profile_path.glob('*.collapsed'):
+        for line in collapsed.read_text().splitlines():
+            stack, count = line.rsplit(' ', 1)
+            assert stack.split(';')[0]
+            assert int(count) > 0
+
+
+def test_profile_env(tmp_path, monkeypatch):
+    monkeypatch.setenv(uiutil.PROFILE_ENV, str(tmp_path))
+
+    result = CliRunner().invoke(_pool_command, ['1'])
+    assert result.exit_code == 0, result.output
+    assert len(list(tmp_path.glob('*.prof'))) == 2
+    assert len(list(tmp_path.glob('*.collapsed'))) == 2
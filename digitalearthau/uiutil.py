@@ -1,9 +1,23 @@
+import cProfile
+import collections
+import datetime
+import multiprocessing.util
+import os
 import sys
+import threading
 from functools import partial
+from pathlib import Path
+from typing import Counter, Optional, Tuple
 
+import click
 import structlog
 
-from digitalearthau import serialise
+from digitalearthau import paths, serialise
+
+# Enables profiling, as with --profile. (It may also be the folder to write the profiles to)
+PROFILE_ENV = 'DEA_PROFILE'
+# How often the stack sampler records every thread's stack.
+PROFILE_SAMPLE_SECONDS = 0.01
 
 
 class CleanConsoleRenderer(structlog.dev.ConsoleRenderer):
@@ -44,3 +58,121 @@ def init_logging(output_file=None):
         cache_logger_on_first_use=True,
         logger_factory=structlog.PrintLoggerFactory(file=output_file),
     )
+
+
+class Profiler:
+    """
+    Profile this process two ways: cProfile records every call made in the main thread, and a sampler
+    records the stack of every thread at an interval.
+
+    When stopped, they're written to the output folder as `<name>-<pid>.prof` (for pstats, snakeviz...)
+    and `<name>-<pid>.collapsed` (collapsed stacks for flamegraph.pl, speedscope...).
+
+    Worker processes forked by multiprocessing (such as a Pool) profile themselves the same way, and write
+    their own files when they exit. (A worker that's terminated writes nothing)
+    """
+
+    def __init__(self, output_path: Path, name: str, sample_interval: float = PROFILE_SAMPLE_SECONDS) -> None:
+        self.output_path = output_path
+        self.name = name
+        self.sample_interval = sample_interval
+
+        self._profile = cProfile.Profile()
+        self._stacks = collections.Counter()  # type: Counter[Tuple[str, ...]]
+        self._stopping = threading.Event()
+        self._sampler = None  # type: Optional[threading.Thread]
+
+    def start(self):
+        self._sampler = threading.Thread(target=self._sample, name='profile-sampler', daemon=True)
+        self._sampler.start()
+        self._profile.enable()
+        multiprocessing.util.register_after_fork(self, Profiler._start_in_worker)
+
+    def _start_in_worker(self):
+        if self._stopping.is_set():
+            return
+        # We inherited the parent's profile, still running: start afresh.
+        self._profile.disable()
+        worker = Profiler(self.output_path, f'{self.name}-worker', self.sample_interval)
+        worker.start()
+        multiprocessing.util.Finalize(None, worker.stop, exitpriority=100)
+
+    def _sample(self):
+        sampler_id = threading.get_ident()
+        while not self._stopping.wait(self.sample_interval):
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if thread_id == sampler_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_globals.get('__name__')}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                self._stacks[tuple(reversed(stack))] += 1
+
+    def stop(self) -> Tuple[Path, Path]:
+        """
+        Stop profiling, and write the profile files, returning their paths.
+        """
+        self._profile.disable()
+        self._stopping.set()
+        self._sampler.join()
+
+        self.output_path.mkdir(parents=True, exist_ok=True)
+        file_stem = f'{self.name}-{os.getpid()}'
+
+        profile_path = self.output_path.joinpath(file_stem + '.prof')
+        self._profile.dump_stats(str(profile_path))
+
+        collapsed_path = self.output_path.joinpath(file_stem + '.collapsed')
+        with collapsed_path.open('w') as f:
+            for stack, count in self._stacks.items():
+                f.write(f"{';'.join(stack)} {count}\n")
+        return profile_path, collapsed_path
+
+
+def start_profiling(name: str) -> Profiler:
+    """
+    Profile this run (and its forked workers), into the folder named by DEA_PROFILE, or else a new
+    work directory. (see `paths.get_product_work_directory()`)
+    """
+    output_path = os.environ.get(PROFILE_ENV)
+    if output_path and os.path.isdir(output_path):
+        output_path = Path(output_path)
+    else:
+        output_path = paths.get_product_work_directory(
+            'all', time=datetime.datetime.utcnow(), task_type='profile'
+        )
+    # For any of our commands run beneath this one.
+    os.environ[PROFILE_ENV] = str(output_path)
+
+    profiler = Profiler(output_path, name)
+    profiler.start()
+    return profiler
+
+
+def profile_option(f):
+    """
+    Add a --profile option to a command: profile its run, and the worker processes it forks.
+
+    (Setting DEA_PROFILE in the environment does the same, see start_profiling)
+    """
+
+    def enable_profiling(ctx: click.Context, param, value):
+        if not (value or os.environ.get(PROFILE_ENV)):
+            return
+        profiler = start_profiling(ctx.find_root().info_name)
+
+        def finish():
+            for path in profiler.stop():
+                click.echo(f'Profile written to {path}', err=True)
+
+        ctx.find_root().call_on_close(finish)
+
+    return click.option('--profile',
+                        is_flag=True,
+                        is_eager=True,
+                        expose_value=False,
+                        callback=enable_profiling,
+                        help='Profile the run (and its workers) into a work directory. (Or set $DEA_PROFILE)')(f)
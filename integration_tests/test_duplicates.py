@@ -1,4 +1,5 @@
 import uuid
+from datetime import date
 from pathlib import Path
 
 import pytest
@@ -75,6 +76,57 @@ def test_duplicates(global_integration_cli_args,
     assert res.exit_code == 0
 
 
+def _find_ls8_duplicates(dea_index: Index, **kwargs):
+    product = dea_index.products.get_by_name('ls8_level1_scene')
+    return list(duplicates.find_duplicates(dea_index, [product], ('time', 'sat_path', 'sat_row'), **kwargs))
+
+
+def test_stream_rows(dea_index: Index,
+                     indexed_ls8_l1_scenes: Tuple[uuid.UUID, uuid.UUID], duplicate_ls8_l1_scene: uuid.UUID):
+    product = dea_index.products.get_by_name('ls8_level1_scene')
+    dea_index.datasets.archive([ON_DISK2_ID])
+
+    def stream(**kwargs):
+        rows = duplicates._stream_rows(dea_index, product.metadata_type, [product], ('time', 'sat_path', 'sat_row'),
+                                       **kwargs)
+        return {dataset_id: (product_name, values[1:], archived is not None)
+                for product_name, values, dataset_id, archived in rows}
+
+    # Archived datasets are only read if asked for.
+    assert stream() == {
+        ON_DISK1_ID: ('ls8_level1_scene', (114, 80), False),
+        ON_DISK1_DUP_ID: ('ls8_level1_scene', (114, 80), False),
+    }
+    assert stream(include_archived=True)[ON_DISK2_ID] == ('ls8_level1_scene', (114, 80), True)
+
+    rows = duplicates._stream_rows(dea_index, product.metadata_type, [product], ('time', 'sat_path', 'sat_row'),
+                                   solar_day=True)
+    assert {values for _, values, _, _ in rows} == {(date(2016, 9, 26), 114, 80)}
+
+
+def test_duplicates_by_solar_day(dea_index: Index,
+                                 indexed_ls8_l1_scenes: Tuple[uuid.UUID, uuid.UUID],
+                                 duplicate_ls8_l1_scene: uuid.UUID):
+    [group] = _find_ls8_duplicates(dea_index, solar_day=True)
+    assert group.values == (date(2016, 9, 26), 114, 80)
+    assert group.dataset_ids == [ON_DISK1_ID, ON_DISK1_DUP_ID]
+
+
+def test_archived_duplicates(dea_index: Index,
+                             indexed_ls8_l1_scenes: Tuple[uuid.UUID, uuid.UUID],
+                             duplicate_ls8_l1_scene: uuid.UUID):
+    dea_index.datasets.archive([ON_DISK1_DUP_ID])
+    assert _find_ls8_duplicates(dea_index) == []
+
+    # Still a duplicate of the active one.
+    [group] = _find_ls8_duplicates(dea_index, include_archived=True)
+    assert group.dataset_ids == [ON_DISK1_ID, ON_DISK1_DUP_ID]
+
+    # Nothing to fix once they're both archived.
+    dea_index.datasets.archive([ON_DISK1_ID])
+    assert _find_ls8_duplicates(dea_index, include_archived=True) == []
+
+
 def _run_cmd(args, global_integration_cli_args) -> click.testing.Result:
     res = click.testing.CliRunner().invoke(
         duplicates.cli, args=[
@@ -0,0 +1,21 @@
+from digitalearthau.index import local_uris
+
+from integration_tests.conftest import DatasetForTests
+
+
+def test_local_uris(test_dataset: DatasetForTests, other_dataset: DatasetForTests):
+    test_dataset.add_to_index()
+    index = test_dataset.collection.index_
+    assert local_uris(index, [test_dataset.id_, other_dataset.id_]) == {test_dataset.id_: test_dataset.uri}
+
+    # A newer location is preferred, and archived and remote ones are ignored.
+    moved_uri = other_dataset.uri
+    test_dataset.add_location(moved_uri)
+    test_dataset.add_location('s3://some-bucket/ga-metadata.yaml')
+    assert local_uris(index, [test_dataset.id_]) == {test_dataset.id_: moved_uri}
+
+    test_dataset.archive_location_in_index(uri=moved_uri)
+    assert local_uris(index, [test_dataset.id_]) == {test_dataset.id_: test_dataset.uri}
+
+    test_dataset.archive_location_in_index()
+    assert local_uris(index, [test_dataset.id_]) == {}
@@ -21,10 +21,12 @@ from integration_tests.conftest import DatasetForTests, freeze_index
 
 
 @pytest.fixture
-def destination_path(tmpdir) -> Path:
+def destination_path(tmpdir, work_path) -> Path:
     """A directory that datasets can be moved to or from.
 
     Provides a temp directory that is registered with the `digitalearthau.paths` module as a base directory.
+
+    (Moves write their manifest to the work path)
     """
     destination = Path(tmpdir) / 'destination_collection'
     destination.mkdir(exist_ok=False)
@@ -121,6 +123,34 @@ def test_nc_move(global_integration_cli_args,
     _check_successful_move(example_nc_dataset, expected_destination, other_dataset, res)
 
 
+def test_move_resume(global_integration_cli_args,
+                     test_dataset: DatasetForTests,
+                     other_dataset: DatasetForTests,
+                     destination_path,
+                     tmpdir):
+    """
+    Resuming a finished move from its manifest should skip the dataset, without touching the index.
+    """
+    test_dataset.add_to_index()
+    other_dataset.add_to_index()
+
+    expected_new_path = destination_path.joinpath(*test_dataset.path_offset)
+    manifest_path = Path(str(tmpdir)).joinpath('move-manifest.jsonl')
+
+    res = _call_move(['--manifest', manifest_path, '--destination', destination_path, test_dataset.path],
+                     global_integration_cli_args)
+    _check_successful_move(test_dataset, expected_new_path, other_dataset, res)
+
+    assert set(move.MoveManifest.read_stages(manifest_path).values()) == {move.MoveStage.INDEXED}
+
+    original_index = freeze_index(test_dataset.collection.index_)
+    res = _call_move(['--resume', '--manifest', manifest_path, '--destination', destination_path,
+                      test_dataset.path],
+                     global_integration_cli_args)
+    assert res.exit_code == 0, res.output
+    assert freeze_index(test_dataset.collection.index_) == original_index
+
+
 @pytest.mark.xfail(reason="Not yet implemented", strict=True)
 def test_move_when_already_exists_at_dest(global_integration_cli_args,
                                           test_dataset: DatasetForTests,
@@ -12,6 +12,7 @@ from typing import List, Tuple, Set, Iterable
 from datacube import Datacube
 from datacube.index._api import Index
 from datacube.model import Dataset
+from digitalearthau.index import ArchiveBatcher
 from digitalearthau.uiutil import init_logging
 
 _LOG = structlog.getLogger()
@@ -21,21 +22,20 @@ def main(dry_run=True):
     init_logging()
     index = Datacube().index
 
-    for group_name, dataset_ids in _find_dupes(index):
-        log = _LOG.bind(duplicate_group=group_name)
-        log.debug("duplicate.found", dataset_ids=dataset_ids)
-
-        to_remove = _choose_removable(dataset_ids, index, log)
-
-        if to_remove:
-            removable_ids = [dataset.id for dataset in to_remove]
-            log.info('duplicate.archive', dataset_ids=removable_ids)
-            if not dry_run:
-                index.datasets.archive(removable_ids)
-            for dataset in to_remove:
-                log.info('duplicate.archive_location', dataset_id=dataset.id, uri=dataset.local_uri)
-                if not dry_run:
-                    index.datasets.archive_location(dataset.id, dataset.local_uri)
+    with ArchiveBatcher(index, dry_run=dry_run, log=_LOG) as archiver:
+        for group_name, dataset_ids in _find_dupes(index):
+            log = _LOG.bind(duplicate_group=group_name)
+            log.debug("duplicate.found", dataset_ids=dataset_ids)
+
+            to_remove = _choose_removable(dataset_ids, index, log)
+
+            if to_remove:
+                removable_ids = [dataset.id for dataset in to_remove]
+                log.info('duplicate.archive', dataset_ids=removable_ids)
+                archiver.archive(removable_ids)
+                for dataset in to_remove:
+                    log.info('duplicate.archive_location', dataset_id=dataset.id, uri=dataset.local_uri)
+                    archiver.archive_location(dataset.id, dataset.local_uri)
 
 
 def _choose_removable(dataset_ids: List[UUID], index: Index, log) -> List[Dataset]:
@@ -4,18 +4,23 @@ Find gaps in the purported one-to-one correspondences between datasets across
 products.
 """
 
+import multiprocessing
 from sys import stderr
-from datetime import datetime
+from datetime import datetime, timedelta
 from itertools import combinations
-from functools import total_ordering
+from functools import partial, total_ordering
+from typing import NamedTuple, Tuple
 
+import numpy
 import yaml
 import click
+from dateutil import tz
 from dateutil.relativedelta import relativedelta
 
 from datacube import Datacube
 from datacube.model import Range
 from datacube.api import GridWorkflow
+from digitalearthau.index import search_arrays
 
 
 @total_ordering
@@ -102,109 +107,197 @@ def common_product_kind(datacube, products):
         return kind
 
 
-def mismatches(datacube, product1, product2, grid_workflow, query):
+# Fields needed to identify a scene, as (field, array dtype) for search_arrays()
+SCENE_FIELDS = [
+    ('id', 'O'),
+    ('time', 'datetime64[us]'), ('time.end', 'datetime64[us]'),
+    ('sat_path', 'i8'), ('sat_path.end', 'i8'),
+    ('sat_row', 'i8'), ('sat_row.end', 'i8'),
+]
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=tz.tzutc())
+
+
+class Keys(NamedTuple):
     """
-    Returns a pair of :class:`Tally` objects recording the mismatch
-    between two products matching the same (spatio-temporal) `query`.
-    Expects a pre-configured `GridWorkflow` object `grid_workflow`.
+    The spatio-temporal location of each dataset in a product, as rows of integers.
+
+    The first column is always the center time, in microseconds since the epoch.
     """
-    datasets = datacube.index.datasets
+    ids: numpy.ndarray
+    values: numpy.ndarray
+    # Names of the columns after time, for reporting: eg. ('path', 'row')
+    names: Tuple[str, ...]
+
+    def dataset(self, i):
+        """ The :class:`Dataset` of one row, for reporting. """
+        time, *others = (int(v) for v in self.values[i])
+        if self.names == ('index',):
+            keys = dict(index=str(tuple(others)))
+        else:
+            keys = dict(zip(self.names, others))
+        return Dataset(id_=str(self.ids[i]),
+                       time=str(_EPOCH + timedelta(microseconds=time)),
+                       **keys)
 
-    def check_no_duplicates(every, unique, product):
-        """
-        There should be no duplicates among the locations
-        in a product.
-        """
-        if len(every) == len(unique):
-            # nothing weird here
-            return True
 
-        count = 0
+def scene_keys(index, product, query):
+    """ Identify scenes by their time, path and row. """
+    batches = list(search_arrays(index, SCENE_FIELDS, product=product, **query))
+    if not batches:
+        return Keys(numpy.empty(0, dtype=object), numpy.empty((0, 3), dtype='int64'), ('path', 'row'))
+    rows = numpy.concatenate(batches)
 
-        for dataset in every:
-            equals = [d for d in every if d == dataset]
-            if len(equals) != 1:
-                # what?
-                count = count + 1
+    assert (rows['sat_path'] == rows['sat_path_end']).all(), "scenes should have a single path"
+    assert (rows['sat_row'] == rows['sat_row_end']).all(), "scenes should have a single row"
 
-                if count > 3:
-                    continue
+    begin, end = rows['time'].astype('int64'), rows['time_end'].astype('int64')
+    center_time = begin + (end - begin) // 2
+
+    return Keys(rows['id'],
+                numpy.column_stack([center_time, rows['sat_path'], rows['sat_row']]),
+                ('path', 'row'))
 
-                print('these datasets in {}'.format(product), file=stderr)
-                print('have the same spatio-temporal location',
-                      file=stderr)
 
-                for i, elem in enumerate(equals):
-                    print("#{} id: {}".format(i + 1, elem), file=stderr)
-                    for key in elem.keys:
-                        print("#{} {}: {}".format(i + 1, key, elem.keys[key]),
-                              file=stderr)
+def tile_keys(grid_workflow, product, query):
+    """ Identify tiles by their time and index. """
+    cells = grid_workflow.cell_observations(product=product, **query)
+    observations = [(dataset.id, _to_microseconds(dataset.center_time), x, y)
+                    for (x, y), cell in cells.items()
+                    for dataset in cell['datasets']]
+    if not observations:
+        return Keys(numpy.empty(0, dtype=object), numpy.empty((0, 3), dtype='int64'), ('index',))
 
-                    print(file=stderr)
+    ids, *values = zip(*observations)
+    return Keys(numpy.array(ids, dtype=object), numpy.column_stack(values).astype('int64'), ('index',))
 
-        if count > 3:
-            print('... and there were {} more.'.format(count - 3),
-                  file=stderr)
 
-        return False
+def _to_microseconds(time):
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=tz.tzutc())
+    return (time - _EPOCH) // timedelta(microseconds=1)
 
-    def unique_scenes(product):
-        """ Identify scenes by their time, path and row. """
 
-        def extract(path_or_row):
-            """ Make satellite path or row entry `yaml` friendly. """
-            assert path_or_row.begin == path_or_row.end
-            return int(path_or_row.begin)
+def duplicate_rows(values):
+    """
+    Which rows have the same values as another row?
 
-        every = [Dataset(id_=str(dataset.id),
-                         time=str(dataset.center_time),
-                         path=extract(dataset.metadata.sat_path),
-                         row=extract(dataset.metadata.sat_row))
-                 for dataset in datasets.search(product=product, **query)]
-        unique = set(every)
+    >>> duplicate_rows(numpy.array([[1, 2], [1, 3], [1, 2]])).tolist()
+    [True, False, True]
+    """
+    _, inverse, counts = numpy.unique(values, axis=0, return_inverse=True, return_counts=True)
+    return counts[inverse.reshape(-1)] > 1
 
-        check_no_duplicates(every, unique, product)
 
-        return unique
+def missing_rows(left, right):
+    """
+    Which rows of `left` do not appear in `right`?
 
-    def unique_tiles(product):
-        """ Identify tiles by their time and index. """
-        cells = grid_workflow.cell_observations(product=product, **query)
-        every = [Dataset(id_=str(dataset.id),
-                         time=str(dataset.center_time),
-                         index=str(index))
-                 for index in cells
-                 for dataset in cells[index]['datasets']]
-        unique = set(every)
+    >>> missing_rows(numpy.array([[1, 2], [1, 3], [5, 2]]), numpy.array([[5, 2], [1, 2]])).tolist()
+    [False, True, False]
+    """
+    _, inverse = numpy.unique(numpy.concatenate([left, right]), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    return ~numpy.isin(inverse[:len(left)], inverse[len(left):])
+
+
+def check_no_duplicates(keys, product):
+    """
+    There should be no duplicates among the locations
+    in a product.
+    """
+    duplicated = duplicate_rows(keys.values)
+    if not duplicated.any():
+        # nothing weird here
+        return True
+
+    rows = numpy.flatnonzero(duplicated)
+    groups = numpy.unique(keys.values[rows], axis=0)
+
+    for group in groups[:3]:
+        print('these datasets in {}'.format(product), file=stderr)
+        print('have the same spatio-temporal location',
+              file=stderr)
+
+        equals = rows[(keys.values[rows] == group).all(axis=1)]
+        for i, row in enumerate(equals):
+            elem = keys.dataset(row)
+            print("#{} id: {}".format(i + 1, elem), file=stderr)
+            for key in elem.keys:
+                print("#{} {}: {}".format(i + 1, key, elem.keys[key]),
+                      file=stderr)
 
-        check_no_duplicates(every, unique, product)
+            print(file=stderr)
 
-        return unique
+    if len(groups) > 3:
+        print('... and there were {} more.'.format(len(groups) - 3),
+              file=stderr)
 
+    return False
+
+
+def _unique(keys):
+    """ One row for each distinct location. """
+    _, first = numpy.unique(keys.values, axis=0, return_index=True)
+    return Keys(keys.ids[first], keys.values[first], keys.names)
+
+
+def mismatches(datacube, product1, product2, grid_workflow, query):
+    """
+    Returns a pair of :class:`Tally` objects recording the mismatch
+    between two products matching the same (spatio-temporal) `query`.
+    Expects a pre-configured `GridWorkflow` object `grid_workflow`.
+    """
     kind = common_product_kind(datacube, (product1, product2))
 
-    if kind == 'scene':
-        uniqueness_function = unique_scenes
-    else:
-        uniqueness_function = unique_tiles
+    def product_keys(product):
+        if kind == 'scene':
+            keys = scene_keys(datacube.index, product, query)
+        else:
+            keys = tile_keys(grid_workflow, product, query)
+
+        check_no_duplicates(keys, product)
+        return _unique(keys)
+
+    keys1 = product_keys(product1)
+    keys2 = product_keys(product2)
+
+    def tally(product, keys, other):
+        misses = numpy.flatnonzero(missing_rows(keys.values, other.values))
+        return Tally(product, {keys.dataset(i) for i in misses}, len(keys.ids))
+
+    return (tally(product1, keys1, keys2),
+            tally(product2, keys2, keys1))
 
-    set1 = uniqueness_function(product1)
-    set2 = uniqueness_function(product2)
-    common = set1 & set2
 
-    return (Tally(product1, set1 - common, len(set1)),
-            Tally(product2, set2 - common, len(set2)))
+def _window_mismatches(product1, product2, grid_product, query):
+    """ Mismatches of one time window, with its own connection to the index. """
+    datacube = Datacube(app='find-those-gaps')
+    grid_workflow = GridWorkflow(datacube.index, product=grid_product)
+    try:
+        return mismatches(datacube, product1, product2, grid_workflow, query)
+    finally:
+        datacube.close()
 
 
-def distribute(datacube, product1, product2, grid_workflow, queries):
+def distribute(datacube, product1, product2, grid_workflow, queries, workers=1, grid_product=None):
     """
     Accumulates mismatches between two products over a list of `queries`.
+
+    With more than one worker, the queries are spread over a pool of processes,
+    each with its own `GridWorkflow` for the `grid_product`.
     """
     total_left, total_right = Tally(product1), Tally(product2)
 
-    for sub in queries:
-        left, right = mismatches(datacube, product1, product2,
-                                 grid_workflow, sub)
+    if workers > 1:
+        window_mismatches = partial(_window_mismatches, product1, product2, grid_product)
+        with multiprocessing.Pool(processes=workers) as pool:
+            results = list(pool.imap_unordered(window_mismatches, queries))
+    else:
+        results = (mismatches(datacube, product1, product2, grid_workflow, sub)
+                   for sub in queries)
+
+    for left, right in results:
         total_left = total_left + left
         total_right = total_right + right
 
@@ -240,7 +333,7 @@ def subdivide_time_domain(time_divs=None, **query):
         yield query
 
 
-def find_gaps(datacube, products, query, time_divs=None):
+def find_gaps(datacube, products, query, time_divs=None, workers=1):
     """ Summary of gaps in the `products` compared pairwise. """
     products = list(set(products))
     assert len(products) != 0 and len(products) != 1, "no products to compare"
@@ -253,7 +346,8 @@ def find_gaps(datacube, products, query, time_divs=None):
                                            **query)
         left, right = distribute(datacube,
                                  product1, product2, grid_workflow,
-                                 subqueries)
+                                 subqueries, workers=workers,
+                                 grid_product=products[0])
         return {
             'products': [left.product, right.product],
             left.product: left.summary(),
@@ -311,12 +405,15 @@ def time_query(start_date, end_date):
 @click.option('--time-divs', type=int,
               help="Split up the computation into number of segments"
                    " of the date range.")
-def main(products, output_file, start_date, end_date, time_divs):
+@click.option('--workers', type=int, default=1,
+              help="Number of processes to spread the segments over.")
+def main(products, output_file, start_date, end_date, time_divs, workers):
     """ Entry point. """
     datacube = Datacube(app='find-those-gaps')
 
     summary = find_gaps(datacube, products,
-                        time_query(start_date, end_date), time_divs)
+                        time_query(start_date, end_date), time_divs,
+                        workers=workers)
 
     yaml.dump(summary, output_file, default_flow_style=False)
 
@@ -1,13 +1,21 @@
 import csv
-import os
+import itertools
+import multiprocessing
 import re
-
+import sys
+import time
 from datetime import datetime
-from urllib.parse import urlencode
+from functools import partial
 from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple
+from urllib.parse import urlencode
+
+import numpy
+from boltons import fileutils
 
 import datacube
 from datacube.model import Range
+from digitalearthau.index import local_uris, search_arrays
 
 THREDDS_PRODUCT_LIST = [
     'ls5_nbar_albers',
@@ -25,337 +33,189 @@ THREDDS_PRODUCT_LIST = [
 YEAR_RANGE = list(range(1986, datetime.now().year))
 OUTPUT_DIR = Path('./files')
 
+THREDDS_SERVER = 'http://dapds00.nci.org.au/thredds/wcs'
 
-# Fields
-class ObservationDateField:
-    NAME = 'observation_date'
-
-    @classmethod
-    def get_value(cls, dss_record):
-        """get_value: Returns the observation date for the record
-
-        :param dss_record: A dataset record
-        """
-        try:
-            return dss_record.time.begin.isoformat()
-        except AttributeError:
-            return ''
-
-
-class CreationDateField:
-    NAME = 'creation_date'
-
-    @classmethod
-    def get_value(cls, dss_record):
-        """get_value: Returns the creation date of the record
-
-        :param dss_record: A dataset record
-        """
-        try:
-            return dss_record.metadata.creation_dt
-        except (KeyError, AttributeError):
-            return ''
-
-
-class SpatialReferenceField:
-    NAME = 'spatial_reference'
-
-    @classmethod
-    def get_value(cls, dss_record):
-        """get_value: Returns the spatial reference for the dataset record
-
-        :param dss_record: A dataset record
-        """
-        try:
-            return dss_record.crs
-        except AttributeError:
-            return ''
-
-
-class CoordinateFieldFactory:
-
-    COORDINATE_MAP = {
-        'eastings': 0,
-        'northings': 1
-    }
-
-    CACHE = {}
-
-    # file:///{ignored}/{ignored}/{ignored}/{ignored}/{ignored}/{ignored}/-14_-12/{ignored}
-    REGEX_PATTERN = re.compile('file://(?:/[^/]*){6}/([-0-9]+)_([-0-9]+)')
-
-    @classmethod
-    def get_coordinate_field(cls, coordinate):
-        factory_cls = cls
-
-        class _CoordinateClass:
-            NAME = coordinate
-
-            @classmethod
-            def get_value(cls, dss_record):
-                return factory_cls.get_coordinate_value(dss_record, coordinate)
-
-        return _CoordinateClass
-
-    @classmethod
-    def get_coordinate_value(cls, dss_record, coordinate):
-        coordinate_idx = cls.COORDINATE_MAP[coordinate]
-        if cls.CACHE.get('coordinate_id') == dss_record.id:
-            return cls.CACHE.get('coordinate_value')[coordinate_idx]
+# file:///{ignored}/{ignored}/{ignored}/{ignored}/{ignored}/{ignored}/-14_-12/{ignored}
+TILE_URI_PATTERN = re.compile('file://(?:/[^/]*){6}/([-0-9]+)_([-0-9]+)')
 
-        coordinates = cls.REGEX_PATTERN.match(dss_record.local_uri).groups()
-
-        cls.CACHE['coordinate_id'] = dss_record.id
-        cls.CACHE['coordinate_value'] = coordinates
-
-        return cls.CACHE.get('coordinate_value')[coordinate_idx]
-
-
-class GeoTIFFFieldFactory:
-    """GeoTIFFFieldFactory: Factory class for converting dss_records to wcs geotiff urls"""
-    NCI_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
-    THREDDS_SERVER = 'http://dapds00.nci.org.au/thredds/wcs'
-    CACHE = {}
+# The index fields read for each dataset, as (field, array dtype) for search_arrays().
+# (Its location is read separately: the 'uri' field would give a row for every location, archived or not)
+DATASET_FIELDS = [
+    ('id', 'O'),
+    ('time', 'datetime64[us]'),
+    ('creation_time', 'datetime64[us]'),
+    ('lat.end', 'f8'),
+    ('lon.begin', 'f8'),
+]
 
-    @classmethod
-    def get_band_field(cls, band):
-        """get_band_field: Returns a field class that will return corresponding band url
+HEADERS = ['observation_date', 'creation_date', 'spatial_reference', 'eastings', 'northings']
 
-        :param band: The band of the band to return the field for
-        """
-        factory_cls = cls
 
-        class _BandClass:
-            NAME = band
+class ExportResult(NamedTuple):
+    product: str
+    year: int
+    path: Path
+    row_count: int
+    seconds: float
 
-            @classmethod
-            def get_value(cls, dss_record):
-                params = {
-                    'service': 'WCS',
-                    'version': '1.0.0',
-                    'request': 'GetCoverage',
-                    'format': 'GeoTIFF',
-                    'coverage': band,
-                    'time': factory_cls.get_begin_time(dss_record),
-                    'bbox': factory_cls.get_bounding_box(dss_record),
-                    band: '100.0'
-                }
-                return "{band}: {server}/{file_path}?{params}".format(
-                    band=band,
-                    server=factory_cls.THREDDS_SERVER,
-                    file_path=factory_cls.get_file_path(dss_record),
-                    params=urlencode(params)
-                )
 
-        return _BandClass
+def iso_times(times: numpy.ndarray) -> numpy.ndarray:
+    """
+    Format UTC times as datetime.isoformat() would: microseconds only when there are some. Missing times are empty.
 
-    @classmethod
-    def get_begin_time(cls, dss_record):
-        """get_begin_time: Returns the beginning time from dds record for geotiff query
-        Caching the last requested result
+    >>> iso_times(numpy.array(['2016-01-01T00:00:00', '2016-01-01T00:00:00.5'], dtype='datetime64[us]')).tolist()
+    ['2016-01-01T00:00:00+00:00', '2016-01-01T00:00:00.500000+00:00']
+    >>> iso_times(numpy.array(['NaT', '2016-01-01T00:00:00'], dtype='datetime64[us]')).tolist()
+    ['', '2016-01-01T00:00:00+00:00']
+    """
+    text = numpy.char.replace(numpy.datetime_as_string(times, unit='us'), '.000000', '')
+    return numpy.where(numpy.isnat(times), '', numpy.char.add(text, '+00:00'))
 
-        :param dss_record: Record being queried
-        """
-        if cls.CACHE.get('begin_time_id') == dss_record.id:
-            return cls.CACHE.get('begin_time_value')
 
-        cls.CACHE['begin_time_id'] = dss_record.id
-        cls.CACHE['begin_time_value'] = dss_record.time.begin.strftime(cls.NCI_DATE_FORMAT)
+def tile_coordinates(uris: numpy.ndarray):
+    """
+    The eastings and northings of each tile, from the tile folder in its uri.
 
-        return cls.CACHE.get('begin_time_value')
+    >>> tile_coordinates(numpy.array(['file:///g/data/rs0/datacube/002/LS8_OLI_NBAR/-14_-12/LS8_NBAR.nc']))
+    [('-14', '-12')]
+    """
+    return [TILE_URI_PATTERN.match(uri).groups() for uri in uris]
 
-    @classmethod
-    def get_file_path(cls, dss_record):
-        """get_file_path: Returns the file path for the url conversion, caching the last requested result
 
-        :param dss_record: Record being queried
-        """
-        if cls.CACHE.get('file_path_id') == dss_record.id:
-            return cls.CACHE.get('file_path_value')
-
-        cls.CACHE['file_path_id'] = dss_record.id
-        cls.CACHE['file_path_value'] = dss_record.local_uri.replace('file:///g/data/', '')
-
-        return cls.CACHE.get('file_path_value')
+def band_urls(band: str, file_paths: numpy.ndarray, begin_times: numpy.ndarray, bounding_boxes: numpy.ndarray):
+    """
+    WCS GeoTIFF urls of one band for a batch of datasets.
+
+    >>> [url] = band_urls('blue', numpy.array(['rs0/LS8.nc']), numpy.array(['2016-01-01T00:00:00Z']),
+    ...                   numpy.array(['140.0,-35.0,140.0,-35.0']))
+    >>> url.split('?')[0]
+    'blue: http://dapds00.nci.org.au/thredds/wcs/rs0/LS8.nc'
+    >>> url.split('&')[4:]
+    ['coverage=blue', 'time=2016-01-01T00%3A00%3A00Z', 'bbox=140.0%2C-35.0%2C140.0%2C-35.0', 'blue=100.0']
+    """
+    query_start = urlencode({
+        'service': 'WCS',
+        'version': '1.0.0',
+        'request': 'GetCoverage',
+        'format': 'GeoTIFF',
+        'coverage': band,
+    })
+    # The same escaping urlencode() would give these values.
+    times = numpy.char.replace(begin_times, ':', '%3A')
+    boxes = numpy.char.replace(bounding_boxes, ',', '%2C')
+
+    urls = numpy.char.add(f'{band}: {THREDDS_SERVER}/', file_paths)
+    urls = numpy.char.add(urls, f'?{query_start}&time=')
+    urls = numpy.char.add(urls, times)
+    urls = numpy.char.add(urls, '&bbox=')
+    urls = numpy.char.add(urls, boxes)
+    return numpy.char.add(urls, '&' + urlencode({band: '100.0'}))
+
+
+def format_rows(batch: numpy.ndarray, crs: str, bands) -> list:
+    """ Compute every output column for a batch of datasets at once. """
+    uris = batch['uri'].astype(str)
+    file_paths = numpy.char.replace(uris, 'file:///g/data/', '')
+    begin_times = numpy.char.add(numpy.datetime_as_string(batch['time'], unit='s'), 'Z')
+
+    lon, lat = batch['lon_begin'].astype(str), batch['lat_end'].astype(str)
+    corner = numpy.char.add(numpy.char.add(lon, ','), lat)
+    bounding_boxes = numpy.char.add(numpy.char.add(corner, ','), corner)
+
+    eastings, northings = zip(*tile_coordinates(uris))
+    columns = [
+        iso_times(batch['time']),
+        iso_times(batch['creation_time']),
+        [crs] * len(batch),
+        eastings,
+        northings,
+    ] + [band_urls(band, file_paths, begin_times, bounding_boxes) for band in bands]
+    return list(zip(*columns))
+
+
+def export_product_year(product, year, output_dir=OUTPUT_DIR) -> ExportResult:
+    """
+    Write the list of one product's datasets for one year.
 
-    @classmethod
-    def get_bounding_box(cls, dss_record):
-        """get_bounding_box: Returns the bounding box for the url conversion, caching the last requested result
-
-        :param dss_record: Record being queried
-        """
-        if cls.CACHE.get('bounding_box_id') == dss_record.id:
-            return cls.CACHE.get('bounding_box_value')
-
-        cls.CACHE['bounding_box_value'] = ",".join((
-            str(dss_record.metadata.lon.begin),
-            str(dss_record.metadata.lat.end),
-            str(dss_record.metadata.lon.begin),
-            str(dss_record.metadata.lat.end)
+    The file is written atomically, and not at all if there are no datasets.
+    """
+    start = time.monotonic()
+    path = output_dir / product / "{}.csv".format(year)
+    row_count = 0
+
+    dc = datacube.Datacube(app='generate-product-list')
+    try:
+        product_definition = dc.index.products.get_by_name(product)
+        bands = list(product_definition.measurements.keys())
+        crs = str(product_definition.grid_spec.crs) if product_definition.grid_spec else ''
+
+        batches = _local_datasets(dc.index, search_arrays(
+            dc.index,
+            DATASET_FIELDS,
+            product=product,
+            time=Range(datetime(year, 1, 1), datetime(year + 1, 1, 1))
         ))
-
-        cls.CACHE['bounding_box_id'] = dss_record.id
-        return cls.CACHE.get('bounding_box_value')
-
-
-class DCReader:
-    """DCReader: Iterates over products and years to provide product list dataset"""
-
-    def __init__(self, dc, product_list, year_range):
-        self.product_list = product_list
-        self.year_range = year_range
-        self.datacube = dc
-        self.curr_idx = None
-
-    def get_current_bands(self):
-        return (
-            self.datacube.index.products
-            .get_by_name(self.product_list[self.curr_idx['product']])
-            .measurements.keys()
-        )
-
-    def __iter__(self):
-        self.curr_idx = {'product': 0, 'year': -1}
-        return self
-
-    def __next__(self):
-        self.curr_idx['year'] += 1
-
-        if self.curr_idx['year'] >= len(self.year_range):
-            self.curr_idx['year'] = 0
-            self.curr_idx['product'] += 1
-
-        if self.curr_idx['product'] >= len(self.product_list):
-            raise StopIteration
-
-        return (
-            self.product_list[self.curr_idx['product']],
-            self.year_range[self.curr_idx['year']],
-            self.datacube.index.datasets.search(
-                product=self.product_list[self.curr_idx['product']],
-                time=Range(
-                    datetime(self.year_range[self.curr_idx['year']], 1, 1),
-                    datetime(self.year_range[self.curr_idx['year']] + 1, 1, 1)
-                )
-            )
-        )
-
-
-class CSVWriter:
-    """CSVWriter: Object that configures and controls writing datasets to a csv file"""
-
-    LIST_DELIM = ' | '
-
-    def __init__(self):
-        self.headers = None
-        self.file_path = None
-        self.fdesc = None
-        self.writer = None
-
-    def configure(self, file_path, headers):
-        self.file_path = file_path
-        self.headers = headers
-
-    def open(self):
-        """open: calls enter and writes out the headers"""
-        self.__enter__()
-        self.write(self.headers)
-
-    def close(self, valid_data):
-        self.__exit__()
-
-        if not valid_data:
-            self.file_path.unlink()
-
-    def create_outdir(self):
-        """create_outdir: Creates configured output directory"""
-        outdir = Path(*self.file_path.absolute().parts[:-1])
-        outdir.mkdir(parents=True, exist_ok=True)
-
-    def __enter__(self):
-        """__enter__: Creates output directory and opens csv file"""
-        self.create_outdir()
-        self.fdesc = self.file_path.open(mode='w')
-        self.writer = csv.writer(self.fdesc)
-        return self.writer
-
-    def write(self, data):
-        """write writes the data to the configured csv file
-
-        :param data: a list containing the records to write out
-        """
-        for i, _ in enumerate(data):
-            if isinstance(data[i], str):
-                continue
-            elif hasattr(data[i], '__iter__'):
-                data[i] = self.LIST_DELIM.join([str(txt) for txt in data[i]])
-            else:
-                data[i] = str(data[i])
-
-        self.writer.writerow(data)
-
-    def __exit__(self, *exc_details):
-        """__exit__: Closing the open file descriptor
-
-        :param *exc_details: Inbuilt args
-        """
-        if self.fdesc:
-            self.fdesc.close()
-        self.fdesc = None
-
-
-def process_product_list(product_generator, product_writer):
-    """process_product_list
-    Iterates over the list of products and writes to the configured output.
-
-    :param product_generator: (object) An iterator over a list of products
-    :param product_writer: (object) A writer that implements configure, open, write, close.
+        first_batch = next(batches, None)
+        if first_batch is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with fileutils.atomic_save(str(path), text_mode=True) as f:
+                writer = csv.writer(f)
+                writer.writerow(HEADERS + bands)
+                for batch in itertools.chain([first_batch], batches):
+                    writer.writerows(format_rows(batch, crs, bands))
+                    row_count += len(batch)
+    finally:
+        dc.close()
+
+    return ExportResult(product, year, path, row_count, time.monotonic() - start)
+
+
+def _local_datasets(index, batches: Iterable[numpy.ndarray]) -> Iterator[numpy.ndarray]:
     """
+    Add each dataset's newest active file location as a 'uri' column, dropping those without one.
 
-    data_row = None
-    for product, year, dataset in product_generator:
-
-        fields = [
-            ObservationDateField,
-            CreationDateField,
-            SpatialReferenceField,
-            CoordinateFieldFactory.get_coordinate_field('eastings'),
-            CoordinateFieldFactory.get_coordinate_field('northings')
-        ]
-
-        # Add a field for each band
-        for band in product_generator.get_current_bands():
-            fields.append(GeoTIFFFieldFactory.get_band_field(band))
-
-        headers = list(map(lambda field: field.NAME, fields))
-
-        product_writer.configure(
-            OUTPUT_DIR / product / "{}.csv".format(year),  # Pathlib path concatenation
-            headers
-        )
-        product_writer.open()
-
-        for data_row in dataset:
-            product_writer.write(
-                list(map(lambda field: field.get_value(data_row), fields))
-            )
+    Empty batches are dropped.
+    """
+    for batch in batches:
+        uris = local_uris(index, batch['id'])
+        batch = batch[numpy.fromiter((id_ in uris for id_ in batch['id']), dtype=bool, count=len(batch))]
+        if not len(batch):
+            continue
 
-        product_writer.close(valid_data=(data_row is not None))
+        with_uri = numpy.empty(len(batch), dtype=batch.dtype.descr + [('uri', 'O')])
+        for name in batch.dtype.names:
+            with_uri[name] = batch[name]
+        with_uri['uri'] = [uris[id_] for id_ in batch['id']]
+        yield with_uri
 
 
-def main(product_list=None, year_range=None):
+def main(product_list=None, year_range=None, workers=1, output_dir=OUTPUT_DIR):
     """
     Reads product list from the database and creates a directory of csv files.
+
+    Each (product, year) is written by one of the worker processes.
     """
-    product_generator = DCReader(
-        datacube.Datacube(),
-        (product_list or THREDDS_PRODUCT_LIST),
-        (year_range or YEAR_RANGE)
-    )
+    start = time.monotonic()
+    pairs = [(product, year)
+             for product in (product_list or THREDDS_PRODUCT_LIST)
+             for year in (year_range or YEAR_RANGE)]
+
+    export = partial(_export_pair, output_dir=output_dir)
+    with multiprocessing.Pool(processes=workers) as pool:
+        total_rows = 0
+        for result in pool.imap_unordered(export, pairs):
+            total_rows += result.row_count
+            if result.row_count:
+                print('{r.path}: {r.row_count} datasets in {r.seconds:.1f}s'.format(r=result), file=sys.stderr)
+
+    print('{} datasets from {} products and years in {:.1f}s'.format(
+        total_rows, len(pairs), time.monotonic() - start
+    ), file=sys.stderr)
 
-    product_writer = CSVWriter()
 
-    process_product_list(product_generator, product_writer)
+def _export_pair(pair, output_dir=OUTPUT_DIR):
+    product, year = pair
+    return export_product_year(product, year, output_dir=output_dir)
 
 
 if __name__ == '__main__':
@@ -364,6 +224,9 @@ if __name__ == '__main__':
     PARSER = argparse.ArgumentParser(description='Generates a product list.')
     PARSER.add_argument('--year', type=int, nargs="+", dest="year_range", help='Year to process')
     PARSER.add_argument('--product', nargs="+", dest="product_list", help='Product to process')
+    PARSER.add_argument('--workers', type=int, default=1, help='Number of processes to export with')
+    PARSER.add_argument('--output-dir', type=Path, default=OUTPUT_DIR, help='Folder to write the lists to')
 
     ARGS = vars(PARSER.parse_args())
-    main(product_list=ARGS.get('product_list'), year_range=ARGS.get('year_range'))
+    main(product_list=ARGS.get('product_list'), year_range=ARGS.get('year_range'),
+         workers=ARGS.get('workers'), output_dir=ARGS.get('output_dir'))
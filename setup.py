@@ -37,12 +37,13 @@ setup(
         'colorama',  # Needed for structlog's CLI output.
         'click>=5.0',
         'datacube[celery] >= 1.8',
-        'python-dateutil',
+        'python-dateutil>=2.7',  # For isoparse()
         'gdal',
         'eodatasets3>=0.4.0',
         'structlog',
         'DAWG',
         'boltons',
+        'cloudpickle',
         'lxml',
         'pydash',
     ],
@@ -54,6 +55,7 @@ setup(
             'dea-clean = digitalearthau.cleanup:cli',
             'dea-coherence = digitalearthau.coherence:main',
             'dea-duplicates = digitalearthau.duplicates:cli',
+            'dea-events = digitalearthau.eventstore:cli',
             'dea-harvest = digitalearthau.harvest.iso19115:main',
             'dea-move = digitalearthau.move:cli',
             'dea-submit-ingest = digitalearthau.submit.ingest:cli',